@@ -54,8 +54,13 @@ import glob
 import random
 from struct import pack,unpack
 import json
+import mmap
+import numbers
+import numpy as np
 
 import threading
+import queue
+import traceback
 #from Sparx import *
 
 HOMEDB=None
@@ -82,7 +87,7 @@ except: pass
 #try:
 #import EMAN2db
 from EMAN2db import EMAN2DB,db_open_dict,db_close_dict,db_remove_dict,db_list_dicts,db_check_dict,db_parse_path,db_convert_path,db_get_image_info,e2gethome, e2getcwd
-from EMAN2jsondb import JSDict,js_open_dict,js_close_dict,js_remove_dict,js_list_dicts,js_check_dict,js_one_key
+from EMAN2jsondb import JSDict,js_open_dict,js_close_dict,js_remove_dict,js_list_dicts,js_check_dict,js_one_key,js_compact_dict
 #except:
 #	HOMEDB=None
 
@@ -1317,6 +1322,65 @@ def num_cpus():
 		print("error, in num_cpus - unknown platform string:",platform_string," - returning 2")
 		return 2
 
+def thread_map(func,tasks,nthreads,callback=None,logid=None,cancel=None):
+	"""Runs func(*task) for each task in tasks using at most nthreads worker threads, and returns
+a list of the return values in task order. This replaces the common pattern of making one Thread per
+task and spinning on threading.active_count(). callback(i,result) is called in the calling thread as
+each task finishes, so it is safe to write files or accumulate results there. If logid (from E2init)
+is specified, E2progress is updated as tasks complete. cancel is an optional callable polled in the
+calling thread; once it returns True, tasks which have not yet started are skipped and None is left
+in their slot. An exception in any task stops the remaining tasks and is re-raised here."""
+	tasks=list(tasks)
+	ntask=len(tasks)
+	ret=[None]*ntask
+	if ntask==0 : return ret
+	nthreads=max(1,min(int(nthreads),ntask))
+
+	todo=queue.Queue()
+	for i,t in enumerate(tasks): todo.put((i,t))
+	done=queue.Queue()
+	stop=threading.Event()
+
+	def worker():
+		while not stop.is_set():
+			try: i,t=todo.get_nowait()
+			except queue.Empty: return
+			try: done.put((i,func(*t),None))
+			except Exception as e:
+				traceback.print_exc()
+				done.put((i,None,e))
+				stop.set()
+				return
+
+	thrds=[threading.Thread(target=worker) for j in range(nthreads)]
+	for t in thrds:
+		t.daemon=True
+		t.start()
+
+	err=None
+	ndone=0
+	lastpct=-1
+	while ndone<ntask:
+		if cancel!=None and not stop.is_set() and cancel() : stop.set()
+		try: i,r,e=done.get(timeout=0.1)
+		except queue.Empty:
+			# once stopped, we only wait for tasks which are already running
+			if stop.is_set() and not any(t.is_alive() for t in thrds) and done.empty() : break
+			continue
+		ndone+=1
+		if e!=None :
+			if err==None : err=e
+			continue
+		ret[i]=r
+		if callback!=None and err==None : callback(i,r)
+		if logid!=None and int(ndone*100/ntask)!=lastpct :
+			lastpct=int(ndone*100/ntask)
+			E2progress(logid,ndone/ntask)
+
+	for t in thrds: t.join()
+	if err!=None : raise err
+	return ret
+
 def gimme_image_dimensions2D( imagefilename ):
 	"""returns the dimensions of the first image in a file (2-D)"""
 
@@ -2151,6 +2215,82 @@ def write_FSC_file(fsc,filename) :
 	for i in range(sz):
 		out.write("{}\t{}\n".format(fsc[i],fsc[i+sz]))
 
+def frc_rings(ny):
+	"""Ring index of each complex pixel of a 2-D ny x ny Fourier transform (as returned by numpy() on the EMData, viewed
+	as complex64), using the same binning as EMData.calc_fourier_shell_correlation. Pixels that the C++ code skips
+	(Friedel pairs on the first column and the corners) are assigned to an extra ring ny//2+1. Pass the result to
+	calc_frc_batch/frc_cmp_batch to avoid recomputing it for every call."""
+	nc=ny//2+1
+	ny2=ny//2
+	d2=np.float32(1./ny2/ny2)
+	ky=np.arange(ny)
+	ky[ky>ny2]-=ny
+	argy=(ky*ky).astype(np.float32)*d2
+	ix=np.arange(nc)*2
+	argx=(ix*ix).astype(np.float32)*np.float32(.25)*d2
+	r=np.float32(.5)*np.sqrt(argy[:,None]+argx[None,:])
+	r=np.floor(np.float32(ny2*2)*r+np.float32(.5)).astype(int)
+	use=(r<=ny2)
+	use[:,0]&=(ky>=0)
+	r[~use]=ny2+1
+	return r.flatten()
+
+def fft_stack(imgs):
+	"""Complex numpy array (n, ny, ny//2+1) from a complex EMData, a list of them or the float32 numpy() array(s)"""
+	if isinstance(imgs, EMData): imgs=[imgs]
+	if isinstance(imgs, np.ndarray) and np.iscomplexobj(imgs):
+		return imgs.reshape((-1,)+imgs.shape[-2:])
+	if not isinstance(imgs, np.ndarray):
+		imgs=np.array([m.numpy() for m in imgs], dtype=np.float32)
+	imgs=np.ascontiguousarray(imgs, dtype=np.float32)
+	if imgs.ndim==2: imgs=imgs[None,:,:]
+	return imgs.view(np.complex64)
+
+def calc_frc_batch(imgs, pjs, rings=None):
+	"""FRC between complex 2-D images and projections, all with the same size and Fourier layout. imgs may be a single
+	image, compared to every projection, or one image per projection. Inputs may be EMData, lists of EMData or numpy
+	arrays of the raw complex data. Returns an N x (ny//2+1) array, matching the second third of
+	EMData.calc_fourier_shell_correlation for each pair."""
+	b=fft_stack(pjs)
+	a=fft_stack(imgs)
+	n=len(b)
+	if rings is None: rings=frc_rings(b.shape[1])
+	a=a.reshape((len(a),-1))
+	b=b.reshape((n,-1))
+	nr=np.max(rings)+1
+	idx=(rings[None,:]+nr*np.arange(n)[:,None]).flatten()
+	ret=np.bincount(idx, (a*np.conj(b)).real.flatten().astype(np.float64), n*nr).reshape((n,nr))
+	n2=np.bincount(idx, (abs(b)**2).flatten().astype(np.float64), n*nr).reshape((n,nr))
+	if len(a)==1:
+		n1=np.bincount(rings, (abs(a[0])**2).astype(np.float64), nr)
+	else:
+		n1=np.bincount(idx, (abs(a)**2).flatten().astype(np.float64), n*nr).reshape((n,nr))
+	fsc=ret/np.sqrt(n1*n2+1e-30)
+	return fsc[:, :-1]
+
+def frc_cmp_batch(imgs, pjs, pmin=0, pmax=0, rings=None, wt=None, apix=None, minres=200.0, maxres=8.0):
+	"""Same as a.cmp("frc",b,{"pmin":pmin,"pmax":pmax,"minres":minres,"maxres":maxres}) for each projection a and
+	image b, computed in one pass. As in FRCCmp, pmin/pmax of 0 are replaced by the minres/maxres (A) cutoffs, which
+	needs apix. This is taken from the first projection if pjs are EMData; for numpy input it must be passed, otherwise
+	pmin/pmax of 0 mean no cutoff. wt is an optional extra per-ring weight (e.g. a CTF curve). Returns an array of N
+	scores, more negative is better."""
+	if apix is None:
+		if isinstance(pjs, EMData): apix=pjs["apix_x"]
+		elif not isinstance(pjs, np.ndarray) and isinstance(pjs[0], EMData): apix=pjs[0]["apix_x"]
+	b=fft_stack(pjs)
+	ny=b.shape[1]
+	if apix is not None:
+		if pmin==0 and minres>0: pmin=apix*ny/minres
+		if pmax==0 and maxres>0: pmax=apix*ny/maxres
+	if rings is None: rings=frc_rings(ny)
+	fsc=calc_frc_batch(imgs, b, rings)[:, :ny//2]
+	i=np.arange(ny//2, dtype=np.float64)
+	weight=np.bincount(rings, minlength=ny//2+2)[:ny//2]*2.
+	if pmin>0: weight*=(np.tanh(5.0*(i-pmin)/pmin)+1.0)/2.0
+	if pmax>0: weight*=(1.0-np.tanh(i-pmax))/2.0
+	if wt is not None: weight*=np.asarray(wt)[:ny//2]
+	return -np.sum(fsc*weight, axis=1)/np.sum(weight)
+
 def initializeCUDAdevice():
 	# Initialize CUDA upon EMAN2 import. If cuda is not compiled an error will be thrown an nothing will happen
 	try:
@@ -2171,11 +2311,21 @@ The file begins with
 number<\t>filename<\t>comment
 ...
 """
-	def __init__(self,path,ifexists=False, comments=""):
+	def __init__(self,path,ifexists=False, comments="", readonly=False):
 		"""Initialize the object using the .lst file in 'path'. If 'ifexists' is set, an exception will be raised
-if the lst file does not exist."""
+if the lst file does not exist. If 'readonly' is set, the file must exist, and records are read through a read-only
+memory map rather than the file pointer, which permits concurrent reads from multiple threads. Normally readonly
+objects should be obtained via lsx_cached()."""
 
 		self.path=path
+		self.mm=None
+		self.dirty=False
+		self.readonly=readonly
+		if readonly:
+			self.ptr=None
+			self.open_readonly()
+			return
+
 		if len(comments)==0:
 			comments="# This file is in fast LST format. All lines after the next line have exactly the number of characters shown on the next line. This MUST be preserved if editing."
 
@@ -2256,10 +2406,46 @@ if the lst file does not exist."""
 		if len(tupl)==3 : self.write(n,tupl[0],tupl[1],tupl[2])
 		else : self.write(n,tupl[0],tupl[1])
 
+	def open_readonly(self):
+		"""Opens an existing #LSX file for memory-mapped read-only access. If the header line length is consistent
+with the file size, the record count is computed directly and no pass over the file is required. Otherwise the
+file is normalized (or converted from #LST) once with a writable LSXFile before being mapped."""
+
+		for i in range(2):
+			ptr=open(self.path,"rb")
+			if ptr.readline()==b"#LSX\n":
+				self.filecomment=ptr.readline().decode("utf-8").strip()
+				try: self.linelen=int(ptr.readline()[1:])
+				except: self.linelen=0
+				self.seekbase=ptr.tell()
+				size=os.fstat(ptr.fileno()).st_size
+				if self.linelen>0 and (size-self.seekbase)%self.linelen==0:
+					self.n=(size-self.seekbase)//self.linelen
+					if self.n==0: break
+					self.mm=mmap.mmap(ptr.fileno(),0,access=mmap.ACCESS_READ)
+					# spot check the first and last records, a full check is what we are trying to avoid
+					if self.mm[self.seekbase+self.linelen-1:self.seekbase+self.linelen]==b"\n" and self.mm[size-1:size]==b"\n" : break
+					self.mm.close()
+					self.mm=None
+			ptr.close()
+			if i==1: raise Exception("ERROR: unable to normalize #LSX file {}".format(self.path))
+
+			# converts/rewrites the file if necessary
+			LSXFile(self.path,True).close()
+
+		ptr.close()
+
+		# legacy LST file support
+		if self.filecomment.startswith("#keys: "): self.filekeys=self.filecomment[7:].split(';')
+		else: self.filekeys=None
+
 	def close(self):
 		"""Once you call this, you should not try to access this object any more"""
+		if self.mm!=None :
+			self.mm.close()
+			self.mm=None
 		if self.ptr!=None :
-			self.normalize()
+			if self.dirty: self.normalize()
 			self.ptr=None
 
 	def write(self,n,nextfile,extfile,jsondict=None):
@@ -2269,6 +2455,8 @@ nextfile : the image number in the referenced image file
 extfile : the path to the referenced image file (can be relative or absolute, depending on purpose)
 jsondict : optional string in JSON format or a JSON compatible dictionary. values will override header values when an image is read.
 """
+		if self.readonly : raise Exception("Error: attempt to write to read-only #LSX {}".format(self.path))
+		self.dirty=True
 
 		if jsondict==None : 
 			outln="{}\t{}".format(nextfile,extfile)
@@ -2303,8 +2491,12 @@ contains decoded information from the stored JSON dictionary. Will also read cer
 and translate them into a dictionary."""
 		if n>=self.n : raise Exception("Attempt to read record {} from #LSX {} with {} records".format(n,self.path,self.n))
 		n=int(n)
-		self.ptr.seek(self.seekbase+self.linelen*n)
-		ln=self.ptr.readline().strip().split("\t")
+		if self.mm!=None :
+			loc=self.seekbase+self.linelen*n
+			ln=self.mm[loc:loc+self.linelen].decode("utf-8").strip().split("\t")
+		else:
+			self.ptr.seek(self.seekbase+self.linelen*n)
+			ln=self.ptr.readline().strip().split("\t")
 		if len(ln)==2 : ln.append("")
 		try: ln[0]=int(ln[0])
 		except:
@@ -2403,6 +2595,7 @@ but this method prevents multiple open/close operations on the #LSX file."""
 		"""This will read the entire file and insure that the line-length parameter is valid. If it is not,
 it will rewrite the file with a valid line-length. """
 
+		if self.readonly : return
 		self.ptr.seek(self.seekbase)
 		self.n=0
 		while 1:
@@ -2457,6 +2650,32 @@ line length. Used when a line must be added in the middle of the file."""
 
 #		print "rewrite ",self.linelen
 
+# process-wide cache of read-only LSXFile objects, keyed by absolute path
+lsxcache={}
+lsxcache_max=16
+lsxcache_lock=threading.Lock()
+
+def lsx_cached(path):
+	"""Returns a read-only, memory-mapped LSXFile for 'path' from a process-wide cache. The cached object is
+reused as long as the file's inode, modification time and size are unchanged, so repeated single-image reads from the
+same .lst file do not reopen or rescan it. The returned object must not be closed or written to."""
+
+	key=os.path.abspath(path)
+	st=os.stat(key)
+	with lsxcache_lock:
+		try:
+			lsx,stkey=lsxcache[key]
+			if stkey==(st.st_ino,st.st_mtime_ns,st.st_size) : return lsx
+			del lsxcache[key]
+		except KeyError: pass
+
+		lsx=LSXFile(path,True,readonly=True)
+		st=os.stat(key)			# open_readonly may have normalized the file
+		if len(lsxcache)>=lsxcache_max : del lsxcache[next(iter(lsxcache))]
+		lsxcache[key]=(lsx,(st.st_ino,st.st_mtime_ns,st.st_size))
+
+	return lsx
+
 def image_eosplit(filename):
 	"""This will take an input image stack in LSX or normal image format and produce output .lst (LSX)
 files corresponding to even and odd numbered particles. It will return a tuple with two filenames
@@ -2514,11 +2733,12 @@ corresponding to each 1/2 of the data."""
 
 	return (eset,oset)
 
-def save_lst_params(lst,fsp, overwrite=True):
+def save_lst_params(lst,fsp, overwrite=True, sidecar=True):
 	"""Saves a LSX file (fsp) with metadata represented by a list of dictionaries (lst).
 	each dictionary must contain 'src', the image file containing the actual image and
 	'idx' the index in that file. Additional keys will be stored in the LSX metadata
-	region. Overwrite existing file by default."""
+	region. Overwrite existing file by default. If sidecar is set, a columnar copy of the
+	metadata is also written to fsp+".npz" (see save_lst_sidecar)."""
 	if len(lst)==0: raise(Exception,"ERROR: save_lst_params with empty list")
 	
 	if overwrite:
@@ -2531,10 +2751,130 @@ def save_lst_params(lst,fsp, overwrite=True):
 		p=dct.pop("src")
 		n=dct.pop("idx")
 		lsx.write(-1,n,p,dct)
+	lsx.close()
+	lsx=None
+
+	if sidecar and overwrite : save_lst_sidecar(lst,fsp)
+	elif os.path.isfile(fsp+".npz") : os.remove(fsp+".npz")
+
+def save_lst_sidecar(lst,fsp):
+	"""Writes the metadata in lst (as passed to save_lst_params) as a columnar binary sidecar, fsp+".npz", for the
+	already written LSX file fsp. Each key becomes one array: numbers, booleans and strings are stored directly and
+	Transforms as (N,12) float32 matrices. Keys missing from some records get an additional presence mask. The
+	sidecar records the identity of the LSX file it was written for, and is ignored if the LSX file is later modified.
+	If some key cannot be represented (eg - an EMAN2Ctf object), no sidecar is written and False is returned."""
+
+	sfsp=fsp+".npz"
+	if os.path.isfile(sfsp) : os.remove(sfsp)
+
+	n=len(lst)
+	srcfiles,srcid=np.unique([d["src"] for d in lst],return_inverse=True)
+	arrays={"src_files":srcfiles,"src":srcid.astype(np.int32),"idx":np.array([d["idx"] for d in lst],dtype=np.int64)}
+	layout=[]
+	for i,k in enumerate(sorted(set(k for d in lst for k in d)-{"src","idx"})):
+		has=np.array([k in d for d in lst])
+		vals=[d[k] for d in lst if k in d]
+		if all(isinstance(v,Transform) for v in vals):
+			kind="xf"
+			col=np.zeros((n,12),dtype=np.float32)
+			col[has]=[v.get_matrix() for v in vals]
+		else:
+			if all(isinstance(v,(bool,np.bool_)) for v in vals): kind,dtype,dflt="bool",bool,False
+			elif all(isinstance(v,numbers.Integral) for v in vals): kind,dtype,dflt="int",np.int64,0
+			elif all(isinstance(v,numbers.Real) for v in vals): kind,dtype,dflt="float",np.float64,0.0
+			elif all(isinstance(v,str) for v in vals): kind,dtype,dflt="str",str,""
+			else: return False
+			col=np.array([d.get(k,dflt) for d in lst],dtype=dtype)
+		arrays["c{}".format(i)]=col
+		if not has.all() : arrays["m{}".format(i)]=has
+		layout.append((k,kind,not has.all()))
+
+	st=os.stat(fsp)
+	arrays["layout"]=np.array(json.dumps(layout))
+	arrays["lststat"]=np.array((st.st_ino,st.st_mtime_ns,st.st_size,n),dtype=np.int64)
+	np.savez(fsp+".tmp.npz",**arrays)
+	os.replace(fsp+".tmp.npz",sfsp)
+	return True
 
-def load_lst_params(fsp , imgns=None):
+class LSXParams(object):
+	"""A read-only, NumPy-backed view of the metadata in an LSX file, read from the columnar sidecar written by
+save_lst_params. Indexing or iterating produces the same dictionaries as load_lst_params, but each dictionary (and any
+Transform objects in it) is only constructed when that record is accessed. Entire columns are available as arrays via
+column(), eg - column("score"), or column("xform.projection") for an (N,12) array of transform matrices. Normally
+obtained from load_lst_params(fsp,lazy=True)."""
+
+	def __init__(self,fsp,imgns=None):
+		npz=np.load(fsp+".npz")
+		self.path=fsp
+		self.srcfiles=npz["src_files"]
+		self.lststat=tuple(npz["lststat"])
+		self.layout=json.loads(str(npz["layout"]))
+		if imgns is None or len(imgns)==0 : self.sel=slice(None)
+		else:
+			self.sel=np.asarray(imgns,dtype=np.int64)
+			if self.sel.max()>=self.lststat[3] : raise Exception("Attempt to read record {} from #LSX {} with {} records".format(self.sel.max(),fsp,self.lststat[3]))
+
+		self.src=npz["src"][self.sel]
+		self.idx=npz["idx"][self.sel]
+		self.cols={}
+		for i,(k,kind,masked) in enumerate(self.layout):
+			self.cols[k]=(kind,npz["c{}".format(i)][self.sel],npz["m{}".format(i)][self.sel] if masked else None)
+		self.n=len(self.idx)
+
+	def __len__(self): return self.n
+
+	def __getitem__(self,i):
+		if isinstance(i,slice) : return [self[j] for j in range(*i.indices(self.n))]
+		ret={"idx":int(self.idx[i]),"src":str(self.srcfiles[self.src[i]])}
+		for k,(kind,col,mask) in self.cols.items():
+			if mask is not None and not mask[i] : continue
+			if kind=="xf":
+				ret[k]=Transform()
+				ret[k].set_matrix(col[i].tolist())
+			elif kind=="str": ret[k]=str(col[i])
+			else: ret[k]=col[i].item()
+		return ret
+
+	def __iter__(self):
+		for i in range(self.n): yield self[i]
+
+	def keys(self):
+		"""Returns the list of metadata keys present in at least one record"""
+		return ["idx","src"]+list(self.cols.keys())
+
+	def column(self,key):
+		"""Returns the values for one key as a NumPy array. Transforms are returned as an (N,12) array of matrices.
+Records missing the key contain 0/""/False, see mask()"""
+		if key=="idx" : return self.idx
+		if key=="src" : return self.srcfiles[self.src]
+		return self.cols[key][1]
+
+	def mask(self,key):
+		"""Returns a boolean array indicating which records contain key"""
+		if key in ("idx","src") or self.cols[key][2] is None : return np.ones(self.n,dtype=bool)
+		return self.cols[key][2]
+
+def load_lst_sidecar(fsp,imgns=None):
+	"""Returns an LSXParams view of the columnar sidecar for the LSX file fsp, or None if there is no sidecar or the
+LSX file has been modified since the sidecar was written"""
+	try:
+		st=os.stat(fsp)
+		ret=LSXParams(fsp,imgns)
+	except (OSError,KeyError,ValueError): return None
+	if ret.lststat!=(st.st_ino,st.st_mtime_ns,st.st_size,ret.lststat[3]) : return None
+	return ret
+
+def load_lst_params(fsp , imgns=None, lazy=False):
 	"""Reads the metadata for all of the images in an LSX file (fsp) with an optional list of
-	image numbers (imgns, iterable or None)"""
+	image numbers (imgns, iterable or None). If an up to date columnar sidecar exists (see
+	save_lst_params), it is used instead of parsing the text file. If lazy is set and the
+	sidecar is available, an LSXParams view is returned instead of a list, and dictionaries
+	are only constructed as records are accessed."""
+	ret=load_lst_sidecar(fsp,imgns)
+	if ret!=None:
+		if lazy : return ret
+		return list(ret)
+
 	lsx=LSXFile(fsp,True)
 	if imgns==None or len(imgns)==0: imgns=range(lsx.n)
 	
@@ -2544,6 +2884,59 @@ def load_lst_params(fsp , imgns=None):
 		ret.append({"idx":n,"src":p,**d})
 		
 	return ret
+
+HDRCAT_CHUNK=10000
+def load_header_catalog(fsp,keys,imgns=None,cache=True):
+	"""Returns the values of the header keys listed in keys for every image in fsp, or only the images in imgns, as a
+	dictionary of lists with one value per image (None where an image lacks the key). Headers are read in bulk with
+	read_images(...,hdronly). Unless cache is False, the values for a regular image file are saved in a catalog,
+	fsp+".hdrcat", so later calls asking for the same keys do not touch the image file at all. The catalog is rebuilt
+	whenever the image file is modified or new keys are requested. .lst files are not cached, since their headers
+	depend on the files they point to."""
+	want=keys=list(keys)
+	cfsp=fsp+".hdrcat"
+	try:
+		st=os.stat(fsp)
+		stat=(st.st_mtime_ns,st.st_size)
+	except OSError: stat=None
+
+	if fsp.endswith(".lst") or stat==None: cache=False
+
+	cat=None
+	if cache and os.path.isfile(cfsp):
+		try:
+			with open(cfsp,"rb") as f: cat=pickle.load(f)
+			if cat["stat"]!=stat : cat=None
+		except: cat=None
+
+	if cat!=None and all(k in cat["data"] for k in keys):
+		data=cat["data"]
+		if imgns is None : return {k:data[k] for k in keys}
+		return {k:[data[k][i] for i in imgns] for k in keys}
+
+	if cache:
+		# the catalog always covers the whole file, keeping the keys which were already there
+		if cat!=None: keys=keys+[k for k in cat["data"] if k not in keys]
+		imgs=list(range(EMUtil.get_image_count(fsp)))
+	elif imgns is None : imgs=list(range(EMUtil.get_image_count(fsp)))
+	else : imgs=list(imgns)
+
+	data={k:[None]*len(imgs) for k in keys}
+	for i0 in range(0,len(imgs),HDRCAT_CHUNK):
+		hdrs=EMData.read_images(fsp,imgs[i0:i0+HDRCAT_CHUNK],IMAGE_UNKNOWN,True)
+		for i,h in enumerate(hdrs,i0):
+			for k in keys:
+				if h.has_attr(k): data[k][i]=h[k]
+
+	if cache:
+		try:
+			tmp="{}.{}.tmp".format(cfsp,os.getpid())
+			with open(tmp,"wb") as f: pickle.dump({"stat":stat,"data":data},f,pickle.HIGHEST_PROTOCOL)
+			os.replace(tmp,cfsp)
+		except OSError: pass		# read-only location, just skip the catalog
+		if imgns is not None: return {k:[data[k][i] for i in imgns] for k in want}
+
+	return {k:data[k] for k in want}
 	
 ##########
 #### replace a few EMData methods with python versions to intercept 'bdb:' filenames
@@ -2627,7 +3020,6 @@ EMData.__init__ = db_emd_init
 
 # Transform.__str__ = transform_to_str
 
-#lsxcache=None
 def db_read_image(self, fsp, *parms, **kparms):
 	"""read_image(filespec,image #,[header only],[region],[is_3d],[imgtype])
 
@@ -2664,10 +3056,7 @@ def db_read_image(self, fsp, *parms, **kparms):
 		#			raise Exception("Could not access "+str(fsp)+" "+str(key))
 		return None
 	if fsp[-4:].lower()==".lst":
-		return LSXFile(fsp).read_into_image(self,*parms)
-		#global lsxcache
-		#if lsxcache==None or lsxcache.path!=fsp: lsxcache=LSXFile(fsp,True)
-		#return lsxcache.read_image(parms[0])
+		return lsx_cached(fsp).read_into_image(self,*parms)
 
 	if len(kparms) != 0:
 		if 'img_index' not in kparms:
@@ -2714,10 +3103,7 @@ def db_read_images(fsp, *parms):
 			if not keys or len(keys) == 0: keys = list(range(len(db)))
 		return [db.get(i, nodata=nodata) for i in keys]
 	if fsp[-4:].lower()==".lst":
-		return LSXFile(fsp).read_images(*parms)
-		#global lsxcache
-		#if lsxcache==None or lsxcache.path!=fsp: lsxcache=LSXFile(fsp,True)
-		#return lsxcache.read_images(*parms)
+		return lsx_cached(fsp).read_images(*parms)
 
 	if len(parms) > 0 and (parms[0] == None or len(parms[0]) == 0):
 		parms = (list(range(EMUtil.get_image_count(fsp))),) + parms[1:]
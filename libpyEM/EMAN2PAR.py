@@ -39,10 +39,12 @@ from builtins import range
 from builtins import object
 
 import sys, os, getpass, socket, subprocess, threading, time,select,shutil, traceback, random,_thread, queue
+import multiprocessing, itertools, copy, atexit, hashlib
 from pickle import dumps,loads,dump,load
+import numpy as np
 
 from EMAN2jsondb import JSTask,JSTaskQueue,js_open_dict
-from EMAN2 import test_image,EMData,abs_path,local_datetime,EMUtil,Util,get_platform, e2getinstalldir
+from EMAN2 import test_image,EMData,abs_path,local_datetime,EMUtil,Util,get_platform, e2getinstalldir, to_numpy
 
 # If we can't import it then we probably won't be trying to use MPI
 try :
@@ -70,6 +72,10 @@ EMAN2PARVER=14
 # This is the maximum number of active server threads before telling clients to wait
 DCMAXTHREADS=7
 
+# EMData objects and numpy arrays in task data or results at least this large (bytes) are passed to local workers
+# as raw files in a shared memory directory, rather than being pickled
+PAYLOADMIN=16*1024*1024
+
 
 
 class EMTaskCustomer(object):
@@ -79,6 +85,7 @@ class EMTaskCustomer(object):
 		"""Specify the type and target host of the parallelism server to use.
 	dc[:hostname[:port]] - default hostname localhost, default port 9990
 	thread:nthreads[:scratch_dir]
+	pool:nthreads[:scratch_dir]
 	mpi:ncpu[:scratch_dir_on_nodes]
 	"""
 		origtarget=target
@@ -92,6 +99,12 @@ class EMTaskCustomer(object):
 			try: self.scratchdir=target.split(":")[2]
 			except: self.scratchdir="/tmp"
 			self.handler=EMLocalTaskHandler(self.maxthreads,self.scratchdir, module)
+		elif self.servtype=="pool":
+			self.groupn=0
+			self.maxthreads=int(target.split(":")[1])
+			try: self.scratchdir=target.split(":")[2]
+			except: self.scratchdir="/tmp"
+			self.handler=EMPoolTaskHandler(self.maxthreads, module, self.scratchdir)
 		elif self.servtype=="thread_sm":
 			self.maxthreads=int(target.split(":")[1])
 			self.handler=EMSharedMemoryLocalTaskHandler(self.maxthreads)
@@ -105,7 +118,7 @@ class EMTaskCustomer(object):
 			try: self.usethreads=int(tsplit[3])+1
 			except: self.usethreads=self.maxthreads
 			self.handler=EMMpiTaskHandler(self.maxthreads,self.scratchdir, module, self.usethreads)
-		else : raise Exception("Only 'thread' and 'mpi' servertypes currently supported")
+		else : raise Exception("Only 'thread', 'pool' and 'mpi' servertypes currently supported")
 
 	def __del__(self):
 		#if self.servtype=="thread" :
@@ -189,6 +202,33 @@ class EMTaskCustomer(object):
 
 		#raise Exception("Unknown server type")
 
+	def wait_task(self,taskid_list,timeout=5,waitall=True):
+		"""Waits until all of the tasks in the list are complete (or any of them, if waitall is False), or at most
+		timeout seconds, then returns the same status list as check_task. Handlers which can signal completion
+		return as soon as the tasks finish, others simply sleep for timeout seconds before checking."""
+		if hasattr(self.handler,"wait_task") : return self.handler.wait_task(taskid_list,timeout,waitall)
+		time.sleep(timeout)
+		return self.handler.check_task(taskid_list)
+
+	def reduce_results(self,taskid_list,reduce,progress=None,timeout=5):
+		"""Retrieves the results of a list of tasks as each one completes and passes them to reduce(results),
+		which should fold them into an accumulator (eg - a sum of partial reconstructions). Only one result is
+		held at a time, and reduction overlaps with execution of the remaining tasks. progress, if provided,
+		is called with the fraction of the work completed. Returns False if a task failed, otherwise True."""
+		pending=list(taskid_list)
+		while len(pending)>0:
+			st_vals=self.check_task(pending)
+			if -100 in st_vals : return False
+
+			done=[t for t,s in zip(pending,st_vals) if s==100]
+			pending=[t for t,s in zip(pending,st_vals) if s!=100]
+			for t in done: reduce(self.get_results(t)[1])
+
+			if progress!=None : progress((100.0*(len(taskid_list)-len(pending))+sum(max(s,0) for s in st_vals if s!=100))/(100.0*len(taskid_list)))
+			if len(pending)>0 and len(done)==0 : self.wait_task(pending,timeout,False)
+
+		return True
+
 	def get_results(self,taskid,retry=True):
 		"""Get the results for a completed task. Returns a tuple (task object,dictionary}."""
 
@@ -661,6 +701,127 @@ class EMMpiClient(object):
 
 
 
+#######################
+# Large payload transport for local parallelism
+
+payloadcount=itertools.count()
+
+def payload_dir(scratchdir):
+	"""Creates and returns a new directory for large task payloads. This is in /dev/shm if available, so the
+	files never touch the disk, otherwise in scratchdir"""
+	if os.path.isdir("/dev/shm") and os.access("/dev/shm",os.W_OK) : scratchdir="/dev/shm"
+	ret="%s/e2payload.%d"%(scratchdir,random.randint(1,2000000000))
+	os.makedirs(ret)
+	return ret
+
+class SharedPayload(object):
+	"""Stands in for a large EMData or numpy array in a pickled task or result. The data is written once as a
+	raw file in a (normally memory backed) payload directory, and only the file name, shape and header are pickled.
+	get() memory maps the file, so numpy arrays are restored without copying, and EMData objects with a single
+	copy into the new image. key is set when the payload is held in a share_payloads cache."""
+	def __init__(self,obj,path):
+		self.key=None
+		if isinstance(obj,EMData):
+			self.hdr=obj.get_attr_dict()
+			self.size=(obj["nx"],obj["ny"],obj["nz"])
+			arr=to_numpy(obj)
+		else:
+			self.hdr=None
+			arr=obj
+		self.shape=arr.shape
+		self.dtype=arr.dtype.str
+		self.path="%s/%d_%d.raw"%(path,os.getpid(),next(payloadcount))
+		# a plain write, rather than through a memmap, so a full tmpfs raises OSError (ENOSPC) instead of SIGBUS
+		try:
+			with open(self.path,"wb") as out: np.ascontiguousarray(arr).tofile(out)
+		except:
+			try: os.unlink(self.path)
+			except: pass
+			raise
+
+	def get(self):
+		"""Returns the EMData or numpy array. Arrays are copy-on-write memory maps of the payload file."""
+		arr=np.memmap(self.path,dtype=self.dtype,mode="c",shape=self.shape)
+		if self.hdr==None : return arr
+
+		ret=EMData(*self.size)
+		to_numpy(ret)[...]=arr
+		ret.set_attr_dict(self.hdr)
+		ret.update()
+		return ret
+
+def payload_key(obj):
+	"""Key identifying a shared object in a share_payloads cache. This includes a checksum of the data (and
+	header for EMData), so an object modified in place and sent again is written again, not reused stale."""
+	if isinstance(obj,EMData):
+		arr=to_numpy(obj)
+		hdr=str(sorted(obj.get_attr_dict().items()))
+	else:
+		arr=np.ascontiguousarray(obj)
+		hdr=""
+	return (id(obj),arr.shape,arr.dtype.str,hashlib.md5(arr.reshape(-1).view(np.uint8)).hexdigest(),hdr)
+
+def share_payloads(obj,path,cache=None):
+	"""Returns obj (possibly a nested dict/list/tuple) with every EMData or numpy array of at least PAYLOADMIN
+	bytes replaced by a SharedPayload written to the directory 'path'. Objects which don't fit in 'path' are left
+	in place. If a cache dictionary is provided, an object which has already been shared (such as a reference
+	volume sent with every task) is written only once, and the cache counts the references so release_payloads
+	can delete the file when the last one is released. Containers are copied rather than modified."""
+	if type(obj)==dict : return {k:share_payloads(v,path,cache) for k,v in obj.items()}
+	if type(obj) in (list,tuple) : return type(obj)([share_payloads(v,path,cache) for v in obj])
+	if isinstance(obj,EMData) : nbytes=obj["nx"]*obj["ny"]*obj["nz"]*4
+	elif isinstance(obj,np.ndarray) : nbytes=obj.nbytes
+	else: return obj
+	if nbytes<PAYLOADMIN : return obj
+
+	# /dev/shm is often small (64 MB in many containers). Objects which don't fit are pickled with the task as usual
+	if shutil.disk_usage(path).free<nbytes+PAYLOADMIN : return obj
+	if cache==None :
+		try: return SharedPayload(obj,path)
+		except OSError: return obj
+	key=payload_key(obj)
+	if key not in cache :
+		try: cache[key]=[SharedPayload(obj,path),0]
+		except OSError: return obj
+		cache[key][0].key=key
+	cache[key][1]+=1
+	return cache[key][0]
+
+def release_payloads(obj,cache):
+	"""Drops one reference to each cached SharedPayload in obj (as returned by share_payloads), and deletes
+	the payload file once no unretrieved task refers to it"""
+	if type(obj)==dict : obj=list(obj.values())
+	if type(obj) in (list,tuple) :
+		for v in obj: release_payloads(v,cache)
+		return
+	if not isinstance(obj,SharedPayload) or obj.key not in cache : return
+
+	cache[obj.key][1]-=1
+	if cache[obj.key][1]<=0 :
+		del cache[obj.key]
+		try: os.unlink(obj.path)
+		except: pass		# Windows won't remove mapped files, they are cleaned up with the payload directory
+
+def restore_payloads(obj,remove=False):
+	"""Inverse of share_payloads. If remove is set, the payload files are deleted once mapped (results are only
+	restored once, shared task inputs may be needed by several workers)"""
+	if type(obj)==dict : return {k:restore_payloads(v,remove) for k,v in obj.items()}
+	if type(obj) in (list,tuple) : return type(obj)([restore_payloads(v,remove) for v in obj])
+	if not isinstance(obj,SharedPayload) : return obj
+
+	ret=obj.get()
+	if remove:
+		try: os.unlink(obj.path)
+		except: pass		# Windows won't remove mapped files, they are cleaned up with the payload directory
+	return ret
+
+def share_task(task,path,cache=None):
+	"""Returns a shallow copy of task with large objects in task.data replaced by SharedPayloads. With a cache,
+	release_payloads(shared.data,cache) must be called once the task has been retrieved."""
+	task=copy.copy(task)
+	task.data=share_payloads(task.data,path,cache)
+	return task
+
 #######################
 # Here we define the classes for local threaded parallelism
 class EMSharedMemoryLocalTaskHandler(object):
@@ -774,6 +935,8 @@ class EMLocalTaskHandler(object):
 
 
 		os.makedirs(self.scratchdir)
+		self.payloaddir=payload_dir(self.scratchdir)
+		self.shared={}			# large objects written to payloaddir, released as their tasks are retrieved
 		self.thr=threading.Thread(target=self.run)
 		self.thr.start()
 
@@ -782,10 +945,13 @@ class EMLocalTaskHandler(object):
 		self.doexit=1
 		self.thr.join()
 		shutil.rmtree(self.scratchdir,True)
+		shutil.rmtree(self.payloaddir,True)
+		self.shared={}
 
 	def add_task(self,task):
 		EMLocalTaskHandler.lock.acquire()
 		if not isinstance(task,JSTask) : raise Exception("Non-task object passed to EMLocalTaskHandler for execution")
+		task=share_task(task,self.payloaddir,self.shared)
 		dump(task,open("%s/%07d"%(self.scratchdir,self.maxid),"wb"),-1)
 		ret=self.maxid
 		self.maxid+=1
@@ -808,7 +974,10 @@ class EMLocalTaskHandler(object):
 		if taskid not in self.completed : raise Exception("Task %d not complete !!!"%taskid)
 
 		task=load(open("%s/%07d"%(self.scratchdir,taskid),"rb"))
-		results=load(open("%s/%07d.out"%(self.scratchdir,taskid),"rb"))
+		shared=task.data
+		task.data=restore_payloads(shared)
+		with EMLocalTaskHandler.lock: release_payloads(shared,self.shared)
+		results=restore_payloads(load(open("%s/%07d.out"%(self.scratchdir,taskid),"rb")),True)
 
 		os.unlink("%s/%07d.out"%(self.scratchdir,taskid))
 		os.unlink("%s/%07d"%(self.scratchdir,taskid))
@@ -852,7 +1021,7 @@ class EMLocalTaskHandler(object):
 				EMLocalTaskHandler.lock.acquire()
 
 				fname=os.path.join(self.scratchdir,"{:07d}".format(self.nextid))
-				cmd="e2parallel.py --mode=thread --taskin={} --taskout={}.out".format(fname, fname)
+				cmd="e2parallel.py --mode=thread --taskin={} --taskout={}.out --payloaddir={}".format(fname, fname, self.payloaddir)
 				if self.module!="":
 					cmd+=" --loadmodule={}".format(self.module)
 					
@@ -869,6 +1038,167 @@ class EMLocalTaskHandler(object):
 
 
 
+def load_task_module(module):
+	"""Imports the class containing a JSTask subclass, specified as "file.Class", and makes it available in
+	__main__ so pickled tasks created by the customer program can be restored"""
+	fname, cls=module.split('.')
+	sys.path.append(os.path.join(e2getinstalldir(),"bin"))
+	mod=__import__(fname, fromlist=[cls])
+	setattr(sys.modules["__main__"], cls, getattr(mod,cls))
+
+def pool_worker(module,payloaddir,taskq,resultq,current,wid):
+	"""Main loop for EMPoolTaskHandler worker processes. Executes (taskid,task) tuples from taskq until
+	it receives None, and sends ("PROG",taskid,progress), ("DONE",taskid,results) or ("EROR",taskid,traceback)
+	messages back through resultq. Large payloads are exchanged through files in payloaddir. current[wid]
+	holds the id of the task this worker is running (-1 if idle), so the customer can fail it if we die."""
+	if module!="" : load_task_module(module)
+
+	while 1:
+		job=taskq.get()
+		if job==None : break
+		taskid,task=job
+		current[wid]=taskid
+		task.data=restore_payloads(task.data)
+
+		lastprog=[0]
+		def progress(prog):
+			if time.time()-lastprog[0]>1.0 :
+				resultq.put(("PROG",taskid,prog))
+				lastprog[0]=time.time()
+			return True
+
+		try: ret=share_payloads(task.execute(progress),payloaddir)
+		except:
+			resultq.put(("EROR",taskid,traceback.format_exc()))
+			continue
+		resultq.put(("DONE",taskid,ret))
+		current[wid]=-1
+
+class EMPoolTaskHandler(object):
+	"""Local multiprocess Taskserver. Unlike EMLocalTaskHandler, which launches a new e2parallel.py process
+	for each task, this keeps a fixed pool of worker processes which import the task module once, and
+	exchanges tasks and results with them via pipes rather than scratch files. A thread in the customer
+	collects results as workers finish them, so completion is signalled rather than polled. If a worker
+	process dies (eg - killed by the OOM killer), the task it was running is marked as failed (-100)."""
+	def __init__(self,nthreads=2,module="",scratchdir="/tmp"):
+		self.maxthreads=nthreads
+		self.maxid=0
+		self.payloaddir=payload_dir(scratchdir)
+		self.shared={}			# large objects written to payloaddir, released as their tasks are retrieved
+		self.sharedlock=threading.Lock()
+		self.payloads={}		# shared task.data of each task which has not been retrieved yet
+		self.status={}			# progress of each incomplete task, -1 queued, 0-99 running, 100 complete, -100 failed
+		self.tasks={}			# tasks which have not been retrieved yet
+		self.results={}			# results of completed tasks, removed by get_results
+		self.cond=threading.Condition()
+
+		self.taskq=multiprocessing.Queue()
+		self.resultq=multiprocessing.Queue()
+		self.current=multiprocessing.Array("l",[-1]*nthreads,lock=False)	# task each worker is running
+		self.workers=[multiprocessing.Process(target=pool_worker,args=(module,self.payloaddir,self.taskq,self.resultq,self.current,i),daemon=True) for i in range(nthreads)]
+		for w in self.workers: w.start()
+		self.dead=set()			# workers which have died unexpectedly
+		self.stopping=False
+
+		self.thr=threading.Thread(target=self.run,daemon=True)
+		self.thr.start()
+		atexit.register(self.stop)		# __del__ may run too late in interpreter shutdown to stop the workers
+
+	def stop(self):
+		"""Called externally (by the Customer) to nicely shut down the task handler"""
+		if self.workers==None : return
+		self.stopping=True
+		for w in self.workers: self.taskq.put(None)
+		for w in self.workers: w.join()
+		self.resultq.put(None)
+		self.thr.join()
+		self.workers=None
+		shutil.rmtree(self.payloaddir,True)
+		self.shared={}
+
+	def add_task(self,task):
+		if not isinstance(task,JSTask) : raise Exception("Non-task object passed to EMPoolTaskHandler for execution")
+		with self.cond:
+			ret=self.maxid
+			task.taskid=ret
+			self.maxid+=1
+			self.tasks[ret]=task
+			self.status[ret]=-1
+		with self.sharedlock:
+			shared=share_task(task,self.payloaddir,self.shared)
+		self.payloads[ret]=shared.data
+		self.taskq.put((ret,shared))
+		return ret
+
+	def check_task(self,id_list):
+		"""Checks a list of tasks for completion. Returns -1 for queued tasks, the last reported progress for
+		running tasks, 100 for completed tasks and -100 for tasks lost with a dead worker"""
+		with self.cond:
+			return [self.status.get(i,100) for i in id_list]
+
+	def wait_task(self,id_list,timeout=None,waitall=True):
+		"""Blocks until all of the tasks in id_list (or any of them if waitall is False) are complete or have
+		failed, or timeout seconds have passed, then returns the same list as check_task"""
+		test=all if waitall else any
+		with self.cond:
+			self.cond.wait_for(lambda :test(self.status.get(i,100) in (100,-100) for i in id_list),timeout)
+			return [self.status.get(i,100) for i in id_list]
+
+	def get_results(self,taskid):
+		"""This returns a (task,dictionary) tuple for a task, and forgets about the task"""
+		with self.cond:
+			if self.status.get(taskid)!=100 : raise Exception("Task %d not complete !!!"%taskid)
+			del self.status[taskid]
+			task=self.tasks.pop(taskid)
+			results=self.results.pop(taskid)
+		with self.sharedlock:
+			release_payloads(self.payloads.pop(taskid),self.shared)
+		return (task,restore_payloads(results,True))
+
+	def check_workers(self):
+		"""Marks the task of any worker which has died as failed. If no workers are left, every incomplete
+		task fails, since nothing will ever run them."""
+		if self.stopping : return
+		with self.cond:
+			for wid,w in enumerate(self.workers):
+				if wid in self.dead or w.is_alive() : continue
+				self.dead.add(wid)
+				taskid=self.current[wid]
+				print("Error: pool worker {} died (exit code {}) running task {}".format(wid,w.exitcode,taskid))
+				if taskid in self.status and self.status[taskid]!=100 : self.status[taskid]=-100
+
+			if len(self.dead)==len(self.workers):
+				for taskid in self.status:
+					if self.status[taskid]!=100 : self.status[taskid]=-100
+
+			self.cond.notify_all()
+
+	def run(self):
+		lastcheck=time.time()
+		while 1:
+			if time.time()-lastcheck>2.0 :
+				self.check_workers()
+				lastcheck=time.time()
+			try: msg=self.resultq.get(True,2)
+			except queue.Empty: continue
+			if msg==None : break
+			com,taskid,data=msg
+
+			if com=="EROR":
+				print("Error running task : ",taskid)
+				print(data)
+				_thread.interrupt_main()
+				sys.stderr.flush()
+				sys.stdout.flush()
+				os._exit(1)
+
+			with self.cond:
+				if com=="DONE":
+					self.results[taskid]=data
+					self.status[taskid]=100
+				elif self.status.get(taskid)!=-100 : self.status[taskid]=max(int(data),0)
+				self.cond.notify_all()
+
 #######################
 
 
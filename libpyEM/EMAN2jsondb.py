@@ -57,23 +57,39 @@ from libpyUtils2 import EMUtil
 # larger numbers will increase the amount of output
 DBDEBUG=0
 
+# A journaled JSDict is compacted into its main JSON file once the journal is larger than both this size (bytes)
+# and the main file, so the cost of compaction is amortized over many single-key writes
+JOURNALCOMPACT=1048576
+
 def js_one_key(url,key):
 	"""Opens a JSON file and returns a single key before closing the file. Not really faster, but conserves memory by not leaving the file open"""
 
 	return JSDict.one_key(url,key)
 
-def js_open_dict(url):
+def js_open_dict(url,journal=False):
 	"""Opens a JSON file as a dict-like database object. The interface is almost identical to the BDB db_* functions.
 If opened. Writes to JDB dictionaries may be somewhat inefficient due to the lack of a good model (as BDB has) for
 multithreaded access. Default behavior is to write the entire dictionary to disk when any element is changed. File
 locking is attempted to avoid conflicts, but may not work in all situations. read-only access is a meaningless concept
 because file pointers are not held open beyond discrete transitions. While it is possible to store images in JSON files
-it is not recommended due to inefficiency, and making files which are difficult to read."""
+it is not recommended due to inefficiency, and making files which are difficult to read.
+
+If journal is set, or the file already has a journal, changes are instead appended to a journal file next to the
+JSON file, so single-key writes don't rewrite the whole dictionary. See JSDict.compact() and js_compact_dict()."""
+
+	if url[-5:]!=".json" :
+		raise Exception("JSON databases must have .json extension")
+
+	return JSDict.open_db(url,journal)
+
+def js_compact_dict(url,plain=True):
+	"""Merges the journal of a journaled JSON database back into the JSON file. If plain is set, the journal is
+removed, converting the database back to a plain JSON file (until it is next opened with journal=True)."""
 
 	if url[-5:]!=".json" :
 		raise Exception("JSON databases must have .json extension")
 
-	return JSDict.open_db(url)
+	JSDict.open_db(url).compact(plain)
 
 def js_close_dict(url):
 	"""This will free some resources associated with the database. Not associated with closing a file pointer at present."""
@@ -95,6 +111,8 @@ def js_remove_dict(url):
 	js_close_dict(url)
 	try : os.unlink(url)
 	except OSError: pass
+	try : os.unlink(url[:-5]+"_journal.jsonl")
+	except OSError: pass
 
 	return
 
@@ -559,8 +577,9 @@ JSDicts are open at one time."""
 	lock=threading.Lock()		# to make this section threadsafe
 
 	@classmethod
-	def open_db(cls,path=None):
-		"""This should be used to create a JSDict instance. It caches already open dictionaries to avoid redundancy and conflicts."""
+	def open_db(cls,path=None,journal=False):
+		"""This should be used to create a JSDict instance. It caches already open dictionaries to avoid redundancy and conflicts.
+		If journal is set, the dictionary will use journaled storage (see __init__)."""
 
 		cls.lock.acquire()
 
@@ -578,9 +597,11 @@ JSDicts are open at one time."""
 
 		if normpath in cls.opendicts :
 			cls.lock.release()
-			return cls.opendicts[normpath]
+			ret=cls.opendicts[normpath]
+			if journal : ret.journal=True
+			return ret
 
-		try : ret=JSDict(path)
+		try : ret=JSDict(path,journal)
 		except MyLockException as e:
 			cls.lock.release()
 			print(e)
@@ -632,7 +653,7 @@ JSDicts are open at one time."""
 
 		return ret
 
-	def __init__(self,path=None):
+	def __init__(self,path=None,journal=False):
 		"""This is a dict-like representation of a JSON file on disk. Warning, the entire file contents are parsed and held
 in memory for efficient access. File change monitoring and file locking is used to insure self-consistency across processes.
 Due to JSON module, there may be some data types which aren't permitted as values. While this module may be used like a traditional
@@ -640,7 +661,11 @@ dictionary for the most part, for efficiency, you may consider using the setval(
 synchronization with the disk file.
 
 There is no name/path separation as existed with BDB objects. 'path' is a full path to the .json file. A normalized version
-of the path is stored as self.normpath"""
+of the path is stored as self.normpath
+
+If 'journal' is set, or a journal file (<name>_journal.jsonl) already exists, changes are appended to the journal as one
+line per key rather than rewriting the JSON file, and other processes only need to read the lines added since their last
+access. The journal is merged back into the JSON file when it grows larger than the JSON file (and JOURNALCOMPACT)."""
 
 		from EMAN2 import e2getcwd
 
@@ -653,6 +678,11 @@ of the path is stored as self.normpath"""
 		self.changes={}					# a set of changes to merge when next committing to disk
 		self.delkeys=set()				# a set of keys to delete on next update
 		self.lasttime=0					# last time the database was accessed
+		self.journalpath=self.normpath[:-5]+"_journal.jsonl"
+		self.journal=journal or os.path.exists(self.journalpath)	# if set, changes are appended to journalpath
+		self.journaloff=0				# number of bytes of the journal already merged into self.data
+		self.journalino=None			# inode of the journal when last locked, to detect its removal by another process
+		self.basestat=None				# (inode,mtime,size) of the main file when last read, journaled storage only
 
 		self.busy=False					# used for some degree of threadsafety to supplement file locking
 		self.sync()
@@ -669,6 +699,7 @@ of the path is stored as self.normpath"""
 		be automatically reopened."""
 		if len(self.changes)>0 or len(self.delkeys): self.sync()
 		self.lasttime=0
+		self.journaloff=0
 		self.data={}
 #		del JSDict.opendicts[self.normpath]
 
@@ -677,6 +708,18 @@ of the path is stored as self.normpath"""
 		while self.busy: time.sleep(.1)		# this is for some degree of threadsafety beyond file locking
 		self.busy=True
 
+		# a journal created by another process switches us to journaled storage as well
+		if self.journal or os.path.exists(self.journalpath) :
+			self.journal=True
+			try: done=self.sync_journal()
+			except:
+				self.busy=False
+				raise
+			if done :
+				self.busy=False
+				return
+			# otherwise another process converted the database back to plain JSON, so we continue below
+
 		# We check for the _tmp file first
 		try:
 			mt2=os.stat(self.normpath[:-5]+"_tmp.json").st_mtime
@@ -762,6 +805,118 @@ of the path is stored as self.normpath"""
 		self.lasttime=os.stat(self.normpath).st_mtime	# make sure we include our recent change, if made
 		self.busy=False
 
+	def sync_journal(self,compact=False,plain=False):
+		"""sync() for journaled storage. Reads the main JSON file only if it has been replaced since we last read it,
+		then merges any new journal records, and appends our own changes. The journal lock is held throughout, so a
+		compaction by another process can't occur in the middle. If compact is set, or the journal has grown too large,
+		the journal is merged into the main file, and if plain is also set, the journal is removed. Returns False,
+		doing nothing, if the journal has been removed by another process since we last used it, in which case the
+		database is plain JSON again."""
+
+		writing=compact or len(self.changes)>0 or len(self.delkeys)>0
+		while True:
+			if self.journalino!=None and not os.path.exists(self.journalpath) :
+				self.journal=False
+				self.journalino=None
+				self.lasttime=0			# force the main file to be reread
+				return False
+			jfile=open(self.journalpath,"ab+")
+			file_lock(jfile,readonly=not writing)
+			# a plain compaction may have unlinked the journal while we waited for the lock. Anything appended to
+			# that inode would be lost, so we check that the path still refers to the file we locked
+			ino=os.fstat(jfile.fileno()).st_ino
+			try: same=os.stat(self.journalpath).st_ino==ino
+			except OSError: same=False
+			if same : break
+			file_unlock(jfile)
+			jfile=None
+		self.journalino=ino
+
+		try:
+			try: st=os.stat(self.normpath)
+			except OSError:
+				try: os.makedirs(os.path.dirname(self.normpath))
+				except: pass
+				out=open(self.normpath,"w")
+				out.write("{}")
+				out=None
+				st=os.stat(self.normpath)
+
+			# compaction always replaces the main file, so a changed main file means the journal has been restarted
+			basestat=(st.st_ino,st.st_mtime_ns,st.st_size)
+			if self.lasttime==0 or basestat!=self.basestat :
+				jsfile=open(self.normpath,"r")
+				try: self.data=json.load(jsfile,object_hook=json_to_obj)
+				except:
+					jsfile.seek(0)
+					if len(jsfile.read().strip())!=0 : raise Exception("Error reading JSON file : {}".format(self.path))
+					self.data={}
+				jsfile=None
+				self.filesize=st.st_size
+				self.basestat=basestat
+				self.journaloff=0
+
+			self.read_journal(jfile)
+
+			if len(self.changes)>0 or len(self.delkeys)>0:
+				jfile.seek(0,os.SEEK_END)
+				for k,v in self.changes.items():
+					jfile.write(json.dumps([k,v],separators=(',',':'),default=obj_to_json).encode("utf-8")+b"\n")
+					self.data[k]=v
+				for k in self.delkeys:
+					jfile.write(json.dumps([k]).encode("utf-8")+b"\n")
+					self.data.pop(k,None)
+				self.changes={}
+				self.delkeys=set()
+				jfile.flush()
+				self.journaloff=jfile.tell()
+
+			if compact or (writing and self.journaloff>max(JOURNALCOMPACT,self.filesize)) :
+				jss=json.dumps(self.data,indent=0,sort_keys=True,default=obj_to_json)
+				jss=re.sub(listrex,denl,jss)
+				tmpname=self.normpath[:-5]+"_compact.tmp"
+				out=open(tmpname,"w")
+				out.write(jss)
+				out=None
+				os.replace(tmpname,self.normpath)
+				st=os.stat(self.normpath)
+				self.filesize=st.st_size
+				self.basestat=(st.st_ino,st.st_mtime_ns,st.st_size)
+				self.journaloff=0
+				if plain :
+					# safe while we hold the lock, since other processes check the journal inode after locking
+					os.unlink(self.journalpath)
+					self.journal=False
+					self.journalino=None
+				else: jfile.truncate(0)
+		finally:
+			file_unlock(jfile)
+			jfile=None
+
+		self.lasttime=st.st_mtime
+		return True
+
+	def read_journal(self,jfile):
+		"""Merges any complete records appended to the (locked, shared is sufficient) journal since it was last read into self.data"""
+		jfile.seek(self.journaloff)
+		buf=jfile.read()
+		end=buf.rfind(b"\n")+1			# a partially written record at the end is left for next time
+		for ln in buf[:end].splitlines():
+			rec=json.loads(ln.decode("utf-8"),object_hook=json_to_obj)
+			if len(rec)==1 : self.data.pop(rec[0],None)
+			else: self.data[rec[0]]=rec[1]
+		self.journaloff+=end
+
+	def compact(self,plain=False):
+		"""Merges the journal into the main JSON file. If plain is set, the journal is also removed, so the database is
+		a normal JSON file again. Has no effect on a database which isn't journaled."""
+		self.sync()
+		if not self.journal : return
+		while self.busy: time.sleep(.1)
+		self.busy=True
+		try: self.sync_journal(True,plain)
+		finally: self.busy=False
+
 	def __len__(self):
 		"""Ignores any pending updates for speed"""
 		return len(self.data)
@@ -35,6 +35,7 @@ import os
 import os.path
 import re
 import traceback
+import numpy as np
 
 #from libpyEMData2 import EMData
 #from libpyUtils2 import EMUtil
@@ -60,7 +61,11 @@ import traceback
 #
 # loop values are represented as a python list. keys from the same loop should have an identical number
 # of elements. loops are identified internally as a list of lists (self.loop) independent of the
-# actual data storage.
+# actual data storage. If the StarFile is opened with usenumpy=True, loop values are instead typed
+# NumPy arrays (int64, float64 or str), which is much more efficient for large particle files.
+#
+# Loops without quoted or multi-line values (the normal case for Relion files) are parsed a column
+# at a time rather than a value at a time.
 ######
 
 def goodval(vals): 
@@ -71,27 +76,60 @@ def goodval(vals):
 		except: pass
 	return val
 
+def goodcolumn(vals):
+	"""Converts a list of string values from one loop column into an int64, float64 or (if neither works) str array"""
+	arr=np.array(vals)
+	for dtype in (np.int64,np.float64):
+		try: return arr.astype(dtype)
+		except (ValueError,OverflowError): pass		# integers too large for int64 are read as float
+	return arr
+
+def starval(val):
+	"""Formats a single value for writing to a STAR file, quoting strings where necessary"""
+	if isinstance(val,str):
+		if "\n" in val : return "\n;{}\n;\n".format(val)
+		if len(val)>1 and val[0] in ("'",'"') and val[-1]==val[0] : return val		# already quoted when read
+		if len(val)==0 or len(val.split())>1 or val[0] in ("_","#","'",'"') : return '"{}"'.format(val)
+		return val
+	return str(val)
+
 class StarFile(dict):
 	
-	def __init__(self,filename,dataname=None):
+	def __init__(self,filename,dataname=None,usenumpy=False,create=False,lines=None):
 		"""dataname can be used to specify a specific data block to read from the file.
-If not set, it will read the first block encountered. Value should be of the form "data_general"."""
+If not set, it will read the first block encountered. Value should be of the form "data_general".
+If usenumpy is set, loop values are stored as NumPy arrays rather than lists. If create is set,
+filename need not exist, and an empty StarFile is created, to be filled in and written with writefile().
+lines is used internally to avoid rereading the file when reading multiple blocks."""
 		dict.__init__(self)
 		self.filename=filename
 		self.dataname=dataname
+		self.usenumpy=usenumpy
 		self.loops=[]
 		
-		if os.path.isfile(filename) :
-			self.readfile()
-		else :
+		if lines!=None or os.path.isfile(filename) :
+			self.readfile(lines)
+		elif not create :
 			raise Exception(f"Cannot open STAR file: {filename}")
+
+	@staticmethod
+	def datablocks(filename):
+		"""Returns a list of the names of all of the data blocks in a STAR file, eg - ["data_optics","data_particles"]"""
+		return [l.split()[0] for l in open(filename,"r") if l[:5].lower()=="data_"]
+
+	@staticmethod
+	def readall(filename,usenumpy=False):
+		"""Reads every data block in a STAR file, returning a dictionary of StarFile objects keyed by block name"""
+		lines=[i for i in open(filename,"r") if len(i.strip())!=0 and i[0]!="#"]
+		names=[l.split()[0] for l in lines if l[:5].lower()=="data_"]
+		return {n:StarFile(filename,n,usenumpy,lines=lines) for n in names}
 			
 	def _nextline(self):
 		"""Used internally when parsing a star file to emulate readline"""
 		self.lineptr+=1
 		return self.lines[self.lineptr-1]
 	
-	def readfile(self):
+	def readfile(self,lines=None):
 		"""This parses the STAR file, replacing any previous contents in the dictionary"""
 		
 		self.loops=[]
@@ -100,14 +138,15 @@ If not set, it will read the first block encountered. Value should be of the for
 		matcher=re.compile("""("[^"]+")|('[^']+')|([^\s]+)""")
 		
 		# read the entire file into a buffer, this dramatically simplifies the logic, even if it eats a chunk of RAM
-		self.lines=[i for i in open(self.filename,"r") if len(i.strip())!=0 and i[0]!="#"]
+		if lines!=None : self.lines=lines
+		else: self.lines=[i for i in open(self.filename,"r") if len(i.strip())!=0 and i[0]!="#"]
 		self.lineptr=0
 
 		# seek to the correct block of data
 		if self.dataname!=None:
 			lt=len(self.dataname)
 			for i,l in enumerate(self.lines):
-				if l[:lt]==self.dataname : break
+				if l[:lt]==self.dataname and (len(l)==lt or l[lt].isspace()) : break
 			else:
 				raise Exception("Dataname '{}' not found".format(self.dataname))
 			self.lineptr=i+1
@@ -160,6 +199,22 @@ If not set, it will read the first block encountered. Value should be of the for
 						self[loop[-1]]=[]			# this will hold the data values when we read them
 					else: break
 				self.lineptr-=1
+
+				# Fast path, find the end of the loop, and if the values are simple, split them into columns all at once
+				end=self.lineptr
+				while end<len(self.lines):
+					l=self.lines[end].lstrip()
+					if l[0] in "_;" or l[:5].lower() in ("loop_","data_") : break
+					end+=1
+				if end==len(self.lines) or self.lines[end].lstrip()[0]!=";" :
+					body=" ".join(self.lines[self.lineptr:end])
+					vals=body.split()
+					if '"' not in body and "'" not in body and len(vals)%len(loop)==0 :
+						for i,k in enumerate(loop):
+							self[k]=goodcolumn(vals[i::len(loop)])
+							if not self.usenumpy : self[k]=self[k].tolist()
+						self.lineptr=end
+						continue
 				
 				# Now we read the actual loop data elements
 				vals=[]
@@ -167,7 +222,7 @@ If not set, it will read the first block encountered. Value should be of the for
 					try: line2=self._nextline().strip()
 					except: break
 				
-					if line2[0]=="_" or line2.lower()[:5]=="loop_" : break
+					if line2[0]=="_" or line2.lower()[:5] in ("loop_","data_") : break
 					elif line2[0]==";" :
 						val=line2[0][1:]
 						while 1:
@@ -189,15 +244,44 @@ If not set, it will read the first block encountered. Value should be of the for
 						for i in range(len(vals)): self[loop[i]].append(vals[i])
 						vals=[]
 				self.lineptr-=1
+				if self.usenumpy :
+					for k in loop: self[k]=np.array(self[k])
 			else:
 				print("StarFile: Unknown content on line :",line)
 				break
 
 				
-	def writefile(self,filename=None):
-		"""Writes the contents of the current dictionary back to disk using either the existing filename, or an alternative name passed in"""
-		
-		print("Sorry, writing not implemented yet")
-					
-			
-			
+	def writefile(self,filename=None,append=False):
+		"""Writes the contents of the current dictionary back to disk using either the existing filename, or an alternative name passed in.
+If append is set, this data block is added to the end of the file rather than replacing it, which is how files with multiple
+data blocks (eg - data_optics and data_particles) are written. Loop rows are formatted and written a chunk at a time."""
+
+		if filename==None : filename=self.filename
+		name=self.dataname if self.dataname!=None else ""
+		if name[:5].lower()!="data_" : name="data_"+name
+
+		out=open(filename,"a" if append else "w")
+		out.write("\n{}\n\n".format(name))
+
+		inloop=set(k for loop in self.loops for k in loop)
+		for k in self:
+			if k not in inloop : out.write("_{} {}\n".format(k,starval(self[k])))
+
+		chunk=10000
+		for loop in self.loops:
+			n=len(self[loop[0]])
+			if any(len(self[k])!=n for k in loop) : raise Exception("StarFile: loop keys {} have different numbers of values".format(loop))
+
+			out.write("\nloop_\n")
+			for i,k in enumerate(loop): out.write("_{} #{}\n".format(k,i+1))
+			for i in range(0,n,chunk):
+				cols=[]
+				for k in loop:
+					col=self[k][i:i+chunk]
+					if isinstance(col,np.ndarray) : col=col.tolist()
+					cols.append([starval(v) for v in col])
+				out.write("\n".join([" ".join(row) for row in zip(*cols)]))
+				out.write("\n")
+
+		out.write("\n")
+		out=None
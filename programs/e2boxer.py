@@ -39,7 +39,6 @@ from builtins import object
 from EMAN2 import *
 from EMAN2jsondb import *
 import numpy as np
-import threading
 import queue
 import os,sys
 from pathlib import Path
@@ -69,6 +68,80 @@ except:
 
 # ok, this is kind of bad style, but really don't want to have to drag this flag around through many objects
 invert_on_read=False
+# the reference based autoboxers write their intermediate maps to final.hdf unless this is cleared (parallel autopicking)
+autobox_debug=True
+
+def update_boxes(fsp,newboxes):
+	"""Replaces the boxes from the picking mode of newboxes in the info file for fsp. If newboxes is empty,
+	the existing boxes are left alone"""
+	if len(newboxes)==0 : return
+	
+	# read the existing box list and update
+	db=js_open_dict(info_name(fsp))
+	try: 
+		boxes=db["boxes"]
+		# Filter out all existing boxes for this picking mode
+		bname=newboxes[0][2]
+		boxes=[b for b in boxes if b[2]!=bname]
+	except:
+		boxes=[]
+		
+	boxes.extend(newboxes)
+	
+	db["boxes"]=boxes
+	db.close()
+
+def autobox_parallel(filenames,apick,goodrefs,badrefs,bgrefs,options,logid=None):
+	"""Headless autopicking with one of the reference-based pickers. Micrographs are split across AutoboxTasks
+	using --parallel, each micrograph being downsampled and normalized once within a single task. The boxes
+	from each task are written to the info files as soon as it completes"""
+	from EMAN2PAR import EMTaskCustomer
+	fsps=[f.split()[1] for f in filenames]
+	etc=EMTaskCustomer(options.parallel, module="e2boxer.AutoboxTask")
+	ncpu=min(etc.cpu_est(),len(fsps))
+	print("{} micrographs in {} tasks".format(len(fsps),ncpu))
+	
+	taskopt={"apix":options.apix,"invert":invert_on_read}
+	tids=[etc.send_task(AutoboxTask(fsps[i::ncpu],apick,goodrefs,badrefs,bgrefs,taskopt)) for i in range(ncpu)]
+	
+	def merge(ret):
+		for fsp,newboxes in ret:
+			print("{} boxes -> {}".format(len(newboxes),fsp))
+			update_boxes(fsp,newboxes)
+	
+	if logid!=None : prog=lambda f:E2progress(logid,f)
+	else : prog=None
+	if not etc.reduce_results(tids,merge,prog) :
+		print("Error: autopicking task failed")
+	del etc
+
+class AutoboxTask(JSTask):
+	"""Runs a reference-based autoboxer over a list of micrographs, returning a list of (filename,boxes)"""
+	def __init__(self,fsps,apick,goodrefs,badrefs,bgrefs,options):
+		data={"goodrefs":goodrefs,"badrefs":badrefs,"bgrefs":bgrefs}
+		JSTask.__init__(self,"Autobox",data,{},"")
+		self.fsps=fsps
+		self.apick=apick
+		self.options=options
+	
+	def execute(self,callback):
+		global apix,invert_on_read,autobox_debug
+		apix=self.options["apix"]
+		invert_on_read=self.options["invert"]
+		autobox_debug=False		# tasks would all write to the same final.hdf
+		
+		pcl=[c for s,k,c in aboxmodes if k==self.apick[0]][0]
+		ret=[]
+		for i,fsp in enumerate(self.fsps):
+			callback(100*i//len(self.fsps))
+			micrograph=load_micrograph(fsp)
+			# parallelism is over micrographs, so each picker runs single threaded
+			newboxes=pcl.do_autobox(micrograph,self.data["goodrefs"],self.data["badrefs"],self.data["bgrefs"],apix,2,self.apick[1],None)
+			if newboxes==None : newboxes=[]
+			ret.append((fsp,newboxes))
+		
+		callback(100)
+		return ret
 
 def load_micrograph(filename):
 	if "\t" in filename: filename=filename.split()[1]
@@ -123,6 +196,7 @@ def main():
 	parser.add_argument("--cs",type=float,help="Microscope Cs (spherical aberation)",default=-1, guitype='floatbox', row=5, col=0, rowspan=1, colspan=1, mode="autofit['self.pm().getCS()']")
 	parser.add_argument("--ac",type=float,help="Amplitude contrast (percentage, default=10)",default=10, guitype='floatbox', row=5, col=1, rowspan=1, colspan=1, mode='autofit')
 	parser.add_argument("--autopick",type=str,default=None,help="Perform automatic particle picking. Provide mode and parameter string, eg - auto_local:threshold=5.5")
+	parser.add_argument("--parallel",type=str,default=None,help="With --autopick, distribute micrographs over parallel tasks without the GUI, eg - thread:8. Used by the auto_local and auto_ref pickers.")
 	parser.add_argument("--gui", action="store_true", default=False, help="Interactive GUI mode", guitype='boolbox', row=4, col=0, rowspan=1, colspan=1, mode="boxing[True]")
 	parser.add_argument("--threads", default=4,type=int,help="Number of threads to run in parallel on a single computer when multi-computer parallelism isn't useful",guitype='intbox', row=14, col=1, rowspan=1, colspan=1,mode="boxing")
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
@@ -283,30 +357,17 @@ def main():
 			pcl.do_autobox_all(args,goodrefs,badrefs,bgrefs,options.apix,options.threads,apick[1],None)
 			return
 		
-		for i,fspi in enumerate(args):
-			fsp=fspi.split()[1]
-			micrograph=load_micrograph(fsp)
+		#### otherwise whole micrographs are distributed over tasks
+		if options.parallel!=None and pcl in (boxerByRef,boxerLocal):
+			autobox_parallel(args,apick,goodrefs,badrefs,bgrefs,options,logid)
+		else:
+			for i,fspi in enumerate(args):
+				fsp=fspi.split()[1]
+				micrograph=load_micrograph(fsp)
 
-			newboxes=pcl.do_autobox(micrograph,goodrefs,badrefs,bgrefs,options.apix,options.threads,apick[1],None)
-			print("{}) {} boxes -> {}".format(i,len(newboxes),fsp))
-			
-			# if we got nothing, we just leave the current results alone
-			if len(newboxes)==0 : continue
-		
-			# read the existing box list and update
-			db=js_open_dict(info_name(fsp))
-			try: 
-				boxes=db["boxes"]
-				# Filter out all existing boxes for this picking mode
-				bname=newboxes[0][2]
-				boxes=[b for b in boxes if b[2]!=bname]
-			except:
-				boxes=[]
-				
-			boxes.extend(newboxes)
-			
-			db["boxes"]=boxes
-			db.close()
+				newboxes=pcl.do_autobox(micrograph,goodrefs,badrefs,bgrefs,options.apix,options.threads,apick[1],None)
+				print("{}) {} boxes -> {}".format(i,len(newboxes),fsp))
+				update_boxes(fsp,newboxes)
 
 	if options.gui :
 		if isinstance(QtGui,nothing) :
@@ -447,36 +508,22 @@ class boxerByRef(QtCore.QObject):
 		
 		# Iterate over in-plane rotation for each ref
 		jsd=queue.Queue(0)
-		thrds=[threading.Thread(target=boxerByRef.ccftask,args=(jsd,ref,downsample,gs,microf,ri)) for ri,ref in enumerate(goodrefs)]
-
 		n=-1
 
-		# here we run the threads and save the results, no actual alignment done here
-		print(len(thrds)," threads")
-		thrtolaunch=0
-		while thrtolaunch<len(thrds) or threading.active_count()>1 or not jsd.empty():
-			# If we haven't launched all threads yet, then we wait for an empty slot, and launch another
-			# note that it's ok that we wait here forever, since there can't be new results if an existing
-			# thread hasn't finished.
-			if thrtolaunch<len(thrds) and threading.active_count()!=nthreads:
-#				print "Starting thread {}/{}".format(thrtolaunch,len(thrds))
-				thrds[thrtolaunch].start()
-				thrtolaunch+=1
-			else: 
-				time.sleep(0.05)
-				if prog!=None : 
-					prog.setValue(prog.value())
-					if prog.wasCanceled() : break
-		
-			while not jsd.empty():
-				# add each ccf image to our maxval image as it comes in
-				ccf=jsd.get()
-				maxav.add_image(ccf)
-				sys.stdout.flush()
-		print("")
+		def addccf(i,r):
+			# add each ccf image to our maxval image as it comes in
+			while not jsd.empty(): maxav.add_image(jsd.get())
+
+		def canceled():
+			if prog==None : return False
+			prog.setValue(prog.value())
+			return prog.wasCanceled()
 
-		for t in thrds:
-			t.join()
+		# here we run the tasks and save the results, no actual alignment done here
+		print(len(goodrefs)," tasks")
+		thread_map(boxerByRef.ccftask,[(jsd,ref,downsample,gs,microf,ri) for ri,ref in enumerate(goodrefs)],nthreads-1,callback=addccf,cancel=canceled)
+		addccf(0,None)
+		print("")
 
 			
 		final=maxav.finish()
@@ -495,15 +542,16 @@ class boxerByRef(QtCore.QObject):
 		# Zero edges to eliminate boxes within 1/2 box size of edge
 		edge=int(old_div(goodrefs[0]["nx"],(2.0*downsample))+0.5)
 		final.mult(norm)
-		final.write_image("final.hdf",0)
+		if autobox_debug : final.write_image("final.hdf",0)
 		final.process_inplace("mask.zeroedge2d",{"x0":edge,"y0":edge})
 		final.process_inplace("mask.onlypeaks",{"npeaks":0,"usemean":0})
 		final.process_inplace("normalize.edgemean")
 #		final.process_inplace("threshold.belowtozero",{"minval":threshold})
 
-		final.write_image("final.hdf",1)
-		owner.write_image("final.hdf",2)
-		norm.write_image("final.hdf",3)
+		if autobox_debug :
+			final.write_image("final.hdf",1)
+			owner.write_image("final.hdf",2)
+			norm.write_image("final.hdf",3)
 #		display(final)
 		
 		print("Find peaks")
@@ -618,36 +666,22 @@ class boxerLocal(QtCore.QObject):
 		r.align("rotate_translate",r)
 		
 		jsd=queue.Queue(0)
-		thrds=[threading.Thread(target=boxerLocal.ccftask,args=(jsd,ref,downsample,microdown,ri)) for ri,ref in enumerate(goodrefs)]
-
 		n=-1
 
-		# here we run the threads and save the results, no actual alignment done here
-		print(len(thrds)," threads")
-		thrtolaunch=0
-		while thrtolaunch<len(thrds) or threading.active_count()>1:
-			# If we haven't launched all threads yet, then we wait for an empty slot, and launch another
-			# note that it's ok that we wait here forever, since there can't be new results if an existing
-			# thread hasn't finished.
-			if thrtolaunch<len(thrds) and threading.active_count()!=nthreads:
-#				print "Starting thread {}/{}".format(thrtolaunch,len(thrds))
-				thrds[thrtolaunch].start()
-				thrtolaunch+=1
-			else: 
-				time.sleep(0.05)
-				if prog!=None : 
-					prog.setValue(prog.value())
-					if prog.wasCanceled() : break
-		
-			while not jsd.empty():
-				# add each ccf image to our maxval image as it comes in
-				ccf=jsd.get()
-				maxav.add_image(ccf)
-				sys.stdout.flush()
-		print("")
+		def addccf(i,r):
+			# add each ccf image to our maxval image as it comes in
+			while not jsd.empty(): maxav.add_image(jsd.get())
+
+		def canceled():
+			if prog==None : return False
+			prog.setValue(prog.value())
+			return prog.wasCanceled()
 
-		for t in thrds:
-			t.join()
+		# here we run the tasks and save the results, no actual alignment done here
+		print(len(goodrefs)," tasks")
+		thread_map(boxerLocal.ccftask,[(jsd,ref,downsample,microdown,ri) for ri,ref in enumerate(goodrefs)],nthreads-1,callback=addccf,cancel=canceled)
+		addccf(0,None)
+		print("")
 
 			
 		final=maxav.finish()
@@ -668,9 +702,10 @@ class boxerLocal(QtCore.QObject):
 #		final.process_inplace("normalize.edgemean")
 #		final.process_inplace("threshold.belowtozero",{"minval":threshold})
 
-		microdown.write_image("final.hdf",0)
-		final.write_image("final.hdf",1)
-		owner.write_image("final.hdf",2)
+		if autobox_debug :
+			microdown.write_image("final.hdf",0)
+			final.write_image("final.hdf",1)
+			owner.write_image("final.hdf",2)
 		#norm.write_image("final.hdf",2)
 #		display(final)
 		
@@ -1228,51 +1263,42 @@ class boxerConvNet(QtCore.QObject):
 			jobs.append((fsp, i, layers, shrinkfac, nx, ny))
 		
 		#### worker function
-		def autobox_worker(que, job):
+		def autobox_worker(job):
 			fname, idx, layers, shrinkfac, nx, ny = job
+			print("Starting on img {}...".format(idx))
 			nnout=boxerConvNet.apply_network(fname, layers, shrinkfac, nx, ny, nnet_classify, params)
-			que.put((idx, fname,  nnout))
-			return
+			return (idx, fname,  nnout)
+		
+		#### results are written from this thread as each image finishes
+		ndone=[0]
+		def autobox_save(i, res):
+			idx, fsp, nnout=res
+			newboxes, nbad = nnout
+			print("{}) {} boxes, excluding {} bad -> {}".format(idx,len(newboxes), nbad,fsp))
+			ndone[0]+=1
+			if prog:
+				prog.setValue(ndone[0])
 		
-		#### now start autoboxing...
-		jsd=queue.Queue(0)
-		NTHREADS=max(nthreads+1,2)
-		thrds=[threading.Thread(target=autobox_worker,args=(jsd,job)) for job in jobs]
-		thrtolaunch=0
-		while thrtolaunch<len(thrds) or threading.active_count()>1:
-			#print thrtolaunch, len(thrds)
-			if thrtolaunch<len(thrds) :
+			# if we got nothing, we just leave the current results alone
+			if len(newboxes)==0 : return
+		
+			# read the existing box list and update
+			db=js_open_dict(info_name(fsp))
+			try: 
+				boxes=db["boxes"]
+				# Filter out all existing boxes for this picking mode
+				bname=newboxes[0][2]
+				boxes=[b for b in boxes if b[2]!=bname]
+			except:
+				boxes=[]
 				
-				while (threading.active_count()==NTHREADS ) : time.sleep(.1)
-				print("Starting on img {}...".format(thrtolaunch))
-				thrds[thrtolaunch].start()
-				thrtolaunch+=1
-			else: time.sleep(1)
-		
-			while not jsd.empty():
-				idx, fsp, nnout=jsd.get()
-				newboxes, nbad = nnout
-				print("{}) {} boxes, excluding {} bad -> {}".format(i,len(newboxes), nbad,fsp))
-		
-				# if we got nothing, we just leave the current results alone
-				if len(newboxes)==0 : continue
+			boxes.extend(newboxes)
 			
-				# read the existing box list and update
-				db=js_open_dict(info_name(fsp))
-				try: 
-					boxes=db["boxes"]
-					# Filter out all existing boxes for this picking mode
-					bname=newboxes[0][2]
-					boxes=[b for b in boxes if b[2]!=bname]
-				except:
-					boxes=[]
-					
-				boxes.extend(newboxes)
-				
-				db["boxes"]=boxes
-				db.close()
-				if prog:
-					prog.setValue(thrtolaunch-threading.active_count())
+			db["boxes"]=boxes
+			db.close()
+		
+		#### now start autoboxing...
+		thread_map(autobox_worker,[(job,) for job in jobs],max(nthreads,1),callback=autobox_save)
 				
 		return
 
@@ -46,6 +46,7 @@ import traceback
 from numpy import array,arange
 import numpy
 import threading
+import multiprocessing
 
 from Simplex import Simplex
 
@@ -234,14 +235,22 @@ NOTE: This program should be run from the project directory, not from within the
 
 	options.filenames = args
 
-	# This is where threading occurs, we call ourselves recursively here if we have --threads
+	# This is where threading occurs. CTF fitting is done here with a pool of processes, each taking the next 
+	# micrograph as soon as it is done. For the remaining steps we call ourselves recursively on chunks of the files
 	if nthreads>1 and not options.gui and not options.computesf:
-		print("Fitting in parallel with ",nthreads," threads")
-		chunksize=int(ceil(old_div(float(len(args)),nthreads)))
-#		print " ".join(sys.argv+["--chunk={},{}".format(chunksize,0)])
-		threads=[threading.Thread(target=os.system,args=[" ".join(sys.argv+["--chunk={},{}".format(chunksize,i)])]) for i in range(nthreads)]
-		for t in threads: t.start()
-		for t in threads: t.join()
+		argv=sys.argv
+		if options.autofit:
+			print("Fitting CTF in parallel with ",nthreads," processes")
+			pspec_and_ctf_fit(options,debug,nthreads)
+			argv=[i for i in argv if i!="--autofit"]
+
+		if options.refinebysnr or options.phaseflip or options.wiener or options.phasefliphp or options.phaseflipsmall or options.phaseflipproc or options.storeparm:
+			print("Processing in parallel with ",nthreads," threads")
+			chunksize=int(ceil(old_div(float(len(args)),nthreads)))
+#			print " ".join(argv+["--chunk={},{}".format(chunksize,0)])
+			threads=[threading.Thread(target=os.system,args=[" ".join(argv+["--chunk={},{}".format(chunksize,i)])]) for i in range(nthreads)]
+			for t in threads: t.start()
+			for t in threads: t.join()
 		print("Parallel fitting complete")
 		E2end(logid)
 		sys.exit(0)
@@ -552,116 +561,142 @@ def fixnegbg(bg_1d,im_1d,ds):
 	print("BG correction ratio %1.4f"%ratio)
 	return [i*ratio for i in bg_1d]
 
-def pspec_and_ctf_fit(options,debug=False):
+def pspec_and_ctf_fit(options,debug=False,nthreads=1):
 	"""Power spectrum and CTF fitting. Returns an 'image sets' list. Each item in this list contains
-	filename,EMAN2CTF,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d/None"""
+	filename,EMAN2CTF,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d/None. If nthreads>1, micrographs
+	are handed out one at a time to a pool of nthreads processes"""
 	global logid
 	img_sets=[]
 	#db_parms=db_open_dict("bdb:e2ctf.parms")
 	#db_im2d=db_open_dict("bdb:e2ctf.im2d")
 	#db_bg2d=db_open_dict("bdb:e2ctf.bg2d")
 
-	for i,filename in enumerate(options.filenames):
-		name=base_name(filename)
-		try : js_parms=js_open_dict(info_name(filename))
-		except :
-			print("ERROR: Cannot open {} for metadata storage. Exiting.".format(info_name(filename)))
+	jobs=[(options,filename,debug) for filename in options.filenames]
+	if nthreads>1:
+		pool=multiprocessing.Pool(min(nthreads,len(jobs)),initializer=init_sfcurve,initargs=(options.sf,))
+		results=pool.imap(pspec_and_ctf_fit_one,jobs)
+	else:
+		pool=None
+		results=map(pspec_and_ctf_fit_one,jobs)
+
+	apix=None
+	for i,(sets,fapix) in enumerate(results):
+		if sets==None:
+			if pool!=None: pool.terminate()
 			sys.exit(1)
+		img_sets.extend(sets)
+		if len(sets)>0 : apix=fapix
+		if logid : E2progress(logid,old_div(float(i+1),len(options.filenames)))
 
-		# compute the power spectra
-		if options.verbose or debug : print("Processing ",filename)
-		apix=options.apix
-		if apix<=0 : apix=EMData(filename,0,1)["apix_x"]
-
-		# After this, PS contains a list of (im_1d,bg_1d,im_2d,bg_2d,bg_1d_low) tuples. If classify is <2 then this list will have only 1 tuple in it
-		if options.classify>1 : ps=split_powspec_with_bg(filename,options.source_image,radius=options.bgmask,edgenorm=not options.nonorm,oversamp=options.oversamp,apix=apix,nclasses=options.classify,zero_ok=options.zerook)
-		else: ps=list((powspec_with_bg(filename,options.source_image,radius=options.bgmask,edgenorm=not options.nonorm,oversamp=options.oversamp,apix=apix,zero_ok=options.zerook,wholeimage=options.wholeimage,highdensity=options.highdensity),))
-		# im_1d,bg_1d,im_2d,bg_2d,bg_1d_low,micro_1d/none
-		if ps==None :
-			print("Error fitting CTF on ",filename)
-			continue
-		try: ds=1.0/(apix*ps[0][2].get_ysize())
-		except:
-			print("Error fitting CTF (ds) on ",filename)
-			continue
+	if pool!=None:
+		pool.close()
+		pool.join()
 
-		for j,p in enumerate(ps):
-			try: im_1d,bg_1d,im_2d,bg_2d,bg_1d_low,micro_1d=p
-			except:
-				im_1d,bg_1d,im_2d,bg_2d,bg_1d_low=p
-				micro_1d=None
-			if not options.nosmooth : bg_1d=smooth_bg(bg_1d,ds)
-			if options.fixnegbg :
-				bg_1d=fixnegbg(bg_1d,im_1d,ds)		# This insures that we don't have unreasonable negative values
+	project_db = js_open_dict("info/project.json")
+	try: project_db.update({ "global.microscope_voltage":options.voltage, "global.microscope_cs":options.cs, "global.apix":apix })
+	except:
+		print("ERROR: apix not found. This probably means that no CTF curves were successfully fit !")
+
+	return img_sets
 
-			if debug: Util.save_data(0,ds,bg_1d,"ctf.bgb4.txt")
+def pspec_and_ctf_fit_one(job):
+	"""Power spectrum and CTF fitting of a single particle stack. job is (options,filename,debug). Results are
+	stored in the info file for the stack. Returns the 'image sets' list for this file and the A/pix used, or
+	None if the info file cannot be opened"""
+	options,filename,debug=job
+	img_sets=[]
+	name=base_name(filename)
+	try : js_parms=js_open_dict(info_name(filename))
+	except :
+		print("ERROR: Cannot open {} for metadata storage. Exiting.".format(info_name(filename)))
+		return None,None
+
+	# compute the power spectra
+	if options.verbose or debug : print("Processing ",filename)
+	apix=options.apix
+	if apix<=0 : apix=EMData(filename,0,1)["apix_x"]
+
+	# After this, PS contains a list of (im_1d,bg_1d,im_2d,bg_2d,bg_1d_low) tuples. If classify is <2 then this list will have only 1 tuple in it
+	if options.classify>1 : ps=split_powspec_with_bg(filename,options.source_image,radius=options.bgmask,edgenorm=not options.nonorm,oversamp=options.oversamp,apix=apix,nclasses=options.classify,zero_ok=options.zerook)
+	else: ps=list((powspec_with_bg(filename,options.source_image,radius=options.bgmask,edgenorm=not options.nonorm,oversamp=options.oversamp,apix=apix,zero_ok=options.zerook,wholeimage=options.wholeimage,highdensity=options.highdensity),))
+	# im_1d,bg_1d,im_2d,bg_2d,bg_1d_low,micro_1d/none
+	if ps==None :
+		print("Error fitting CTF on ",filename)
+		return [],apix
+	try: ds=1.0/(apix*ps[0][2].get_ysize())
+	except:
+		print("Error fitting CTF (ds) on ",filename)
+		return [],apix
 
-			# Fit the CTF parameters
-			if debug : print("Fit CTF")
-			if options.curdefocushint or options.curdefocusfix:
+	for j,p in enumerate(ps):
+		try: im_1d,bg_1d,im_2d,bg_2d,bg_1d_low,micro_1d=p
+		except:
+			im_1d,bg_1d,im_2d,bg_2d,bg_1d_low=p
+			micro_1d=None
+		if not options.nosmooth : bg_1d=smooth_bg(bg_1d,ds)
+		if options.fixnegbg :
+			bg_1d=fixnegbg(bg_1d,im_1d,ds)		# This insures that we don't have unreasonable negative values
+
+		if debug: Util.save_data(0,ds,bg_1d,"ctf.bgb4.txt")
+
+		# Fit the CTF parameters
+		if debug : print("Fit CTF")
+		if options.curdefocushint or options.curdefocusfix:
+			try:
+				if options.useframedf : raise Exception		# a bit of a hack...
+				ctf=js_parms["ctf"][0]
+				ctf.apix=apix
+				curdf=ctf.defocus
+				curdfdiff=ctf.dfdiff
+				curdfang=ctf.dfang
+				if options.curdefocushint: dfhint=(curdf-0.1,curdf+0.1)
+				else: dfhint=(curdf-.001,curdf+.001)
+				print("Using existing defocus as hint :",dfhint)
+			except :
 				try:
-					if options.useframedf : raise Exception		# a bit of a hack...
-					ctf=js_parms["ctf"][0]
+					ctf=js_parms["ctf_frame"][1]
 					ctf.apix=apix
 					curdf=ctf.defocus
 					curdfdiff=ctf.dfdiff
 					curdfang=ctf.dfang
 					if options.curdefocushint: dfhint=(curdf-0.1,curdf+0.1)
 					else: dfhint=(curdf-.001,curdf+.001)
-					print("Using existing defocus as hint :",dfhint)
-				except :
-					try:
-						ctf=js_parms["ctf_frame"][1]
-						ctf.apix=apix
-						curdf=ctf.defocus
-						curdfdiff=ctf.dfdiff
-						curdfang=ctf.dfang
-						if options.curdefocushint: dfhint=(curdf-0.1,curdf+0.1)
-						else: dfhint=(curdf-.001,curdf+.001)
-						print("Using existing defocus from frame as hint :",dfhint)
-					except:
-						dfhint=None
-						print("No existing defocus to start with")
-			else: dfhint=(options.defocusmin,options.defocusmax)
-			ctf=ctf_fit(im_1d,bg_1d,bg_1d_low,im_2d,bg_2d,options.voltage,max(options.cs,0.01),options.ac,options.phaseplate,apix,bgadj=not options.nosmooth,autohp=options.autohp,dfhint=dfhint,highdensity=options.highdensity,verbose=options.verbose)
-			if options.astigmatism and not options.curdefocusfix : ctf_fit_stig(im_2d,bg_2d,ctf,verbose=1)
-			elif options.astigmatism:
-				ctf.dfdiff=curdfdiff
-				ctf.dfang=curdfang
-
-			im_1d,bg_1d=calc_1dfrom2d(ctf,im_2d,bg_2d)
-			if options.constbfactor>0 : ctf.bfactor=options.constbfactor
-			else: ctf.bfactor=ctf_fit_bfactor(list(array(im_1d)-array(bg_1d)),ds,ctf)
-
-
-			if debug:
-				Util.save_data(0,ds,im_1d,"ctf.fg.txt")
-				Util.save_data(0,ds,bg_1d,"ctf.bg.txt")
-				Util.save_data(0,ds,ctf.snr,"ctf.snr.txt")
-
-			try : qual=js_parms["quality"]
-			except :
-				qual=5
-				js_parms["quality"]=5
-			if j==0: img_sets.append([filename,ctf,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d])
-			else: img_sets.append([filename+"_"+str(j),ctf,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d])
-
-		# store the results back in the database. We omit the filename, quality and bg_1d_low (which can be easily recomputed)
-		if img_sets[-1][-1]==None: js_parms.delete("ctf_microbox")
-		else: js_parms["ctf_microbox"]=img_sets[-1][-1]
-		js_parms["ctf"]=img_sets[-1][1:4]
-		js_parms["ctf_im2d"]=img_sets[-1][4]
-		js_parms["ctf_bg2d"]=img_sets[-1][5]
-		js_parms.close()
-
-		if logid : E2progress(logid,old_div(float(i+1),len(options.filenames)))
-
-	project_db = js_open_dict("info/project.json")
-	try: project_db.update({ "global.microscope_voltage":options.voltage, "global.microscope_cs":options.cs, "global.apix":apix })
-	except:
-		print("ERROR: apix not found. This probably means that no CTF curves were successfully fit !")
+					print("Using existing defocus from frame as hint :",dfhint)
+				except:
+					dfhint=None
+					print("No existing defocus to start with")
+		else: dfhint=(options.defocusmin,options.defocusmax)
+		ctf=ctf_fit(im_1d,bg_1d,bg_1d_low,im_2d,bg_2d,options.voltage,max(options.cs,0.01),options.ac,options.phaseplate,apix,bgadj=not options.nosmooth,autohp=options.autohp,dfhint=dfhint,highdensity=options.highdensity,verbose=options.verbose)
+		if options.astigmatism and not options.curdefocusfix : ctf_fit_stig(im_2d,bg_2d,ctf,verbose=1)
+		elif options.astigmatism:
+			ctf.dfdiff=curdfdiff
+			ctf.dfang=curdfang
+
+		im_1d,bg_1d=calc_1dfrom2d(ctf,im_2d,bg_2d)
+		if options.constbfactor>0 : ctf.bfactor=options.constbfactor
+		else: ctf.bfactor=ctf_fit_bfactor(list(array(im_1d)-array(bg_1d)),ds,ctf)
+
+
+		if debug:
+			Util.save_data(0,ds,im_1d,"ctf.fg.txt")
+			Util.save_data(0,ds,bg_1d,"ctf.bg.txt")
+			Util.save_data(0,ds,ctf.snr,"ctf.snr.txt")
+
+		try : qual=js_parms["quality"]
+		except :
+			qual=5
+			js_parms.setval("quality",5,deferupdate=True)
+		if j==0: img_sets.append([filename,ctf,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d])
+		else: img_sets.append([filename+"_"+str(j),ctf,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d])
+
+	# store the results back in the database. We omit the filename, quality and bg_1d_low (which can be easily recomputed)
+	# all of the changes are written to the file in a single update
+	if img_sets[-1][-1]==None: js_parms.delete("ctf_microbox",deferupdate=True)
+	else: js_parms.setval("ctf_microbox",img_sets[-1][-1],deferupdate=True)
+	js_parms.update({"ctf":img_sets[-1][1:4],"ctf_im2d":img_sets[-1][4],"ctf_bg2d":img_sets[-1][5]})
+	js_parms.close()
 
-	return img_sets
+	return img_sets,apix
 
 def refine_and_smoothsnr(options,strfact,debug=False):
 	"""This will refine already determined defocus values by maximizing high-resolution smoothed
@@ -1024,6 +1059,25 @@ def powspec(stackfile,source_image=None,mask=None,edgenorm=True):
 	return av
 
 masks={}		# mask cache for background/foreground masking
+PSPEC_CHUNK=256	# number of particles read and transformed at once when computing power spectra
+
+def add_masked_pspec(av,ims,mask):
+	"""Adds the Fourier intensity of each image in ims multiplied by mask to av, an FFT-shaped intensity image.
+	The FFTs of the whole list are done at once in numpy, since the per-image overhead dominates for small boxes"""
+	if len(ims)==0 : return
+	if mask["nx"]%2==1 :
+		for im in ims:
+			imf=(im*mask).do_fft()
+			imf.ri2inten()
+			av+=imf
+		return
+
+	data=numpy.array([im.numpy() for im in ims])*mask.numpy()
+	inten=numpy.sum(numpy.abs(numpy.fft.rfft2(data))**2,axis=0)
+	avn=av.numpy()
+	avn[:,::2]+=inten
+	av.update()
+
 def powspec_with_bg(stackfile,source_image=None,radius=0,edgenorm=True,oversamp=1,apix=2,ptclns=None,zero_ok=False,wholeimage=False,highdensity=False):
 	"""This routine will read the images from the specified file, optionally edgenormalize,
 	then apply a gaussian mask with the specified radius then compute the average 2-D power
@@ -1068,58 +1122,44 @@ def powspec_with_bg(stackfile,source_image=None,radius=0,edgenorm=True,oversamp=
 		masks[(ys,radius)]=(mask1,ratio1,mask2,ratio2)
 #		display((mask1,mask2))
 
-	av1,av2=None,None
-	for i in range(n):
-		if ptclns!=None and i not in ptclns :continue
-		im1 = EMData()
-		if source_image!=None :
-			im1.read_image(stackfile,i,True)
-			try:
-				if im1["ptcl_source_image"]!=source_image : continue
-			except:
-				print("Image %d doesn't have the ptcl_source_image parameter. Skipping."%i)
-				continue
-
-		im1.read_image(stackfile,i)
-
-		# Images with flat edges due to boxing too close to the edge can adversely impact the power spectrum
-		if not zero_ok :
-			im1.process_inplace("mask.zeroedgefill",{"nonzero":1})		# This tries to deal with particles that were boxed off the edge of the micrograph
-			if im1.has_attr("hadzeroedge") and im1["hadzeroedge"]!=0:
-				print("Skipped particle with bad edge ({}:{})".format(stackfile,i))
-				continue
-
-		nn+=1
-#		im1=EMData(stackfile,i)
-
-		if edgenorm : im1.process_inplace("normalize.edgemean")
-		if oversamp>1 :
-#			print Region(-(ys2*(oversamp-1)/2),-(ys2*(oversamp-1)/2),ys,ys)
-			im1.clip_inplace(Region(-(old_div(ys2*(oversamp-1),2)),-(old_div(ys2*(oversamp-1),2)),ys,ys))
-
-		im2=im1.copy()
-
-#		print im2.get_size(), im1.get_size()
-
-		# now we compute power spectra for the 2 regions defined by the masks
-		# av1/2 contain the incoherent averaged power spectra (intensity average)
-		im1*=mask1
-		imf=im1.do_fft()
-		imf.ri2inten()
-		if av1==None:
-			av1=EMData(imf["nx"],imf["ny"],imf["nz"])	# we make a new object to avoid copying the header of imf
-			av1.set_complex(True)
-			av1.to_zero()
-		av1+=imf
-
-		im2*=mask2
-		imf=im2.do_fft()
-		imf.ri2inten()
-		if av2==None:
-			av2=EMData(imf["nx"],imf["ny"],imf["nz"])
-			av2.set_complex(True)
-			av2.to_zero()
-		av2+=imf
+	# select the particles to use, with a single bulk header read if we need to check the source image
+	sel=range(n)
+	if ptclns!=None :
+		ptclns=set(ptclns)
+		sel=[i for i in sel if i in ptclns]
+	if source_image!=None :
+		hdrs=EMData.read_images(stackfile,list(sel),IMAGE_UNKNOWN,True)
+		keep=[]
+		for i,h in zip(sel,hdrs):
+			if not h.has_attr("ptcl_source_image") : print("Image %d doesn't have the ptcl_source_image parameter. Skipping."%i)
+			elif h["ptcl_source_image"]==source_image : keep.append(i)
+		sel=keep
+	sel=list(sel)
+
+	# av1/2 contain the incoherent averaged power spectra (intensity average) for the 2 regions defined by the masks
+	av1=EMData(ys+2-ys%2,ys,1)	# we make a new object to avoid copying the header of an FFT
+	av1.set_complex(True)
+	av1.to_zero()
+	av2=av1.copy()
+	for c in range(0,len(sel),PSPEC_CHUNK):
+		ims=EMData.read_images(stackfile,sel[c:c+PSPEC_CHUNK])
+		good=[]
+		for i,im1 in zip(sel[c:c+PSPEC_CHUNK],ims):
+			# Images with flat edges due to boxing too close to the edge can adversely impact the power spectrum
+			if not zero_ok :
+				im1.process_inplace("mask.zeroedgefill",{"nonzero":1})		# This tries to deal with particles that were boxed off the edge of the micrograph
+				if im1.has_attr("hadzeroedge") and im1["hadzeroedge"]!=0:
+					print("Skipped particle with bad edge ({}:{})".format(stackfile,i))
+					continue
+
+			if edgenorm : im1.process_inplace("normalize.edgemean")
+			if oversamp>1 :
+				im1.clip_inplace(Region(-(old_div(ys2*(oversamp-1),2)),-(old_div(ys2*(oversamp-1),2)),ys,ys))
+			good.append(im1)
+
+		nn+=len(good)
+		add_masked_pspec(av1,good,mask1)
+		add_masked_pspec(av2,good,mask2)
 
 	if nn==0 : return None
 
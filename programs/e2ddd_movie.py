@@ -40,9 +40,10 @@ import pprint
 import sys
 import os
 from sys import argv
-from time import sleep,time,ctime
+from time import time,ctime
 import threading
 import queue
+import traceback
 import numpy as np
 from sklearn import linear_model
 from scipy import optimize
@@ -116,6 +117,7 @@ def main():
 	parser.add_argument("--optstep", type=int,help="Step size to use during alignment optimization. Default is 448.",default=448,  guitype='intbox', row=23, col=1, rowspan=1, colspan=1, mode="align,tomo")
 	parser.add_argument("--optalpha", type=float,help="Penalization to apply during robust regression. Default is 0.1. If 0.0, unpenalized least squares will be performed (i.e., no trajectory smoothing).",default=0.1, guitype='floatbox', row=23, col=2, rowspan=1, colspan=1, mode="align,tomo")
 	parser.add_argument("--optccf",default="robust",type=str, choices=["robust","centerofmass","ccfmax"],help="Use this approach to determine relative frame translations.\nNote: 'robust' utilizes a bimodal Gaussian to robustly determine CCF peaks between pairs of frames in the presence of a fixed background.", guitype='combobox', row=24, col=0, rowspan=1, colspan=2, mode='align["robust"],tomo["robust"]',choicelist='["robust","centerofmass","ccfmax"]')
+	parser.add_argument("--optwindow", type=int,help="Only correlate each frame with the next N frames, rather than all n(n-1)/2 frame pairs, then solve for the trajectory from this sparse set. Default is 0 (all pairs).",default=0, guitype='intbox', row=24, col=2, rowspan=1, colspan=1, mode="align,tomo")
 
 	parser.add_header(name="orblock5", help='Just a visual separation', title="Optional: ", row=25, col=0, rowspan=2, colspan=3, mode="align,tomo")
 
@@ -124,6 +126,7 @@ def main():
 	parser.add_argument("--ext",default="hdf",type=str, choices=["hdf","mrcs","mrc"],help="Save frames with this extension. Default is 'hdf'.", guitype='strbox', row=27, col=2, rowspan=1, colspan=1, mode="align,tomo")
 
 	parser.add_argument("--threads", default=4,type=int,help="Number of threads to run in parallel. The default is 4, and our alignment routine requires 2+ threads. Using more threads will result in faster processing times.", guitype='intbox', row=28, col=0, rowspan=1, colspan=1, mode="align,tomo")
+	parser.add_argument("--readahead", default=0,type=int,help="When processing multiple movies, read and dark/gain correct up to N movies ahead of the one being aligned, and write outputs in the background. Each movie read ahead is held in memory. Default is 0 (one movie at a time).")
 
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=4, help="verbose level [0-9], higher number means higher level of verboseness",guitype="intbox",row=28,col=1,rowspan=1,colspan=1,mode="align,tomo")
 	parser.add_argument("--debug", default=False, action="store_true", help="run with debugging output")
@@ -425,9 +428,8 @@ def main():
 		db.close()
 
 	# the user may provide multiple movies to process at once
+	jobs=[]
 	for idx,fsp in enumerate(sorted(args)):
-		print("Processing {}".format(base_name(fsp,nodir=True)))
-
 		if options.tomo:
 			# write reference image info to corresponding movie info.json files
 			#angle = angles[idx]
@@ -476,24 +478,77 @@ def main():
 
 		if flast > n : flast = n
 
-		process_movie(options, fsp, dark, gain, first, flast, step, idx)
+		jobs.append((idx,fsp,flast))
+
+	if options.readahead>0 and len(jobs)>1:
+		# pipeline mode, the next movies are read while the current one is aligned, and outputs are written in the background
+		movies=queue.Queue(options.readahead)
+		reader=threading.Thread(target=read_movies,args=(options,jobs,dark,gain,first,step,movies))
+		reader.daemon=True
+		reader.start()
+		writer=BackgroundWriter()
+		while True:
+			job=movies.get()
+			if job is None : break
+			idx,fsp,flast,outim=job
+			print("Processing {}".format(base_name(fsp,nodir=True)))
+			if outim is None : continue
+			process_movie(options, fsp, dark, gain, first, flast, step, idx, outim, writer)
+			del outim,job
+		reader.join()
+		writer.close()
+	else:
+		for idx,fsp,flast in jobs:
+			print("Processing {}".format(base_name(fsp,nodir=True)))
+			process_movie(options, fsp, dark, gain, first, flast, step, idx)
 
 	print("Done")
 	E2end(pid)
 
 
-def process_movie(options,fsp,dark,gain,first,flast,step,idx):
-	cwd = os.getcwd()
-
-	# format outname
-	if options.frames: outname="{}/{}_{}".format(cwd,base_name(fsp,nodir=True),options.suffix) #Output contents vary with options
-	else: outname="{}/{}".format(cwd,base_name(fsp,nodir=True))
-
-	if options.groupby > 1: outname = "{}_group{}".format(outname,options.groupby)
-
-	if options.ext == "mrc": outname = "{}.mrcs".format(outname)
-	else: outname = "{}.{}".format(outname,options.ext)
-
+class BackgroundWriter(object):
+	"""Runs output calls, typically EMData.write_image, on a single background thread in the order they are submitted,
+	so writing the outputs of one movie overlaps with processing the next. The queue is bounded, so a slow disk eventually
+	blocks the caller rather than buffering an unlimited number of images"""
+	def __init__(self,maxqueue=16):
+		self.que=queue.Queue(maxqueue)
+		self.thread=threading.Thread(target=self.run)
+		self.thread.daemon=True
+		self.thread.start()
+
+	def run(self):
+		while True:
+			job=self.que.get()
+			if job is None : break
+			func,args=job
+			try: func(*args)
+			except: traceback.print_exc()
+
+	def submit(self,func,*args):
+		self.que.put((func,args))
+
+	def close(self):
+		"""waits for all pending output to be written"""
+		self.que.put(None)
+		self.thread.join()
+
+def read_movies(options,jobs,dark,gain,first,step,out):
+	"""Reader thread for pipeline mode. Reads and corrects each (idx,fsp,flast) movie in jobs, and puts
+	(idx,fsp,flast,frames) in out, which should be bounded to limit the number of movies held in memory.
+	frames is None if the movie could not be read. A final None marks the end."""
+	try:
+		for idx,fsp,flast in jobs:
+			try: outim=read_movie_frames(options,fsp,dark,gain,first,flast,step,False)
+			except:
+				traceback.print_exc()
+				print("Error: Could not read {}".format(fsp))
+				outim=None
+			out.put((idx,fsp,flast,outim))
+	finally:
+		out.put(None)
+
+def read_movie_frames(options,fsp,dark,gain,first,flast,step,verbose=True):
+	"""Reads frames first to flast by step from fsp and applies dark/gain and bad line correction. Returns a list of EMData"""
 	# prepare to read file
 	if fsp[-4:].lower() in (".mrc"):
 		hdr=EMData(fsp,0,True)			# read header
@@ -501,10 +556,8 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 
 	# bgsub and gain correct the stack
 	outim=[]
-	nfs = 0
-	t = time()
 	for ii in range(first,flast,step):
-		if options.verbose:
+		if options.verbose and verbose:
 			sys.stdout.write(" {}/{}   \r".format(ii-first+1,flast-first+1))
 			sys.stdout.flush()
 
@@ -528,16 +581,38 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 
 		outim.append(im)
 
+	return outim
+
+def process_movie(options,fsp,dark,gain,first,flast,step,idx,outim=None,writer=None):
+	"""Gain corrects and aligns one movie and writes the requested averages. outim may be passed in if the frames
+	were already read with read_movie_frames. If writer (a BackgroundWriter) is specified, image output is handed
+	to it rather than written before returning."""
+	cwd = os.getcwd()
+
+	# format outname
+	if options.frames: outname="{}/{}_{}".format(cwd,base_name(fsp,nodir=True),options.suffix) #Output contents vary with options
+	else: outname="{}/{}".format(cwd,base_name(fsp,nodir=True))
+
+	if options.groupby > 1: outname = "{}_group{}".format(outname,options.groupby)
+
+	if options.ext == "mrc": outname = "{}.mrcs".format(outname)
+	else: outname = "{}.{}".format(outname,options.ext)
+
+	if writer!=None : write=writer.submit
+	else : write=lambda func,*args:func(*args)
+
+	t = time()
+	if outim is None : outim=read_movie_frames(options,fsp,dark,gain,first,flast,step)
 	nfs_read = len(outim)
 
 	if options.noali:
 		out=qsum(outim)
 		if options.tomo:
 			alioutname = os.path.join(".","tiltseries","{}__noali.hdf".format(base_name(options.tomo_name,nodir=True)))
-			out.write_image(alioutname,idx) #write out the unaligned average movie
+			write(out.write_image,alioutname,idx) #write out the unaligned average movie
 		else:
 			alioutname = os.path.join(".","micrographs","{}__noali.hdf".format(base_name(fsp,nodir=True)))
-			out.write_image(alioutname,0) #write out the unaligned average movie
+			write(out.write_image,alioutname,0) #write out the unaligned average movie
 
 	# group frames by moving window
 	if options.groupby > 1:
@@ -547,7 +622,7 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 			avgr = Averagers.get("mean")
 			avgr.add_image_list(outim[i:i+options.groupby])
 			avg = avgr.finish()
-			if options.frames: avg.write_image(outname,i)
+			if options.frames: write(avg.copy().write_image,outname,i)	# copy, since frames may be shifted in place below
 			grouped.append(avg)
 		outim = grouped
 
@@ -564,7 +639,7 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 	# 	outim = grouped
 
 	if options.frames and options.ext == "mrc":
-		os.rename(outname,outname.replace(".mrcs",".mrc"))
+		write(os.rename,outname,outname.replace(".mrcs",".mrc"))
 
 	t1 = time()-t
 	print("{:.1f} s".format(time()-t))
@@ -588,68 +663,49 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 
 		# prepare image data (outim) by clipping and FFT'ing all tiles (this is threaded as well)
 		immx=[0]*n
-		thds = []
-		for i in range(n):
-			thd = threading.Thread(target=split_fft,args=(options,outim[i],i,options.optbox,options.optstep,ccfs))
-			thds.append(thd)
-		sys.stdout.write("\rPrecompute  /{} FFTs".format(len(thds)))
+		sys.stdout.write("\rPrecompute  /{} FFTs".format(n))
 		t0=time()
 
-		thrtolaunch=0
-		while thrtolaunch<len(thds) or threading.active_count()>1 or not ccfs.empty():
-			if thrtolaunch<len(thds) :
-				while (threading.active_count()==options.threads ) : sleep(.01)
-				#if options.verbose :
-				#	sys.stdout.write("\rPrecompute {}/{} FFTs {}".format(thrtolaunch+1,len(thds),threading.active_count()))
-				#	sys.stdout.flush()
-				thds[thrtolaunch].start()
-				thrtolaunch+=1
-			else: sleep(0.5)
-
+		def store_fft(j,r):
 			while not ccfs.empty():
 				i,d=ccfs.get()
 				immx[i]=d
 
-		for th in thds: th.join()
+		thread_map(split_fft,[(options,outim[i],i,options.optbox,options.optstep,ccfs) for i in range(n)],options.threads-1,callback=store_fft)
+		store_fft(0,None)
 		print()
 
-		# create threads
-		thds=[]
+		# create tasks
+		tasks=[]
 		peak_locs=queue.Queue(0)
 		i=-1
+		if options.optwindow>0 : win=options.optwindow
+		else : win=n
 		for ima in range(n-1):
-			for imb in range(ima+1,n):
+			for imb in range(ima+1,min(ima+1+win,n)):
 				if options.verbose>3: i+=1		# if i>0 then it will write pre-processed CCF images to disk for debugging
-				thds.append(threading.Thread(target=calc_ccf_wrapper,args=(options,(ima,imb),options.optbox,options.optstep,immx[ima],immx[imb],ccfs,peak_locs,i,fsp)))
+				tasks.append((options,(ima,imb),options.optbox,options.optstep,immx[ima],immx[imb],ccfs,peak_locs,i,fsp))
 
-		print("{:1.1f} s\nCompute {} ccfs".format(time()-t0,len(thds)))
+		print("{:1.1f} s\nCompute {} ccfs".format(time()-t0,len(tasks)))
 		t0=time()
 
-		# here we run the threads and save the results, no actual alignment done here
+		# here we run the tasks and save the results, no actual alignment done here
 		csum2={}
+		ndone=[0]
 
-		thrtolaunch=0
-		while thrtolaunch<len(thds) or threading.active_count()>1:
-			# If we haven't launched all threads yet, then we wait for an empty slot, and launch another
-			# note that it's ok that we wait here forever, since there can't be new results if an existing
-			# thread hasn't finished.
-			if thrtolaunch<len(thds) :
-				while (threading.active_count()==options.threads ) : sleep(.01)
-				#if options.verbose : print "Starting thread {}/{}".format(thrtolaunch,len(thds))
-				thds[thrtolaunch].start()
-				thrtolaunch+=1
-			else:
-				sleep(0.5)
-
+		def store_ccf(j,r):
 			while not ccfs.empty():
 				i,d=ccfs.get()
 				csum2[i]=d
-
+			ndone[0]+=1
 			if options.verbose:
-				sys.stdout.write("\r  {}/{} ({})".format(thrtolaunch,len(thds),threading.active_count()))
+				sys.stdout.write("\r  {}/{}".format(ndone[0],len(tasks)))
 				sys.stdout.flush()
 
-		for th in thds: th.join()
+		thread_map(calc_ccf_wrapper,tasks,options.threads-1,callback=store_ccf)
+		while not ccfs.empty():
+			i,d=ccfs.get()
+			csum2[i]=d
 		print()
 
 		avgr=Averagers.get("minmax",{"max":0})
@@ -722,16 +778,18 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 		locs = traj.ravel()
 		quals=[0]*n # quality of each frame based on its correlation peak summed over all images
 		cen=old_div(options.optbox,2) #csum2[(0,1)]["nx"]/2
-		for i in range(n-1):
-			for j in range(i+1,n):
-				val=csum2[(i,j)].sget_value_at_interp(int(cen+locs[j*2]-locs[i*2]),int(cen+locs[j*2+1]-locs[i*2+1]))*sqrt(old_div(float(n-fabs(i-j)),n))
-				quals[i]+=val
-				quals[j]+=val
+		for i,j in csum2:		# all pairs, or only those within --optwindow
+			val=csum2[(i,j)].sget_value_at_interp(int(cen+locs[j*2]-locs[i*2]),int(cen+locs[j*2+1]-locs[i*2+1]))*sqrt(old_div(float(n-fabs(i-j)),n))
+			quals[i]+=val
+			quals[j]+=val
 
 		print("{:1.1f} s".format(time()-t0,n))
 
 		runtime = time()-start
 		print("Runtime: {:.1f} s".format(runtime))
+		if win<n : mode="window {}".format(win)
+		else : mode="all pairs"
+		print("Alignment ({}): {} CCFs, mean quality per CCF {:.4g}".format(mode,len(csum2),old_div(sum(quals),(2.0*len(csum2)))))
 
 		# print("{:1.1f} s\nShift images".format(time()-t0))
 		# for i,im in enumerate(outim):
@@ -783,6 +841,8 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 			db[idx]["ddd_alignment_optbox"]=options.optbox
 			db[idx]["ddd_alignment_optstep"]=options.optstep
 			db[idx]["ddd_alignment_optalpha"]=options.optalpha
+			db[idx]["ddd_alignment_optwindow"]=options.optwindow
+			db[idx]["ddd_alignment_nccf"]=len(csum2)
 		else:
 			db=js_open_dict(info_name(fsp,nodir=True))
 			db["ddd_alignment_trans"]=[i for i in locs]
@@ -792,6 +852,8 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 			db["ddd_alignment_optbox"]=options.optbox
 			db["ddd_alignment_optstep"]=options.optstep
 			db["ddd_alignment_optalpha"]=options.optalpha
+			db["ddd_alignment_optwindow"]=options.optwindow
+			db["ddd_alignment_nccf"]=len(csum2)
 		db.close()
 
 		# if options.plot:
@@ -835,7 +897,7 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 					dy = float(locs[im*2+1])
 					from fundamentals import fshift
 					outim[im] = fshift(outim[im],dx,dy)
-					outim[im].write_image(alioutname,im) #write out the unaligned average movie
+					write(outim[im].write_image,alioutname,im) #write out the unaligned average movie
 					#im.translate(dx,dy,0)
 				if options.debug or options.verbose > 5:
 					print("{}\t{}\t{}".format(im,dx,dy))
@@ -849,10 +911,10 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 				out=qsum(outim)
 				if options.tomo:
 					alioutname = os.path.join(".","tiltseries","{}__allali.hdf".format(base_name(options.tomo_name,nodir=True)))
-					out.write_image(alioutname,idx) #write out the unaligned average movie
+					write(out.write_image,alioutname,idx) #write out the unaligned average movie
 				else:
 					alioutname = os.path.join(".","micrographs","{}__allali.hdf".format(base_name(fsp,nodir=True)))
-					out.write_image(alioutname,0) #write out the unaligned average movie
+					write(out.write_image,alioutname,0) #write out the unaligned average movie
 
 			if options.goodali:
 				thr=(max(quals[1:])-min(quals))*0.4+min(quals)	# max correlation cutoff for inclusion
@@ -861,10 +923,10 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 				print("Keeping {}/{} frames".format(len(best),len(outim)))
 				if options.tomo:
 					alioutname = os.path.join(".","tiltseries","{}__goodali.hdf".format(base_name(options.tomo_name,nodir=True)))
-					out.write_image(alioutname,idx) #write out the unaligned average movie
+					write(out.write_image,alioutname,idx) #write out the unaligned average movie
 				else:
 					alioutname = os.path.join(".","micrographs","{}__goodali.hdf".format(base_name(fsp,nodir=True)))
-					out.write_image(alioutname,0) #write out the unaligned average movie
+					write(out.write_image,alioutname,0) #write out the unaligned average movie
 
 			if options.bestali:
 				thr=(max(quals[1:])-min(quals))*0.6+min(quals)	# max correlation cutoff for inclusion
@@ -873,10 +935,10 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 				print("Keeping {}/{} frames".format(len(best),len(outim)))
 				if options.tomo:
 					alioutname = os.path.join(".","tiltseries","{}__bestali.hdf".format(base_name(options.tomo_name,nodir=True)))
-					out.write_image(alioutname,idx) #write out the unaligned average movie
+					write(out.write_image,alioutname,idx) #write out the unaligned average movie
 				else:
 					alioutname = os.path.join(".","micrographs","{}__bestali.hdf".format(base_name(fsp,nodir=True)))
-					out.write_image(alioutname,0) #write out the unaligned average movie
+					write(out.write_image,alioutname,0) #write out the unaligned average movie
 
 			# if options.ali4to14:
 			# 	out=qsum(outim[4:14]) # skip the first 4 frames then keep 10
@@ -892,10 +954,10 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 				out=qsum(outim[rng[0]:rng[1]+1])
 				if options.tomo:
 					alioutname = os.path.join(".","tiltseries","{}__{}.hdf".format(base_name(options.tomo_name,nodir=True),"-".join(rng)))
-					out.write_image(alioutname,idx) #write out the unaligned average movie
+					write(out.write_image,alioutname,idx) #write out the unaligned average movie
 				else:
 					alioutname = os.path.join(".","micrographs","{}__{}.hdf".format(base_name(fsp,nodir=True),"-".join(rng)))
-					out.write_image(alioutname,0) #write out the unaligned average movie
+					write(out.write_image,alioutname,0) #write out the unaligned average movie
 
 		except:
 			print("Error: Could not find prior alignment for {}. Exiting".format(fsp,nodir=True))
@@ -43,7 +43,7 @@ import datetime
 from numpy import array
 import traceback
 import json
-from time import time,sleep
+from time import time
 
 try:
 	import numpy as np
@@ -473,7 +473,7 @@ def main():
 		
 	if options.evalptclqual:
 #		from multiprocessing import Pool
-		import threading,queue
+		import queue
 		print("Particle quality evaluation mode")
 
 		jsparm=js_open_dict(args[0]+"/0_refine_parms.json")
@@ -562,32 +562,20 @@ def main():
 					try: classptcls[cls].append((it,eo,j))
 					except: classptcls[cls]=[(it,eo,j)]
 
-		# Create Thread objects
+		# pqual returns its results through jsd, which we drain as each class completes
 		jsd=queue.Queue(0)
-		thrds=[threading.Thread(target=pqual,args=(i,classptcls[i],jsd,options.includeprojs,options.verbose)) for i in list(classptcls.keys())]
+		clss=list(classptcls.keys())
 		result={}
-		thrtolaunch=0
-
-		while thrtolaunch<len(thrds) or threading.active_count()>1 or not jsd.empty():
-			# If we haven't launched all threads yet, then we wait for an empty slot, and launch another
-			# note that it's ok that we wait here forever, since there can't be new results if an existing
-			# thread hasn't finished.
-			if thrtolaunch<len(thrds) :
-				while (threading.active_count()==options.threads+1 ) : sleep(.01)
-				if options.verbose : 
-					print(" Starting thread {}/{}      \r".format(thrtolaunch,len(thrds)), end=' ')
-					sys.stdout.flush()
-				thrds[thrtolaunch].start()
-				thrtolaunch+=1
-			else:sleep(.25)
-		
-			while not jsd.empty():
-				rd=jsd.get()
-				result.update(rd)
-		if options.verbose: print("Threads complete             ")
 
-		for t in thrds:
-			t.join()
+		def collect(i,r):
+			while not jsd.empty(): result.update(jsd.get())
+			if options.verbose :
+				print(" Finished class {}/{}      \r".format(i,len(clss)), end=' ')
+				sys.stdout.flush()
+
+		thread_map(pqual,[(i,classptcls[i],jsd,options.includeprojs,options.verbose) for i in clss],options.threads,callback=collect)
+		while not jsd.empty(): result.update(jsd.get())
+		if options.verbose: print("Threads complete             ")
 	 
 		fout=open(ptclfsc,"w")
 		fout.write("# 100-30 it1; 30-15 it1; 15-8 it1; 8-4 it1; 100-30 it2; 30-15 it2; 15-8 it2; 8-4 it2; it12rmsd; (30-8)/(100-30) alt1; az1; cls1; alt2; az2; cls2; defocus; angdiff\n")
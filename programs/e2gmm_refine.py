@@ -2,6 +2,7 @@
 # Muyuan Chen 2020-06
 from EMAN2 import *
 import numpy as np
+import hashlib
 from sklearn.decomposition import PCA
 
 #### need to unify the float type across tenforflow and numpy
@@ -194,22 +195,22 @@ def calc_frc(data_cpx, imgs_cpx, rings, return_curve=False,minpx=4):
 		frcval=tf.reduce_mean(frc[:, minpx:], axis=1)
 		return frcval
 	
-#### load particles from file and fourier transform them
-#### particles need to have their transform in file header or comment of list file
-##   will also shrink particles and do FT
-##   return Fourier images and transform matrix
-def load_particles(fname, boxsz, shuffle=False):
-	
+#### read particles in chunks, shrink them and do FT
+##   returns the Fourier images as (nptcl, 2 (real, imag), boxsz, boxsz//2+1) and the header transforms
+##   if out is provided (e.g. a memory mapped array), the images are written there instead of kept in memory
+def read_particles_fft(fname, boxsz, out=None):
 	nptcl=EMUtil.get_image_count(fname)
-	projs=[]
-	hdrs=[]
 	e=EMData(fname, 0, True)
 	rawbox=e["nx"]
 	print("Loading {} particles of box size {}. shrink to {}".format(nptcl, rawbox, boxsz))
+	if out is None:
+		out=np.zeros((nptcl, 2, boxsz, boxsz//2+1), dtype=floattype)
+	hdrxfs=[]
 	for j in range(0,nptcl,1000):
 		print(f"{j}/{nptcl}      \r",end="")
 		sys.stdout.flush()
 		el=EMData.read_images(fname,range(j,min(j+1000,nptcl)))
+		projs=[]
 		for e in el:
 			if rawbox!=boxsz:
 				#### there is some fourier artifact with xform.scale. maybe worth switching to fft.resample?
@@ -217,19 +218,71 @@ def load_particles(fname, boxsz, shuffle=False):
 				#nx=e["nx"]
 				#e.clip_inplace(Region((nx-boxsz)//2,(nx-boxsz)//2, boxsz,boxsz))
 				#e.process_inplace("xform.scale", {"scale":boxsz/rawbox,"clip":boxsz})
-			hdrs.append(e.get_attr_dict())
+			if e.has_attr("xform.projection"):
+				x=e["xform.projection"].get_params("eman")
+				hdrxfs.append([x["az"],x["alt"],x["phi"], x["tx"], x["ty"]])
 			projs.append(e.numpy().copy())
+		
+		#### FT one chunk at a time so we never hold the full stack of real and complex images
+		cpx=np.fft.rfft2(np.array(projs)/1e3)
+		out[j:j+len(projs),0]=cpx.real
+		out[j:j+len(projs),1]=cpx.imag
+		
 	print(f"{nptcl}/{nptcl}")
-	projs=np.array(projs)/1e3
+	if len(hdrxfs)<nptcl: hdrxfs=None
+	else: hdrxfs=np.array(hdrxfs)
+	return out, hdrxfs
+
+#### Fourier particles cached on disk, keyed by the input file and box size
+##   the first call computes the cache, later runs with the same input just memory map it
+def load_particle_cache(fname, boxsz, cachedir):
+	st=os.stat(fname)
+	key="{},{},{},{}".format(os.path.abspath(fname), st.st_mtime_ns, st.st_size, boxsz)
+	cfile=os.path.join(cachedir, "ptclfft_{}_{}.npy".format(boxsz, hashlib.md5(key.encode()).hexdigest()))
+	xfile=cfile[:-4]+"_xf.npy"
+	
+	if os.path.isfile(cfile):
+		print("Using cached particles from {}".format(cfile))
+	else:
+		os.makedirs(cachedir, exist_ok=True)
+		nptcl=EMUtil.get_image_count(fname)
+		tmp="{}.{}.tmp.npy".format(cfile[:-4], os.getpid())
+		out=np.lib.format.open_memmap(tmp, mode="w+", dtype=floattype, shape=(nptcl, 2, boxsz, boxsz//2+1))
+		out, hdrxfs=read_particles_fft(fname, boxsz, out)
+		out.flush()
+		del out
+		if hdrxfs is not None: np.save(xfile, hdrxfs)
+		os.replace(tmp, cfile)
+		
+	data=np.load(cfile, mmap_mode="r")
+	if os.path.isfile(xfile): hdrxfs=np.load(xfile)
+	else: hdrxfs=None
+	return data, hdrxfs
+
+#### load particles from file and fourier transform them
+#### particles need to have their transform in file header or comment of list file
+##   will also shrink particles and do FT
+##   return Fourier images and transform matrix
+##   with cachedir, the Fourier images are memory mapped from the cache and returned in file order. 
+##   shuffling is then done by make_dataset when streaming the batches
+def load_particles(fname, boxsz, shuffle=False, cachedir=None):
+	
+	e=EMData(fname, 0, True)
+	rawbox=e["nx"]
+	if cachedir:
+		data, hdrxfs=load_particle_cache(fname, boxsz, cachedir)
+		shuffle=False
+	else:
+		data, hdrxfs=read_particles_fft(fname, boxsz)
 	
 	if shuffle:
-		rndidx=np.arange(len(projs))
+		rndidx=np.arange(len(data))
 		random.shuffle(rndidx)
-		projs=projs[rndidx]
-		hdrs=[hdrs[i] for i in rndidx]
+		data=data[rndidx]
+		if hdrxfs is not None:
+			hdrxfs=hdrxfs[rndidx]
 		
-	data_cpx=np.fft.rfft2(projs)
-	data_cpx=(data_cpx.real.astype(floattype), data_cpx.imag.astype(floattype))
+	data_cpx=(data[:,0], data[:,1])
 
 	xflst=False
 	if fname.endswith(".lst"):
@@ -239,16 +292,16 @@ def load_particles(fname, boxsz, shuffle=False):
 			xfs=[p["xform.projection"].get_params("eman") for p in info]
 			if shuffle:
 				xfs=[xfs[i] for i in rndidx]
+			xfsnp=np.array([[x["az"],x["alt"],x["phi"], x["tx"], x["ty"]] for x in xfs], dtype=floattype)
 			
-	if xflst==False and ("xform.projection" in hdrs[0]):
+	if xflst==False and hdrxfs is not None:
 		xflst=True
-		xfs=[p["xform.projection"].get_params("eman") for p in hdrs]
+		xfsnp=hdrxfs.astype(floattype)
 		
 	if xflst==False:
-		xfs=[Transform().get_params("eman") for p in hdrs]
+		xfsnp=np.zeros((len(data), 5), dtype=floattype)
 		print("No existing transform from particles...")
 		
-	xfsnp=np.array([[x["az"],x["alt"],x["phi"], x["tx"], x["ty"]] for x in xfs], dtype=floattype)
 	xfsnp[:,:3]=xfsnp[:,:3]*np.pi/180.
 	xfsnp[:,3:]/=float(rawbox)
 	
@@ -265,6 +318,65 @@ def get_clip(datacpx, newsz, clipid):
 		dc=[d[:,:,clipid[0]<s+1] for d in dc]
 	return [tf.constant(d) for d in dc]
 
+#### build the tf dataset of ([extra], real, imag, xform) batches
+##   data in memory goes through get_clip and is sliced as before
+##   memory mapped data (from --ptclcache) is read, clipped and prefetched one batch at a time,
+##   so the particles never need to fit in memory. rows selects a subset of the particles, 
+##   and shuffle (memory mapped data only) randomizes the batch order once 
+def make_dataset(datacpx, xfsnp, newsz, clipid, batchsz, extra=None, rows=None, shuffle=False):
+	if not isinstance(datacpx[0], np.memmap):
+		if rows is not None:
+			datacpx=[d[rows] for d in datacpx]
+			xfsnp=xfsnp[rows]
+			if extra is not None: extra=extra[rows]
+		dcpx=get_clip(datacpx, newsz, clipid)
+		if extra is None:
+			trainset=tf.data.Dataset.from_tensor_slices((dcpx[0], dcpx[1], xfsnp))
+		else:
+			trainset=tf.data.Dataset.from_tensor_slices((extra, dcpx[0], dcpx[1], xfsnp))
+		return trainset.batch(batchsz)
+	
+	if rows is None: rows=np.arange(len(xfsnp))
+	rows=np.array(rows)
+	if shuffle: np.random.shuffle(rows)
+	
+	ny=datacpx[0].shape[1]
+	if ny<=newsz:
+		yi=np.ones(ny, dtype=bool)
+		xi=np.ones(ny//2+1, dtype=bool)
+	else:
+		s=newsz//2
+		yi=clipid[1]<s
+		xi=clipid[0]<s+1
+	
+	def gen():
+		for i in range(0, len(rows), batchsz):
+			## sorted reads are much faster from a memory mapped file
+			ii=np.sort(rows[i:i+batchsz])
+			dc=[d[ii][:,yi][:,:,xi] for d in datacpx]
+			if extra is None:
+				yield dc[0], dc[1], xfsnp[ii]
+			else:
+				yield extra[ii], dc[0], dc[1], xfsnp[ii]
+	
+	spec=[tf.TensorSpec(shape=(None, np.sum(yi), np.sum(xi)), dtype=floattype)]*2
+	spec.append(tf.TensorSpec(shape=(None, xfsnp.shape[1]), dtype=floattype))
+	if extra is not None:
+		spec=[tf.TensorSpec(shape=(None,)+extra.shape[1:], dtype=extra.dtype)]+spec
+	
+	trainset=tf.data.Dataset.from_generator(gen, output_signature=tuple(spec))
+	nbatch=(len(rows)-1)//batchsz+1
+	trainset=trainset.apply(tf.data.experimental.assert_cardinality(nbatch))
+	return trainset.prefetch(2)
+
+#### number of batches in a dataset, without reading through it when tf knows the size
+def count_batches(trainset):
+	nbatch=int(trainset.cardinality())
+	if nbatch<0:
+		nbatch=0
+		for t in trainset: nbatch+=1
+	return nbatch
+
 #### compute fourier indices for image generation, clipping, and frc
 #### pass indices in a dictionary
 def set_indices_boxsz(boxsz, apix=0, return_freq=False):
@@ -402,8 +514,7 @@ def train_decoder(gen_model, trainset, params, options):
 	opt=tf.keras.optimizers.Adam(learning_rate=options.learnrate) 
 	wts=gen_model.trainable_variables
 	
-	nbatch=0
-	for t in trainset: nbatch+=1
+	nbatch=count_batches(trainset)
 	
 	for itr in range(options.niter):
 		cost=[]
@@ -620,8 +731,7 @@ def save_ptcls_xform(xfsnp, boxsz, options, scr):
 def calc_gradient(trainset, pts, params, options):
 	allgrds=[]
 	allscr=[]
-	nbatch=0
-	for t in trainset: nbatch+=1
+	nbatch=count_batches(trainset)
 	
 	for pjr,pji,xf in trainset:
 		pj_cpx=(pjr, pji)
@@ -655,8 +765,7 @@ def train_heterg(trainset, pts, encode_model, decode_model, params, options):
 	## initialize optimizer
 	opt=tf.keras.optimizers.Adam(learning_rate=options.learnrate)
 	wts=encode_model.trainable_variables + decode_model.trainable_variables
-	nbatch=0
-	for t in trainset: nbatch+=1
+	nbatch=count_batches(trainset)
 	
 	## Training
 	allcost=[]
@@ -762,6 +871,7 @@ def main():
 	parser.add_argument("--pas", type=str,help="choose whether to adjust position, amplitude, sigma. use 3 digit 0/1 input. default is 110, i.e. only adjusting position and amplitude", default="110")
 	parser.add_argument("--nmid", type=int,help="size of the middle layer", default=4)
 	parser.add_argument("--mask", type=str,help="remove points outside mask", default="")
+	parser.add_argument("--ptclcache", type=str,help="folder to cache the Fourier transformed particles. The cache is memory mapped and streamed in minibatches, so the particles do not need to fit in memory, and later runs on the same particles and box size skip the preprocessing.", default="")
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
 
 	(options, args) = parser.parse_args()
@@ -817,16 +927,14 @@ def main():
 			maxboxsz=options.maxboxsz=ceil(raw_boxsz*raw_apix*2/options.maxres)//2*2
 			print("using box size {}, max resolution {:.1f}".format(maxboxsz, options.maxres))
 			
-		data_cpx, xfsnp = load_particles(options.projs, maxboxsz, shuffle=True)
+		data_cpx, xfsnp = load_particles(options.projs, maxboxsz, shuffle=True, cachedir=options.ptclcache)
 		apix=raw_apix*raw_boxsz/maxboxsz
 		clipid=set_indices_boxsz(data_cpx[0].shape[1], apix, True)
 		
 		## training
 		if options.niter>0:
 			params=set_indices_boxsz(maxboxsz)
-			dcpx=get_clip(data_cpx, params["sz"], clipid)
-			trainset=tf.data.Dataset.from_tensor_slices((dcpx[0], dcpx[1], xfsnp))
-			trainset=trainset.batch(options.batchsz)
+			trainset=make_dataset(data_cpx, xfsnp, params["sz"], clipid, options.batchsz, shuffle=True)
 		
 			train_decoder(gen_model, trainset, params, options)
 			pout=gen_model(tf.zeros((1,options.nmid), dtype=floattype)).numpy()[0]
@@ -867,7 +975,7 @@ def main():
 			maxboxsz=options.maxboxsz=ceil(raw_boxsz*raw_apix*2/options.maxres)//2*2
 			print("using box size {}, max resolution {:.1f}".format(maxboxsz, options.maxres))
 			
-		data_cpx, xfsnp = load_particles(options.ptclsin,maxboxsz,shuffle=False)
+		data_cpx, xfsnp = load_particles(options.ptclsin,maxboxsz,shuffle=False, cachedir=options.ptclcache)
 		apix=raw_apix*raw_boxsz/maxboxsz
 		clipid=set_indices_boxsz(data_cpx[0].shape[1], apix, True)
 		
@@ -906,7 +1014,6 @@ def main():
 	if options.ptclsin and options.heter:
 		pts=tf.constant(pts[None,:,:])
 		params=set_indices_boxsz(maxboxsz)
-		dcpx=get_clip(data_cpx, params["sz"], clipid)
 		
 		#### calculate d(FRC)/d(GMM) for each particle
 		##   this will be the input for the deep network in place of the particle images
@@ -920,8 +1027,7 @@ def main():
 			print("Gradient shape: ", allgrds.shape) 
 			
 		else:
-			trainset=tf.data.Dataset.from_tensor_slices((dcpx[0], dcpx[1], xfsnp))
-			trainset=trainset.batch(bsz)
+			trainset=make_dataset(data_cpx, xfsnp, params["sz"], clipid, bsz)
 			allscr, allgrds=calc_gradient(trainset, pts, params, options )
 			
 			## save to hdf file
@@ -945,8 +1051,7 @@ def main():
 		
 		#### actual training
 		ptclidx=allscr>-1
-		trainset=tf.data.Dataset.from_tensor_slices((allgrds[ptclidx], dcpx[0][ptclidx], dcpx[1][ptclidx], xfsnp[ptclidx]))
-		trainset=trainset.batch(bsz)
+		trainset=make_dataset(data_cpx, xfsnp, params["sz"], clipid, bsz, extra=allgrds, rows=np.where(ptclidx)[0])
 		
 		train_heterg(trainset, pts, encode_model, decode_model, params, options)
 		
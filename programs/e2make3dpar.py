@@ -321,27 +321,22 @@ def main():
 				tid=etc.send_task(task)
 				tids.append(tid)
 
-			while 1:
-				st_vals = etc.check_task(tids)
-				E2progress(logger, np.mean(st_vals)/100.)
-				#print("{:.1f}/{} finished".format(np.mean(st_vals), 100))
-				#print(tids)
-				if np.min(st_vals) == 100: break
-				time.sleep(5)
-
-			#dics=[0]*nptcl
-			
 			output=EMData(padvol[0], padvol[1], padvol[2])
 			normvol=EMData(padvol[0]//2+1, padvol[1], padvol[2])
 			output.to_zero()
 			output.do_fft_inplace()
-			
 			normvol.to_zero()
-			for i in tids:
-				threed, norm=etc.get_results(i)[1]
+
+			# partial reconstructions are merged as each task finishes, so we never hold more than one at a time
+			def merge(ret):
+				threed, norm=ret
 				threed.process_inplace("math.multamplitude", {"amp":norm})
 				output.add(threed)
 				normvol.add(norm)
+
+			if not etc.reduce_results(tids, merge, lambda f:E2progress(logger, f)):
+				print("ERROR: reconstruction task failed, no output written")
+				sys.exit(1)
 				
 			normvol.process_inplace("math.reciprocal")
 			output.process_inplace("math.multamplitude", {"amp":normvol})
@@ -551,6 +546,9 @@ def initialize_data(inputfile,inputmodel,tltfile,pad,no_weights,preprocess):
 			#if lstinfo[2]:
 				#getlst=True
 
+		if not getlst:
+			hdrs=load_header_catalog(inputfile,["xform.projection","model_id","ptcl_repr","class_qual"])
+		
 		for i in range(n_input):
 			
 			#else : tmp=get_processed_image(inputfile,i,-1,preprocess,pad)
@@ -591,9 +589,9 @@ def initialize_data(inputfile,inputmodel,tltfile,pad,no_weights,preprocess):
 
 					data.append(elem)
 			else:
-				tmp.read_image(inputfile,i,True)			
-				try: elem={"xform":tmp["xform.projection"]}
-				except : continue
+				tmp={k:v[i] for k,v in hdrs.items()}
+				if tmp["xform.projection"] is None : continue
+				elem={"xform":tmp["xform.projection"]}
 					#raise Exception,"Image %d doesn't have orientation information in its header"%i
 
 				# skip any particles targeted at a different model
@@ -42,6 +42,8 @@ import sklearn.decomposition as skdc
 import time
 import os
 import sys
+import queue
+import threading
 
 def main():
 	progname = os.path.basename(sys.argv[0])
@@ -49,7 +51,8 @@ def main():
 This too provides a variety of dimensionality reduction methods. This new version
 uses scikit.learn, which provides a greater variety of algorithms, but must load 
 all data into memory. If working with a large file, you may want to consider using
---step to operate on a limited subset of the data.
+--step to operate on a limited subset of the data, or --chunk to perform an incremental
+PCA which only holds a few chunks of images in memory at a time.
 
 If specified, [reprojections] will contain projections of the full input stack
 (ignoring --step) into the basis subspace represented as a single image. This 
@@ -81,6 +84,7 @@ handled this way."""
 	parser.add_argument("--mask",type=int,help="Mask radius, negative values imply ny/2+1+mask, --mask=0 disables, --maskfile overrides",default=0)
 	parser.add_argument("--simmx",type=str,help="Will use transformations from simmx on each particle prior to analysis")
 	parser.add_argument("--normalize",action="store_true",help="Perform a careful normalization of input images before MSA. Otherwise normalization is not modified until after mean subtraction.",default=False)
+	parser.add_argument("--chunk",type=int,help="Stream the data through an incremental PCA in chunks of this many images instead of reading everything into memory. Only for --mode=pca. default=0 (disabled)",default=0)
 	parser.add_argument("--step",type=str,default="0,1",help="Specify <init>,<step>[,last]. Processes only a subset of the input data. For example, 0,2 would process only the even numbered particles")
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higher number means higher level of verboseness")
@@ -92,6 +96,10 @@ handled this way."""
 	(options, args) = parser.parse_args()
 	if len(args)<2 : parser.error("Input and output filenames required")
 
+	if options.chunk>0 and options.mode!="pca" : parser.error("--chunk is only supported with --mode=pca")
+	if options.chunk>0 and options.chunk<options.nbasis : parser.error("--chunk must be at least --nbasis")
+	if options.chunk>0 and options.nomeansub : parser.error("--chunk always subtracts the mean, it cannot be used with --nomeansub")
+
 	logid=E2init(sys.argv,options.ppid)
 
 	if options.verbose>0 : print("Beginning MSA")
@@ -129,27 +137,39 @@ handled this way."""
 	n=(step[2]-step[0])//step[1]
 	nval=int(mask["square_sum"])
 #	print(args[0],n,nval)
-	if options.verbose or n*nval>500000000: print("Estimated memory usage (mb): ",n*nval*4/2**20)
+	if options.chunk>0:
+		if options.verbose: print("Estimated memory usage (mb): ",min(n,options.chunk)*nval*4*3/2**20)
+	else:
+		if options.verbose or n*nval>500000000: print("Estimated memory usage (mb): ",n*nval*4/2**20)
 	
-	# Read all image data into numpy array
-	if options.simmx : data=simmx_get(args[0],options.simmx,mask,step)
-	else : data=normal_get(args[0],mask,step)
-	if options.verbose: print("Data read complete")
+		# Read all image data into numpy array
+		if options.simmx : data=simmx_get(args[0],options.simmx,mask,step)
+		else : data=normal_get(args[0],mask,step)
+		if options.verbose: print("Data read complete")
 	
-	if options.normalize:
-		for i in range(len(data)): data[i]/=np.linalg.norm(data[i])
+		if options.normalize:
+			for i in range(len(data)): data[i]/=np.linalg.norm(data[i])
+
+		mean=np.mean(data,0)
+		if not options.nomeansub:
+			for i in range(len(data)): data[i]-=mean
+		#from_numpy(mean).process("misc.mask.pack",{"mask":mask,"unpack":1}).write_image(args[1],0)
 
 	# first output image is the mean of the input vectors, which has been subtracted from each vector
 	try: os.unlink(args[1])
 	except: pass
-	mean=np.mean(data,0)
-	if not options.nomeansub:
-		for i in range(len(data)): data[i]-=mean
-	#from_numpy(mean).process("misc.mask.pack",{"mask":mask,"unpack":1}).write_image(args[1],0)
 	
 	shift=0
 	# This is where the actual action takes place!
-	if options.mode=="pca":
+	if options.chunk>0:
+		# IncrementalPCA always centers the data, the mean is accumulated along the way
+		msa=skdc.IncrementalPCA(n_components=options.nbasis)
+		for start,data in read_chunks(args[0],mask,step,options.chunk,options.simmx,options.nbasis):
+			if options.verbose>1: print("fitting {}-{}".format(start,start+len(data)))
+			if options.normalize: data/=np.linalg.norm(data,axis=1)[:,None]
+			msa.partial_fit(data)
+		mean=msa.mean_
+	elif options.mode=="pca":
 		msa=skdc.PCA(n_components=options.nbasis)
 #		print(data.shape)
 		msa.fit(data)
@@ -251,20 +271,18 @@ handled this way."""
 			images=args[0]
 	
 		if options.verbose: print("Reprojecting input data into subspace")
-		chunksize=min(max(2,250000000//nval),step2[2])		# limiting memory usage for this step to ~2G
+		if options.chunk>0: chunksize=options.chunk
+		else: chunksize=min(max(2,250000000//nval),step2[2])		# limiting memory usage for this step to ~2G
 		out=EMData(options.nbasis,step2[2])		# we hold the full set of reprojections in memory, though
-		start=0
-		while (start<step2[2]):
-			stept=[start,1,min(step2[2],start+chunksize)]
-			if options.verbose: print(stept)
+		
+		# the next chunk is read in the background while the current one is projected
+		for start,chunk in read_chunks(images,mask,[0,1,step2[2]],chunksize,options.simmx):
+			if options.verbose: print([start,1,start+len(chunk)])
 			
-			# read a chunk of data
-			if options.simmx : chunk=simmx_get(images,options.simmx,mask,stept)
-			else : chunk=normal_get(images,mask,stept)
 			if shift!=0 : 
 				chunk+=shift					# for methods requiring positivity
 				if chunk.min()<=0 :
-					print("ERROR: Results invalid, negative values. Shifting to prevent crash. Chunk ",stept," has mean=",chunk.mean(),"std=",chunk.std(),"min=",chunk.min())
+					print("ERROR: Results invalid, negative values. Shifting to prevent crash. Chunk ",[start,1,start+len(chunk)]," has mean=",chunk.mean(),"std=",chunk.std(),"min=",chunk.min())
 					chunk+= -chunk.min()
 			
 			proj=msa.transform(chunk)		# into subspace
@@ -272,7 +290,6 @@ handled this way."""
 				for i in range(len(proj)): proj[i]/=np.linalg.norm(proj[i])
 			im=from_numpy(proj.copy())
 			out.insert_clip(im,(0,start,0))
-			start+=chunksize
 			
 		# write results
 		out.write_image(args[2],0)
@@ -281,6 +298,34 @@ handled this way."""
 	if options.mode not in ("pca","sparsepca","fastica") :
 		print("WARNING: While projection vectors are reliable, use of modes other than PCA or ICA may involve nonlinarities, meaning the 'Eigenimages' may not be interpretable in the usual way.")
 
+def read_chunks(images,mask,step,chunksize,simmxpath=None,nmin=1):
+	"""Generator over the masked images selected by step, as (first row, array) pairs of at most chunksize rows (plus
+	a short tail if needed to keep every chunk at least nmin rows). Chunks are read in a separate thread, so at most
+	two chunks are waiting in memory while the caller works on the current one."""
+
+	n=(step[2]-step[0])//step[1]
+	starts=list(range(0,n,chunksize))+[n]
+	if len(starts)>2 and starts[-1]-starts[-2]<nmin : del starts[-2]
+
+	jobs=queue.Queue(2)
+	def reader():
+		try:
+			for k0,k1 in zip(starts[:-1],starts[1:]):
+				stept=[step[0]+k0*step[1],step[1],step[0]+k1*step[1]]
+				if simmxpath : jobs.put((k0,simmx_get(images,simmxpath,mask,stept)))
+				else : jobs.put((k0,normal_get(images,mask,stept)))
+		except Exception as e:
+			jobs.put((-1,e))
+
+	thrd=threading.Thread(target=reader)
+	thrd.daemon=True
+	thrd.start()
+	for i in range(len(starts)-1):
+		k0,data=jobs.get()
+		if k0<0 : raise data
+		yield k0,data
+	thrd.join()
+
 def simmx_get(images,simmxpath,mask,step):
 	"""returns an array of transformed masked images as arrays for PCA"""
 
@@ -291,7 +336,7 @@ def simmx_get(images,simmxpath,mask,step):
 	ret=EMData(int(mask["square_sum"]),n)
 	for i in range(n):
 		im=EMData(images,i*step[1]+step[0])
-		xf=get_xform(i,simmx)
+		xf=get_xform(i*step[1]+step[0],simmx)
 		im.transform(xf)
 		imm=im.process("misc.mask.pack",{"mask":mask})
 		ret.insert_clip(imm,(0,i,0))
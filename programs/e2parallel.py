@@ -42,19 +42,12 @@ import traceback
 
 import sys
 from EMAN2 import *
-from EMAN2PAR import EMMpiClient
+from EMAN2PAR import EMMpiClient, load_task_module as load_module, share_payloads, restore_payloads
 
 debug=False
 logid=None
 
 
-def load_module(module):
-	fname, cls=module.split('.')
-	#print("import {} from {}".format(cls, fname))
-	sys.path.append(os.path.join(e2getinstalldir(),"bin"))
-	mod=__import__(fname, fromlist=[cls])
-	setattr(sys.modules["__main__"], cls, getattr(mod,cls))
-
 def main():
 	
 	usage=" "
@@ -63,6 +56,7 @@ def main():
 	parser.add_argument("--mode", type=str,help="choose from thread and mpi",default="thread")
 	parser.add_argument("--taskin", type=str,help="Internal use only. Used when executing local threaded tasks.")
 	parser.add_argument("--taskout", type=str,help="Internal use only. Used when executing local threaded tasks.")
+	parser.add_argument("--payloaddir", type=str,help="Internal use only. Directory for large payloads when executing local threaded tasks.",default=None)
 	parser.add_argument("--loadmodule", type=str,help="load module",default="")
 	parser.add_argument("--usethreads", type=int,help="max thread to use. only used for producing occupancy in mpi mode. default is the same as threads/mpi option given",default=-1)
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
@@ -84,7 +78,9 @@ def main():
 
 		task=load(open(options.taskin,"rb"))
 		try: 
+			task.data=restore_payloads(task.data)
 			ret=task.execute(empty_func)
+			if options.payloaddir!=None : ret=share_payloads(ret,options.payloaddir)
 			dump(ret,open(options.taskout,"wb"),-1)
 		except:
 			#### print to both stdout and text file
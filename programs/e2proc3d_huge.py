@@ -35,16 +35,33 @@ from EMAN2 import *
 import sys
 from math import *
 import os.path
+import queue
+import threading
+import traceback
+
+# processors which only look at one voxel at a time, and can be applied to slabs with no overlap
+POINTPROCESSORS={"math.absvalue","math.floor","math.reciprocal","math.pow","math.squared","math.sqrt","math.linear","math.exp",
+	"math.log","math.finite","math.setbits","threshold.notzero","threshold.belowtozero","threshold.rangetozero","threshold.belowtominval",
+	"threshold.belowtozero_cut","threshold.binary","threshold.binaryrange"}
+
+# Fourier filters, the overlap is a multiple of the real-space width of the filter (1/cutoff)
+FILTERWIDTH={"filter.lowpass.gauss":2.0,"filter.highpass.gauss":2.0,"filter.bandpass.gauss":2.0,"filter.lowpass.tanh":4.0,"filter.highpass.tanh":4.0,
+	"filter.bandpass.tanh":4.0,"filter.lowpass.butterworth":4.0,"filter.highpass.butterworth":4.0,"filter.lowpass.tophat":6.0,"filter.highpass.tophat":6.0,
+	"filter.bandpass.tophat":6.0}
 
 def main():
 	progname = os.path.basename(sys.argv[0])
 	usage = progname + """ [options] <inputfile>
 	This is a specialized version of e2proc3d.py targeted at performing a limited set of operations on
 very large volumes in-place (such as tomograms) which may not readily fit into system memory. Operations are 
-performed by reading portions of the image, processing, then writing the portion back to disk. Unlike e2proc3d.py
-you may pass only a single operation to the program for each invocation, or behavior will be undefined. It will 
-process a single volume in a single file in-place.
+performed by reading slabs of the image along Z, processing, then writing the slab back to disk. Each slab is read with
+enough overlap (halo) with its neighbors for the requested processors, so the results match processing the whole volume
+except within the halo distance of the top and bottom of the volume. Operations are applied in the order
+--process (in the order given), --mult, --multfile, --add. It will process a single volume in a single file in-place.
 
+Only processors which can be applied locally are accepted: point-wise math/threshold processors and the Fourier
+lowpass/highpass/bandpass filters. Other processors (eg - normalization, masks) need the full volume, but may be
+forced with --halo if you know how much context they need.
 """
 	parser = EMArgumentParser(usage=usage,version=EMANVERSION)
 	
@@ -64,27 +81,167 @@ process a single volume in a single file in-place.
 								help="Adds a constant 'f' to the densities")
 
 	parser.add_argument("--trans", metavar="dx,dy,dz", type=str, default=0, help="Translate map by dx,dy,dz ")
+	parser.add_argument("--halo", type=int, help="Number of slices of overlap between slabs, overriding the value determined from the processors. Required for processors not known to work on slabs.",default=-1)
+	parser.add_argument("--mem", type=int, help="Approximate memory to use in MB, this determines the slab thickness. default=4096",default=4096)
+	parser.add_argument("--threads", type=int, help="Number of slabs to process in parallel. default=4",default=4)
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higher number means higher level of verboseness")
 		
 	(options, args) = parser.parse_args()
 
-	print("Sorry, this program still under development. Not functional yet.")
-	sys.exit(1)
+	if len(args)!=1 :
+		print("ERROR: Please specify a single volume to process in-place")
+		sys.exit(1)
+
+	if options.streaksubtract!=None or options.trans!=0 :
+		print("ERROR: --streaksubtract and --trans are not supported yet")
+		sys.exit(1)
 
+	fsp=args[0]
 	try:
-		hdr=EMData(args[1],0,1)
+		hdr=EMData(fsp,0,True)
 	except:
 		print("ERROR: Can't read input file header")
 		sys.exit(1)
+	nx,ny,nz=hdr["nx"],hdr["ny"],hdr["nz"]
 
+	procs=[parsemodopt(p) for p in options.process] if options.process else []
+	if options.halo>=0 : halo=options.halo
+	else:
+		halo=0
+		for name,params in procs:
+			h=processor_halo(name,params,hdr["apix_x"])
+			if h==None:
+				print("ERROR: {} can't be applied to slabs of the volume. Use --halo to force it.".format(name))
+				sys.exit(1)
+			halo+=h
+	halo=min(halo,nz)
 
-	if options.mediansubtract!=None :
-		pass  # Added this to make python happy
-		
+	multfiles=options.multfile if options.multfile else []
+	for m in multfiles:
+		mhdr=EMData(m,0,True)
+		if (mhdr["nx"],mhdr["ny"],mhdr["nz"])!=(nx,ny,nz) :
+			print("ERROR: {} is not the same size as {}".format(m,fsp))
+			sys.exit(1)
+
+	# each slab in flight needs its own memory, with room for a copy during processing
+	nslots=options.threads+2
+	slicebytes=nx*ny*4.0
+	thick=int(options.mem*1048576.0/(nslots*2*slicebytes))-2*halo
+	if thick<max(halo,1) :
+		print("ERROR: --mem {} is too small for slabs of {}x{} with a halo of {}, at least {} MB is needed".format(options.mem,nx,ny,halo,int(ceil(nslots*2*slicebytes*max(3*halo,1)/1048576.0))))
+		sys.exit(1)
+	thick=min(thick,nz)
+	slabs=[(z,min(thick,nz-z)) for z in range(0,nz,thick)]
+	if options.verbose : print("{} slabs of {} slices with a halo of {}, using {} threads".format(len(slabs),thick,halo,options.threads))
+
+	logid=E2init(sys.argv,options.ppid)
+
+	process_slabs(fsp,slabs,halo,procs,options.mult,multfiles,options.add,options.threads,nslots,logid,options.verbose)
+
+	E2end(logid)
+
+def processor_halo(name,params,apix):
+	"""Returns the number of slices of context a processor needs on each side of a slab, or None if the processor
+	can't safely be applied to part of a volume"""
+
+	if name in POINTPROCESSORS : return 0
+	if name not in FILTERWIDTH : return None
+
+	cutoffs=[]
+	for k in ("cutoff_abs","cutoff_low","cutoff_high"):
+		if k in params : cutoffs.append(params[k])
+	if "cutoff_freq" in params : cutoffs.append(params["cutoff_freq"]*apix)
+	if "cutoff_pixels" in params and "nx" in params : cutoffs.append(params["cutoff_pixels"]/params["nx"])
+	cutoffs=[c for c in cutoffs if c>0]
+	if len(cutoffs)==0 : return None
+
+	return int(ceil(FILTERWIDTH[name]/min(cutoffs)))
+
+def process_slabs(fsp,slabs,halo,procs,mult,multfiles,add,nthreads,nslots,logid=None,verbose=0):
+	"""Streams the slabs of fsp through a reader -> worker threads -> writer pipeline, writing results in-place.
+	At most nslots slabs are in memory at once. Since the file is modified in place, a slab is only written after its
+	neighbor above has been read, so every halo is read from unmodified data. This requires the slabs to be at least as
+	thick as the halo"""
+
+	hdr=EMData(fsp,0,True)
+	nx,ny,nz=hdr["nx"],hdr["ny"],hdr["nz"]
+	iolock=threading.Lock()			# image I/O isn't thread-safe
+	slots=threading.Semaphore(nslots)
+	readcond=threading.Condition()
+	nread=[0]
+	readfail=[None]				# slab the reader failed on
+	todo=queue.Queue(nthreads)
+	done=queue.Queue(0)
+
+	def reader():
+		i=0
+		try:
+			for i,(z,n) in enumerate(slabs):
+				slots.acquire()
+				z0=max(z-halo,0)
+				z1=min(z+n+halo,nz)
+				with iolock:
+					img=EMData(fsp,0,False,Region(0,0,z0,nx,ny,z1-z0))
+					mults=[EMData(m,0,False,Region(0,0,z,nx,ny,n)) for m in multfiles]
+				todo.put((i,img,z-z0,mults))
+				with readcond:
+					nread[0]+=1
+					readcond.notify_all()
+		except:
+			traceback.print_exc()
+			done.put((i,None))
+			with readcond:
+				readfail[0]=i
+				readcond.notify_all()
+		finally:
+			for t in range(nthreads): todo.put(None)
+
+	def worker():
+		while True:
+			job=todo.get()
+			if job==None : return
+			i,img,off,mults=job
+			try:
+				for name,params in procs: img.process_inplace(name,params)
+				z,n=slabs[i]
+				if off>0 or img["nz"]>n : img=img.get_clip(Region(0,0,off,nx,ny,n))
+				if mult!=None : img.mult(mult)
+				for m in mults: img.mult(m)
+				if add!=None : img.add(add)
+				done.put((i,img))
+			except:
+				traceback.print_exc()
+				done.put((i,None))
+
+	thrds=[threading.Thread(target=reader)]+[threading.Thread(target=worker) for i in range(nthreads)]
+	for t in thrds:
+		t.daemon=True
+		t.start()
+
+	def failed(j):
+		print("ERROR: processing failed on slab {}. {} is partially processed.".format(j,fsp))
+		sys.exit(1)
+
+	# the writer runs in this thread, writing slabs in order
+	pending={}
+	for i,(z,n) in enumerate(slabs):
+		while i not in pending:
+			j,img=done.get()
+			if img==None : failed(j)
+			pending[j]=img
+		img=pending.pop(i)
+		with readcond:
+			while nread[0]<min(i+2,len(slabs)) and readfail[0]==None : readcond.wait()
+		if readfail[0]!=None : failed(readfail[0])
+		with iolock:
+			img.write_image(fsp,0,IMAGE_UNKNOWN,False,Region(0,0,z,nx,ny,n))
+		img=None
+		slots.release()
+		if logid : E2progress(logid,(i+1)/float(len(slabs)))
+		if verbose : print("{}/{} slabs written".format(i+1,len(slabs)))
 
-def findmode(img) :
-	"""This computes something akin to the mode"""
+	for t in thrds: t.join()
 
 
 if __name__ == "__main__":
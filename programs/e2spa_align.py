@@ -8,6 +8,7 @@ from EMAN2jsondb import JSTask
 from EMAN2PAR import EMTaskCustomer
 from scipy.optimize import minimize
 import gc
+import hashlib
 #from memory_profiler import profile
 
 def main():
@@ -19,7 +20,7 @@ def main():
 	parser.add_argument("--ptclout", type=str,help="particle output", default=None)
 	parser.add_argument("--ref", type=str,help="reference input", default=None)
 	parser.add_argument("--keep", type=float,help="propotion of tilts to keep. default is 0.8", default=0.8)
-	parser.add_argument("--parallel", type=str,help="Thread/mpi parallelism to use. Default is thread:12", default="thread:12")
+	parser.add_argument("--parallel", type=str,help="Thread/pool/mpi parallelism to use. Default is thread:12", default="thread:12")
 
 	parser.add_argument("--debug", action="store_true", default=False ,help="Turn on debug mode. This will only process a small subset of the data")
 	parser.add_argument("--maxshift", type=int,help="maximum shift allowed", default=-1)
@@ -29,6 +30,7 @@ def main():
 	parser.add_argument("--maxres", type=float,default=-1, help="max resolution for cmp")
 	parser.add_argument("--minrespx", type=int,default=4, help="skip the first x pixel in fourier space")
 	parser.add_argument("--sym", type=str,help="symmetry. ", default="c1")
+	parser.add_argument("--projcache", type=str,help="folder to store the coarse projections of the reference so they are computed only once for all tasks. default is None (compute once per task)", default=None)
 	parser.add_argument("--ppid", type=int,help="ppid...", default=-1)
 	#parser.add_argument("--nkeep", type=int,help="", default=1)
 	parser.add_argument("--verbose","-v", type=int,help="Verbose", default=0)
@@ -46,6 +48,9 @@ def main():
 	if options.maxshift<0:
 		options.maxshift=bxsz//2
 	
+	if options.projcache:
+		os.makedirs(options.projcache, exist_ok=True)
+	
 	print("Initializing parallelism...")
 	etc=EMTaskCustomer(options.parallel, module="e2spa_align.SpaAlignTask")	
 	num_cpus = etc.cpu_est()
@@ -76,14 +81,13 @@ def main():
 		tids.append(tid)
 	
 	while 1:
-		st_vals = etc.check_task(tids)
+		st_vals = etc.wait_task(tids,5)
 		if -100 in st_vals:
 			print("Error occurs in parallelism. Exit")
 			return
 		E2progress(logid, np.mean(st_vals)/100.)
 		
 		if np.min(st_vals) == 100: break
-		time.sleep(5)
 	
 	output=[None]*nptcl
 	for i in tids:
@@ -103,6 +107,70 @@ def run(cmd):
 	launch_childprocess(cmd)
 	
 
+class ProjBank(object):
+	"""Fourier projections of a (fourierorigin.tocenter) reference in a fixed list of orientations, computed once
+	and reused for every particle. If cachefile is given, the projections are stored in that .npy file and
+	memory mapped by any other task using the same reference and sampling."""
+	def __init__(self, ref, xfs, cachefile=None):
+		self.xfs=xfs
+		pj=ref.project('gauss_fft',{"transform":xfs[0], "returnfft":1})
+		self.hdr={k:v for k,v in pj.get_attr_dict().items() if k not in ("nx","ny","nz")}
+		shape=(len(xfs), pj["ny"], pj["nx"])
+		
+		self.data=None
+		if cachefile and os.path.isfile(cachefile):
+			try:
+				self.data=np.load(cachefile, mmap_mode="r")
+				if self.data.shape!=shape: self.data=None
+			except:
+				self.data=None
+			
+		if self.data is None:
+			self.data=np.zeros(shape, dtype=np.float32)
+			for i,xf in enumerate(xfs):
+				self.data[i]=ref.project('gauss_fft',{"transform":xf, "returnfft":1}).numpy()
+			
+			if cachefile:
+				## write to a temporary file first so other tasks never see a partial bank
+				tmp="{}.{}.tmp.npy".format(cachefile[:-4], os.getpid())
+				np.save(tmp, self.data)
+				os.replace(tmp, cachefile)
+		
+		self.rings=frc_rings(shape[1])
+		
+	def get(self, i):
+		pj=from_numpy(np.array(self.data[i]))
+		pj.set_attr_dict(self.hdr)
+		return pj
+	
+	def score(self, img, mxsft, x0, x1, wt=None):
+		"""Same score as test_rot in SpaAlignTask for every projection in the bank. The translational search is
+		done per projection, the FSC of all shifted projections is computed at once.
+		Returns the list of scores and the list of translated transforms."""
+		pjs=np.zeros(self.data.shape, dtype=np.float32)
+		xfs=[]
+		for i,x in enumerate(self.xfs):
+			pj=self.get(i)
+			ccf=img.calc_ccf(pj)
+			pos=ccf.calc_max_location_wrap(mxsft, mxsft, 0)
+			xf=Transform(x)
+			xf.translate(pos[0], pos[1],0)
+			pj.process_inplace("xform", {"tx":pos[0], "ty":pos[1]})
+			pjs[i]=pj.numpy()
+			xfs.append(xf)
+		
+		fsc=calc_frc_batch(img, pjs, self.rings)[:, x0:x1]
+		if wt is None:
+			wt=np.ones(fsc.shape[1])
+		scr=-np.sum(fsc*wt, axis=1)/np.sum(wt)
+		return scr.tolist(), xfs
+
+def proj_bank_file(path, ref, ss, sym, astep):
+	"""cache file name for the coarse projection bank. changes whenever the reference file or the sampling changes"""
+	st=os.stat(ref)
+	key="{},{},{},{},{},{:.4f}".format(os.path.abspath(ref), st.st_mtime_ns, st.st_size, ss, sym, astep)
+	return os.path.join(path, "projbank_{}.npy".format(hashlib.md5(key.encode()).hexdigest()))
+
 class SpaAlignTask(JSTask):
 	
 	
@@ -169,9 +237,10 @@ class SpaAlignTask(JSTask):
 		ssrg[:2]=ssrg[:2]*3/2
 		ssrg=ssrg.tolist()
 		
-		astep=7.4
+		astep0=astep=7.4
 		sym=Symmetries.get(options.sym)
 		xfcrs=sym.gen_orientations("saff",{"delta":astep,"phitoo":astep,"inc_mirror":1})
+		bank=None
 		
 		for infoi, infos in enumerate(data["info"]):
 			ii=infos[0]
@@ -234,12 +303,14 @@ class SpaAlignTask(JSTask):
 					print(ss, npos, astep)
 					
 				if si==0:
+					if bank==None:
+						if options.projcache:
+							cache=proj_bank_file(options.projcache, data["ref"], ss, options.sym, astep0)
+						else:
+							cache=None
+						bank=ProjBank(refsmall, xfcrs, cache)
 					
-					newxfs=[]
-					for xf in xfcrs:
-						scr, x=test_rot(xf, True)
-						score.append(scr)
-						newxfs.append(x)
+					score, newxfs=bank.score(imgsmall, mxsft, options.minrespx, int(ss*.4), ctfcv[options.minrespx:int(ss*.4)] if ctfwt else None)
 				
 				else:
 					xfs=newxfs
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from EMAN2 import *
 import numpy as np
+import queue
 from EMAN2jsondb import JSTask
 from scipy.signal import argrelextrema
 
@@ -160,23 +161,22 @@ def main():
 		tid=etc.send_task(task)
 		tids.append(tid)
 
-	while 1:
-		st_vals = etc.check_task(tids)
-		E2progress(logger, .5+.5*np.mean(st_vals)/100.)
-		if np.min(st_vals) == 100: break
-		time.sleep(5)
-		
 	output=EMData(padvol, padvol, padvol)
 	normvol=EMData(padvol//2+1, padvol, padvol)
 	output.to_zero()
 	output.do_fft_inplace()
 	normvol.to_zero()
 	
-	for i in tids:
-		threed, norm=etc.get_results(i)[1]
+	# partial reconstructions are merged as each task finishes, so we never hold more than one at a time
+	def merge(ret):
+		threed, norm=ret
 		threed.process_inplace("math.multamplitude", {"amp":norm})
 		output.add(threed)
 		normvol.add(norm)
+
+	if not etc.reduce_results(tids, merge, lambda f:E2progress(logger, .5+.5*f)):
+		print("ERROR: reconstruction task failed, no output written")
+		sys.exit(1)
 		
 	normvol.process_inplace("math.reciprocal")
 	output.process_inplace("math.multamplitude", {"amp":normvol})
@@ -280,51 +280,89 @@ def initialize_data(inputfile, options):
 	return data
 
 
-def reconstruct(data,recon,pad,ref=None):
+READCHUNK=64		# particles per read_images call in read_particles
 
-	for i,elem in enumerate(data):
-		wt=elem["weight"]
-		if wt<=0:
-			continue
-		
-		img=EMData(elem["src"],elem["idx"])
-		if img["sigma"]==0 : continue
+def read_particles(data,que,nconsumer,chunk=READCHUNK,failed=None):
+	"""Reader thread for reconstruct. Particles are grouped by source file and read chunk at a time in sorted
+	index order, then queued as (elem,image) pairs. que should be bounded, so this only reads ahead a fixed number
+	of particles. One None is queued for each of nconsumer insert threads at the end, or as soon as an error has
+	been reported in the list failed (read errors are appended to it too)."""
+	try:
+		bysrc={}
+		for elem in data:
+			if elem["weight"]<=0 : continue
+			bysrc.setdefault(elem["src"],[]).append(elem)
 	
-		img-=img.get_edge_mean()
-		img.clip_inplace(Region((img["nx"]-pad)//2, (img["ny"]-pad)//2, pad, pad))
+		for src in sorted(bysrc.keys()):
+			elems=sorted(bysrc[src],key=lambda e:e["idx"])
+			for i in range(0,len(elems),chunk):
+				if failed : return
+				els=elems[i:i+chunk]
+				imgs=EMData.read_images(src,[e["idx"] for e in els])
+				for elem,img in zip(els,imgs): que.put((elem,img))
+	except:
+		if failed!=None : failed.append(traceback.format_exc())
+		else: raise
+	finally:
+		for i in range(nconsumer): que.put(None)
+
+def reconstruct(que,recon,pad,ref=None,failed=None):
+	"""Insert thread. Takes (elem,image) pairs from que until it gets None. The padded image is built in a buffer
+	allocated once per thread rather than once per particle. If an insertion raises, the traceback is appended to
+	failed and the rest of the queue is drained up to our None, so the reader never blocks on a full queue"""
+	padimg=EMData(pad,pad)
+	while True:
+		job=que.get()
+		if job is None : break
+		try: insert_particle(job,recon,pad,padimg)
+		except:
+			if failed!=None : failed.append(traceback.format_exc())
+			while que.get() is not None : pass
+			break
+
+	return
+
+def insert_particle(job,recon,pad,padimg):
+	"""Inserts one (elem,image) pair from read_particles into recon, using padimg as the padding buffer"""
+	elem,img=job
+	wt=elem["weight"]
+	if img["sigma"]==0 : return
+
+	img-=img.get_edge_mean()
+	padimg.to_zero()
+	padimg.insert_clip(img,(-((img["nx"]-pad)//2), -((img["ny"]-pad)//2)))
+	ptcl=padimg
+
+	if ("defocus" in elem) and abs(elem["defocus"])>1e-4 and img.has_attr("ctf"):
+		ctf=img["ctf"]
+		fft1=ptcl.do_fft()
+		flipim=fft1.copy()
+		ctf.compute_2d_complex(flipim,Ctf.CtfType.CTF_SIGN)
+		fft1.mult(flipim)
+		ctf1=EMAN2Ctf(ctf)
+		ctf1.defocus=ctf1.defocus+elem["defocus"]
+		ctf1.compute_2d_complex(flipim,Ctf.CtfType.CTF_SIGN)
+		fft1.mult(flipim)
+		ptcl=fft1.do_ift()
+
+	ptcl-=ptcl.get_edge_mean()
 	
-		if ("defocus" in elem) and abs(elem["defocus"])>1e-4 and img.has_attr("ctf"):
-			ctf=img["ctf"]
-			fft1=img.do_fft()
-			flipim=fft1.copy()
-			ctf.compute_2d_complex(flipim,Ctf.CtfType.CTF_SIGN)
-			fft1.mult(flipim)
-			ctf1=EMAN2Ctf(ctf)
-			ctf1.defocus=ctf1.defocus+elem["defocus"]
-			ctf1.compute_2d_complex(flipim,Ctf.CtfType.CTF_SIGN)
-			fft1.mult(flipim)
-			img=fft1.do_ift()
+	if "curve" in elem:
+		c=elem["curve"]
+		ptcl.process_inplace("filter.radialtable", {"table":c.tolist()})
 	
-		img-=img.get_edge_mean()
-		
-		if "curve" in elem:
-			c=elem["curve"]
-			img.process_inplace("filter.radialtable", {"table":c.tolist()})
-		
-		if "xform.projection" in elem:
-			pjxf=elem["xform.projection"]
-		else:
-			pjxf=img["xform.projection"]
-			
-		ts=Transform(pjxf)
-		ts.set_rotation({"type":"eman"})
-		ts.invert()   #### inverse the translation so make3d matches projection 
-		img=recon.preprocess_slice(img,ts)
+	if "xform.projection" in elem:
+		pjxf=elem["xform.projection"]
+	else:
+		pjxf=img["xform.projection"]
 		
+	ts=Transform(pjxf)
+	ts.set_rotation({"type":"eman"})
+	ts.invert()   #### inverse the translation so make3d matches projection 
+	slc=recon.preprocess_slice(ptcl,ts)
+	
 
-		recon.insert_slice(img,pjxf,wt)
-
-	return
+	recon.insert_slice(slc,pjxf,wt)
 
 
 
@@ -358,11 +396,17 @@ class Make3dTask(JSTask):
 		recon=Reconstructors.get("fourier", parms)
 		recon.setup()
 		
-		threads=[threading.Thread(target=reconstruct,
-			    args=(data[i::options.threads],recon, padvol)) for i in range(options.threads)]
+		# one reader thread feeds the insert threads through a bounded queue, so at most
+		# 2*READCHUNK particles are read ahead of insertion
+		que=queue.Queue(2*READCHUNK)
+		failed=[]
+		threads=[threading.Thread(target=read_particles,args=(data,que,options.threads,READCHUNK,failed))]
+		threads+=[threading.Thread(target=reconstruct,
+			    args=(que,recon, padvol,None,failed)) for i in range(options.threads)]
 
 		for t in threads: t.start()
 		for t in threads: t.join()
+		if failed : raise Exception("Error reconstructing particles:\n"+failed[0])
 
 		#reconstruct(
 			#data,
@@ -295,7 +295,7 @@ class ScipySptAlignTask(JSTask):
 			#fscs=np.array(fscs).reshape((len(fscs), 3, -1))[:,1]
 			#pm={"pmin":8, "pmax":int(ss*.45)}
 			#pm={"maxres":8,"minres":300}
-			c=np.mean([a.cmp("frc",b, cmppm) for a,b in zip(pjs, imgsmall)])
+			c=np.mean(frc_cmp_batch(imgsmall, pjs, cmppm["pmin"], cmppm["pmax"], rings))
 			#c=-np.mean(fscs[:, 8:int(ny*.45)])
 			#print(c, ss, ny)
 			return c
@@ -306,7 +306,7 @@ class ScipySptAlignTask(JSTask):
 			txf.set_trans(p.tolist())
 			xfs=[x*txf for x in pjxfs]
 			pjtrans=[refsmall.project('gauss_fft',{"transform":x, "returnfft":1}) for x in xfs]
-			scr=np.mean([a.cmp("frc",b, cmppm) for a,b in zip(pjtrans, imgsmall)])
+			scr=np.mean(frc_cmp_batch(imgsmall, pjtrans, cmppm["pmin"], cmppm["pmax"], rings))
 			#print(scr)
 			return scr
 		
@@ -416,6 +416,8 @@ class ScipySptAlignTask(JSTask):
 					ms=m.get_clip(Region(0,(ny-ss)//2, ss+2, ss))
 					ms.process_inplace("xform.fourierorigin.tocenter")
 					imgsmall.append(ms)
+				imgsmall=fft_stack(imgsmall).copy()
+				rings=frc_rings(ss)
 				
 				scrs=[]
 				xfout=[]
@@ -337,9 +337,10 @@ class EMTomoBoxer(QtWidgets.QMainWindow):
 		if "boxes_3d" in info:
 			box=info["boxes_3d"]
 			for i,b in enumerate(box):
-				#### X-center,Y-center,Z-center,method,[score,[class #]]
+				#### X-center,Y-center,Z-center,method,[score,[class #,[extra fields, eg - orientation from template matching]]]
 				bdf=[0,0,0,"manual",0.0, 0]
-				for j,bi in enumerate(b):  bdf[j]=bi
+				for j,bi in enumerate(b[:6]):  bdf[j]=bi
+				bdf.extend(b[6:])
 				
 				
 				if bdf[5] not in list(self.sets.keys()):
@@ -713,7 +714,7 @@ class EMTomoBoxer(QtWidgets.QMainWindow):
 			boxes=[]
 			for i,b in enumerate(self.boxes):
 				p=pts[i]
-				boxes.append([p[0],p[1],p[2],b[3],b[4],b[5]])
+				boxes.append([p[0],p[1],p[2],b[3],b[4],b[5]]+b[6:])
 		return boxes
 		
 	def update_all(self):
@@ -1156,7 +1157,7 @@ class EMTomoBoxer(QtWidgets.QMainWindow):
 				b=[	(b0[0]-sx)*self.apix_cur/self.apix_unbin,
 					(b0[1]-sy)*self.apix_cur/self.apix_unbin,
 					(b0[2]-sz)*self.apix_cur/self.apix_unbin,
-					b0[3], b0[4], b0[5]	]
+					b0[3], b0[4], b0[5]	]+b0[6:]
 				bxs.append(b)
 				
 			bxsz={}
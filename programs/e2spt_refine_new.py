@@ -294,24 +294,36 @@ def gather_metadata(pfile):
 		nptcl=EMUtil.get_image_count(pfile)
 		params=[[pfile, i] for i in range(nptcl)]
 	
+	#### read all headers in bulk, through the header catalog of each particle file
+	hdr3d=[None]*len(params)
+	files={}
+	for ii,pm in enumerate(params):
+		files.setdefault(pm[0], []).append(ii)
+	for fsp, iis in files.items():
+		hdr=load_header_catalog(fsp, ["class_ptcl_src", "class_ptcl_idxs", "ptcl_source_coord"], [params[i][1] for i in iis])
+		for j,ii in enumerate(iis):
+			hdr3d[ii]={k:v[j] for k,v in hdr.items()}
+	
+	hdr2d={}
 	info3d=[]
 	info2d=[]
 	for ii,pm in enumerate(params):
-		img=EMData(pm[0], pm[1], True)
+		img=hdr3d[ii]
 		imgsrc=img["class_ptcl_src"]
 		imgidx=img["class_ptcl_idxs"]
 		coord=img["ptcl_source_coord"]
 		
-		try: rhdrs=EMData.read_images(imgsrc,imgidx,IMAGE_UNKNOWN,True)
-		except:
-			print(f"couldn't read {imgidx} from {imgsrc}")
-			sys.exit(1)
+		if imgsrc not in hdr2d:
+			try: hdr2d[imgsrc]=load_header_catalog(imgsrc, ["xform.projection", "tilt_id"])
+			except:
+				print(f"couldn't read {imgidx} from {imgsrc}")
+				sys.exit(1)
+		rhdrs=hdr2d[imgsrc]
 			
 		idx2d=[]
-		for k,i in enumerate(imgidx): 
-			e=rhdrs[k]
+		for i in imgidx: 
 			dc={"src":imgsrc,"idx":i,
-				"idx3d":ii, "xform.projection":e["xform.projection"], "tilt_id":e["tilt_id"]}
+				"idx3d":ii, "xform.projection":rhdrs["xform.projection"][i], "tilt_id":rhdrs["tilt_id"][i]}
 			idx2d.append(len(info2d))
 			info2d.append(dc)
 		
@@ -319,8 +331,9 @@ def gather_metadata(pfile):
 		
 		info3d.append(dc)
 
-		sys.stdout.write("\r {}/{}".format(ii, len(params)))
-		sys.stdout.flush()
+		if ii%1000==0:
+			sys.stdout.write("\r {}/{}".format(ii, len(params)))
+			sys.stdout.flush()
 	print()
 		
 	return info2d, info3d
@@ -6,9 +6,10 @@ standard_library.install_aliases()
 from builtins import range
 from EMAN2 import *
 import numpy as np
-import scipy.spatial.distance as scidist
+from scipy.spatial import cKDTree
 import queue
 import threading
+import traceback
 
 def main():
 	
@@ -81,28 +82,15 @@ def main():
 			options.dthr=sz/np.sqrt(2)
 
 		hdr=m.get_attr_dict()
-		ccc=img.copy()*0-65535
-
-		jsd=queue.Queue(0)
-		thrds=[threading.Thread(target=do_match,args=(jsd, m,o, img)) for o in oris]
-		thrtolaunch=0
-		tsleep=threading.active_count()
-
-		ndone=0
-		while thrtolaunch<len(thrds) or threading.active_count()>tsleep or not jsd.empty():
-			if thrtolaunch<len(thrds) :
-				while (threading.active_count()==options.threads+tsleep ) : time.sleep(.1)
-				thrds[thrtolaunch].start()
-				thrtolaunch+=1
-			else: time.sleep(1)
-
-			while not jsd.empty():
-				cf=jsd.get()
-				ccc.process_inplace("math.max", {"with":cf})
-				ndone+=1
-				#if ndone%10==0:
-				sys.stdout.write("\r{}/{} finished.".format(ndone, 2*len(oris)))
-				sys.stdout.flush()
+		
+		#### each orientation and its flipped (alt+180) version
+		xfs=[]
+		for o in oris:
+			xfs.append(Transform(o))
+			xfs.append(Transform(o))
+			xfs[-1].rotate(Transform({"type":"eman","alt":180}))
+		
+		ccc,cori=match_orientations(img, m, xfs, options.threads)
 		print("")
 
 		cbin=ccc.process("math.maxshrink", {"n":2})
@@ -144,39 +132,27 @@ def main():
 		cc=cbin.numpy().copy()
 		cshp=cc.shape
 		ccf=cc.flatten()
-		asrt= np.argsort(-ccf)
-		pts=[]
 		vthr=np.mean(ccf)+np.std(ccf)*options.vthr
 		
 		dthr=options.dthr/4.
-		scr=[]
-		#print vthr,cc.shape
-		for i in range(len(asrt)):
-			aid=asrt[i]
-			pt=np.unravel_index(aid, cshp)
-			#if len(pts)>0:
-				#dst=scidist.cdist(pts, [pt])
-				#if np.min(dst)<dthr:
-					#continue
-
-			pts.append(pt)
-			scr.append(float(ccf[aid]))
-			if cc[pt]<vthr:
-				break
-			
+		#### all peaks above the threshold, plus the first one below it, best first
+		asrt=np.argsort(-ccf)
+		asrt=asrt[:np.sum(ccf>=vthr)+1]
+		pts=np.array(np.unravel_index(asrt, cshp)).T
+		scr=ccf[asrt]
 		
+		tokeep=peak_suppress(pts, dthr)
+		pts=pts[tokeep][:options.nptcl]
+		scr=scr[tokeep][:options.nptcl].tolist()
 		
-		pts=np.array(pts)
-		#print(pts.shape)
-		dst=scidist.cdist(pts, pts)+(np.eye(len(pts))*dthr*100)
-		tokeep=np.ones(len(dst), dtype=bool)
-		for i in range(len(dst)):
-			if tokeep[i]:
-				tokeep[dst[i]<dthr]=False
-			
-		pts=pts[tokeep]
-		if len(pts)>options.nptcl:
-			pts=pts[:options.nptcl]
+		#### best orientation of each peak, from the voxel of the 2x2x2 block that gave the maxshrink value.
+		#### the reference rotated by xfs[i] matches the particle, so the particle is aligned to it by the inverse
+		cfull=ccc.numpy()
+		xali=[]
+		for p in pts:
+			blk=cfull[p[0]*2:p[0]*2+2, p[1]*2:p[1]*2+2, p[2]*2:p[2]*2+2]
+			q=np.array(np.unravel_index(np.argmax(blk), blk.shape))+p*2
+			xali.append(xfs[cori[q[0],q[1],q[2]]].inverse())
 		
 		print("Found {} particles".format(len(pts)))
 		js=js_open_dict(info_name(imgname))
@@ -207,10 +183,10 @@ def main():
 				boxsz=options.boxsz
 			
 			box=(pts*2-shp/2)*apix/apix_unbin
-			bxs.extend([[p[2], p[1],p[0], 'tm', scr[i] ,kid] for i,p in enumerate(box[:n])])
+			bxs.extend([[p[2], p[1],p[0], 'tm', scr[i] ,kid, xali[i]] for i,p in enumerate(box[:n])])
 			
 		else:
-			bxs.extend([[p[2], p[1],p[0], 'tm', scr[i] ,kid] for i,p in enumerate(pts[:n]*2*nbin)])
+			bxs.extend([[p[2], p[1],p[0], 'tm', scr[i] ,kid, xali[i]] for i,p in enumerate(pts[:n]*2*nbin)])
 			if options.boxsz<0:
 				boxsz=sz*nbin
 			else:
@@ -229,15 +205,85 @@ def main():
 
 	E2end(logid)
 	
-def do_match(jsd, m, o, img):
-
-	for i in [0,1]:
-		e=m.copy()
-		e.transform(o)
-		cf=img.calc_ccf(e)
-		cf.process_inplace("xform.phaseorigin.tocenter")
-		jsd.put(cf)
-		o.rotate(Transform({"type":"eman","alt":180}))
+def match_orientations(img, m, xfs, nthreads):
+	"""Cross-correlate img with the reference m in each orientation in xfs. The FFT of img is computed once,
+	and nthreads worker threads each keep a running maximum and the index of the best orientation per voxel.
+	Returns the maximum CCF as an EMData, and the best orientation index for each voxel as a numpy array"""
+	
+	imgf=img.do_fft()
+	nx,ny,nz=img["nx"],img["ny"],img["nz"]
+	
+	tasks=queue.Queue(0)
+	for i in range(len(xfs)): tasks.put(i)
+	jsd=queue.Queue(0)
+	results=[]
+	thrds=[threading.Thread(target=do_match,args=(jsd, tasks, results, imgf, m, xfs, (nx,ny,nz))) for i in range(min(nthreads,len(xfs)))]
+	for t in thrds: t.start()
+	
+	ndone=0
+	while ndone<len(xfs):
+		if jsd.get()<0 : raise Exception("Template matching failed")
+		ndone+=1
+		sys.stdout.write("\r{}/{} finished.".format(ndone, len(xfs)))
+		sys.stdout.flush()
+	for t in thrds: t.join()
+	
+	#### combine the per-thread maxima
+	cmax,cori=results[0]
+	for c,o in results[1:]:
+		better=c>cmax
+		np.copyto(cmax, c, where=better)
+		np.copyto(cori, o, where=better)
+	
+	ccc=img.copy()
+	ccc.numpy()[:]=cmax
+	ccc.update()
+	return ccc,cori
+
+def do_match(jsd, tasks, results, imgf, m, xfs, size):
+	"""worker thread for match_orientations, keeps its own running max/argmax until there are no orientations left"""
+	nx,ny,nz=size
+	cmax=None
+	while True:
+		try: i=tasks.get_nowait()
+		except queue.Empty: break
+		
+		try:
+			e=m.copy()
+			e.transform(xfs[i])
+			#### int() truncates toward zero like the C++ padding in calc_ccf, so odd size differences center the same way
+			e.clip_inplace(Region(int((e["nx"]-nx)/2), int((e["ny"]-ny)/2), int((e["nz"]-nz)/2), nx, ny, nz))
+			ef=e.do_fft()
+			cf=imgf.calc_ccf(ef)
+			cf.process_inplace("xform.phaseorigin.tocenter")
+			c=cf.numpy()
+		except:
+			traceback.print_exc()
+			jsd.put(-1)
+			return
+		if cmax is None:
+			cmax=c.copy()
+			cori=np.full(c.shape, i, dtype=np.int32)
+		else:
+			better=c>cmax
+			np.copyto(cmax, c, where=better)
+			cori[better]=i
+		jsd.put(i)
+	
+	if cmax is not None: results.append((cmax,cori))
+
+def peak_suppress(pts, dthr):
+	"""Greedy non-maximum suppression, pts should be sorted best first. Each point kept removes all
+	later points closer than dthr. Returns a boolean array of the points to keep"""
+	
+	tokeep=np.ones(len(pts), dtype=bool)
+	if len(pts)==0: return tokeep
+	tree=cKDTree(pts)
+	for i,nb in enumerate(tree.query_ball_point(pts, np.nextafter(dthr,0))):
+		if tokeep[i]:
+			tokeep[nb]=False
+			tokeep[i]=True
+	return tokeep
 		
 def run(cmd):
 	print(cmd)
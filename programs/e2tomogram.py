@@ -11,6 +11,7 @@ import scipy.spatial.distance as scidist
 import scipy.ndimage as sciimg
 from EMAN2_utils import *
 import queue
+import traceback
 from sklearn.decomposition import PCA
 
 def main():
@@ -71,6 +72,7 @@ def main():
 
 	parser.add_argument("--extrapad", action="store_true",help="Use extra padding for tilted reconstruction. slower and cost more memory, but reduce boundary artifacts when the sample is thick", default=False,guitype='boolbox',row=15, col=0, rowspan=1, colspan=1,mode="easy")
 	parser.add_argument("--moretile", action="store_true",help="Sample more tiles during reconstruction. Slower, but reduce boundary artifacts when the sample is thick", default=False,guitype='boolbox',row=15, col=1, rowspan=1, colspan=1,mode="easy")
+	parser.add_argument("--streamtile", action="store_true",help="With --bytile, blend each finished tile directly into the tomogram on disk rather than building it in memory. Uses much less memory, but the final tomogram is not compressed.", default=False)
 
 	parser.add_argument("--rmbeadthr", type=float, help="Density value threshold (of sigma) for removing beads. high contrast objects beyond this value will be removed. default is -1 for not removing. try 10 for removing fiducials", default=-1,guitype='floatbox',row=14, col=1, rowspan=1, colspan=1,mode="easy")
 	
@@ -562,17 +564,6 @@ def main():
 		if options.rmbeadthr>0:
 			remove_beads(imgs_500, imgout, ttparams, options)
 		
-		#### only clip z axis at the end..
-		if options.bytile:
-			threed=make_tomogram_tile(imgout, ttparams, options, errtlt=loss0, clipz=options.clipz)
-		else:
-			threed=make_tomogram(imgout, ttparams, options, errtlt=loss0, clipz=options.clipz)
-
-		if options.writetmp:
-			make_ali(imgout, ttparams, options, outname=os.path.join(path,"tiltseries_ali.hdf"))
-			if options.compressbits<0: threed.write_image(os.path.join(path,"tomo_final.hdf"))
-			else: threed.write_compressed(os.path.join(path,"tomo_final.hdf"),0,options.compressbits,nooutliers=True)
-			
 		#### write to the tomogram folder
 		try: os.mkdir("tomograms")
 		except: pass
@@ -582,10 +573,31 @@ def main():
 			sfx+="__bin{:d}".format(int(bf))
 			
 		tomoname=os.path.join("tomograms", options.basename+sfx+".hdf")
-		threed["ytilt"]=yrot
 		
-		if options.compressbits<0: threed.write_image(tomoname)
-		else: threed.write_compressed(tomoname,0,options.compressbits,nooutliers=True)
+		#### only clip z axis at the end..
+		if options.bytile and options.streamtile:
+			make_tomogram_tile(imgout, ttparams, options, errtlt=loss0, clipz=options.clipz, outname=tomoname)
+			threed=None
+		elif options.bytile:
+			threed=make_tomogram_tile(imgout, ttparams, options, errtlt=loss0, clipz=options.clipz)
+		else:
+			threed=make_tomogram(imgout, ttparams, options, errtlt=loss0, clipz=options.clipz)
+
+		if options.writetmp:
+			make_ali(imgout, ttparams, options, outname=os.path.join(path,"tiltseries_ali.hdf"))
+			if threed==None: pass
+			elif options.compressbits<0: threed.write_image(os.path.join(path,"tomo_final.hdf"))
+			else: threed.write_compressed(os.path.join(path,"tomo_final.hdf"),0,options.compressbits,nooutliers=True)
+		
+		if threed==None:
+			#### already on disk, just update the header
+			hdr=EMData(tomoname,0,True)
+			hdr["ytilt"]=yrot
+			hdr.write_image(tomoname,0,IMAGE_UNKNOWN,True)
+		else:
+			threed["ytilt"]=yrot
+			if options.compressbits<0: threed.write_image(tomoname)
+			else: threed.write_compressed(tomoname,0,options.compressbits,nooutliers=True)
 		print("Tomogram written to {}".format(tomoname))
 	
 	#### save alignemnt parameters to info file
@@ -1496,10 +1508,84 @@ def make_tile(args):
 	
 	return
 
+#### clip the region of each tilt image which goes into the tile at stepx, stepy
+def get_tile_images(imgs, tpm, nrange, pad, step, stepx, stepy):
+	tiles=[]
+	for i in range(len(imgs)):
+		if i in nrange:
+			t=tpm[i]
+			pxf=get_xf_pos(t, [stepx*step,stepy*step,0])
+			img=imgs[i]
+			m=img.get_clip(Region(img["nx"]//2-pad//2+pxf[0],img["ny"]//2-pad//2+pxf[1], pad, pad), fill=0)
+			tiles.append(m)
+		else:
+			tiles.append(EMData(1,1))
+	return tiles
+
+#### worker thread for streamed tiling. clips and reconstructs tiles until the job queue is empty
+def make_tile_stream(jobs, jsd, imgs, tpm, nrange, sz, pad, step, outz, options):
+	while True:
+		try: stepx, stepy=jobs.get_nowait()
+		except queue.Empty: return
+		try:
+			tiles=get_tile_images(imgs, tpm, nrange, pad, step, stepx, stepy)
+			make_tile((jsd, tiles, tpm, sz, pad, stepx, stepy, outz, options))
+		except:
+			traceback.print_exc()
+			jsd.put(None)
+			return
+
+#### add a tile to the tomogram on disk, the part of the tile outside the tomogram is dropped
+def add_tile_to_file(outname, threed, x0, y0, z0, outsz):
+	lo=[max(x0,0), max(y0,0), max(z0,0)]
+	hi=[min(x0+threed["nx"],outsz[0]), min(y0+threed["ny"],outsz[1]), min(z0+threed["nz"],outsz[2])]
+	if min([h-l for l,h in zip(lo,hi)])<=0: return
+	rg=Region(lo[0], lo[1], lo[2], hi[0]-lo[0], hi[1]-lo[1], hi[2]-lo[2])
+	cur=EMData(outname, 0, False, rg)
+	cur.add(threed.get_clip(Region(lo[0]-x0, lo[1]-y0, lo[2]-z0, hi[0]-lo[0], hi[1]-lo[1], hi[2]-lo[2])))
+	cur.write_image(outname, 0, IMAGE_UNKNOWN, False, rg)
+
+#### normalize the tomogram on disk a slab at a time, same as the normalize processor
+def normalize_file(outname, apix):
+	hdr=EMData(outname, 0, True)
+	nx, ny, nz=hdr["nx"], hdr["ny"], hdr["nz"]
+	nslab=max(1, (256*1024**2)//(nx*ny*4))
+	
+	sm=sm2=0.
+	for z in range(0, nz, nslab):
+		d=EMData(outname, 0, False, Region(0, 0, z, nx, ny, min(nslab, nz-z))).numpy().astype(np.float64)
+		sm+=np.sum(d)
+		sm2+=np.sum(d**2)
+	n=float(nx*ny*nz)
+	mean=sm/n
+	sigma=np.sqrt(max(sm2/n-mean**2, 0))
+	if sigma==0: sigma=1.
+	
+	vmin=vmax=0
+	for z in range(0, nz, nslab):
+		rg=Region(0, 0, z, nx, ny, min(nslab, nz-z))
+		e=EMData(outname, 0, False, rg)
+		e.sub(mean)
+		e.mult(1./sigma)
+		vmin=min(vmin, e["minimum"])
+		vmax=max(vmax, e["maximum"])
+		e.write_image(outname, 0, IMAGE_UNKNOWN, False, rg)
+	
+	#### region writing does not update the header
+	hdr=EMData(outname, 0, True)
+	hdr["mean"]=0.
+	hdr["sigma"]=1.
+	hdr["minimum"]=vmin
+	hdr["maximum"]=vmax
+	hdr["zshift"]=0
+	hdr["apix_x"]=hdr["apix_y"]=hdr["apix_z"]=apix
+	hdr.write_image(outname, 0, IMAGE_UNKNOWN, True)
+
 
 #### make tomogram by tiles
 #### this is faster and has less artifacts. but takes a lot of memory (~4x the tomogram)
-def make_tomogram_tile(imgs, tltpm, options, errtlt=[], clipz=-1):
+#### if outname is specified, tiles are instead blended directly into that file as they finish, so only a few tiles per thread are in memory
+def make_tomogram_tile(imgs, tltpm, options, errtlt=[], clipz=-1, outname=None):
 	time0=time.time()
 	num=len(imgs)
 	scale=imgs[0]["apix_x"]/options.apix_init
@@ -1561,7 +1647,16 @@ def make_tomogram_tile(imgs, tltpm, options, errtlt=[], clipz=-1):
 	
 	
 	#options.moretile=True
-	if options.moretile:
+	if outname:
+		#### the file needs to exist at full size before region writing
+		#### the volume is sized without allocating data, so the HDF dataset is created empty (reads as zero)
+		full3d=EMData()
+		full3d.set_size(outx, outy, outz, True)
+		full3d.write_image(outname)
+		full3d=None
+		print("Tiles are written to {} directly, using about {:.1f} GB of memory...".format(outname, pad*pad*pad*options.threads*3*4/1024**3))
+		wtcon=1 if options.moretile else 2.5
+	elif options.moretile:
 		full3d=EMData(outx, outy, outz)
 		mem=(outx*outy*outz*4+pad*pad*pad*options.threads*4)
 		print("This will take {}x{}x{}x4 + {}x{}x{}x{}x4 = {:.1f} GB of memory...".format(outx, outy, outz, pad, pad, pad,options.threads, mem/1024**3))
@@ -1586,24 +1681,12 @@ def make_tomogram_tile(imgs, tltpm, options, errtlt=[], clipz=-1):
 		else: 
 			yrange=range(-nstepy+stepx%2,nstepy+1,2)
 		for stepy in yrange:
-			tiles=[]
-			for i in range(num):
-				if i in nrange:
-					t=tpm[i]
-					pxf=get_xf_pos(t, [stepx*step,stepy*step,0])
-					img=imgs[i]
-					m=img.get_clip(Region(img["nx"]//2-pad//2+pxf[0],img["ny"]//2-pad//2+pxf[1], pad, pad), fill=0)
-					tiles.append(m)
-				else:
-					tiles.append(EMData(1,1))
-
+			if outname:
+				jobs.append((stepx, stepy))
+				continue
+			tiles=get_tile_images(imgs, tpm, nrange, pad, step, stepx, stepy)
 			jobs.append((jsd, tiles, tpm, sz, pad, stepx, stepy, outz, options))
 	
-	thrds=[threading.Thread(target=make_tile,args=([i])) for i in jobs]
-	print("now start threads...")
-	thrtolaunch=0
-	tsleep=threading.active_count()
-	
 	#### non-round fall off. this is mathematically correct but seem to have grid artifacts
 	#f=np.zeros((sz,sz))
 	x,y=np.indices((sz,sz),dtype=float)/sz-.5
@@ -1612,6 +1695,44 @@ def make_tomogram_tile(imgs, tltpm, options, errtlt=[], clipz=-1):
 	f3=np.repeat(f[None, :,:], outz, axis=0)
 	msk=from_numpy(f3).copy()
 	#####
+	
+	if outname:
+		#### a fixed pool of threads makes the tiles, finished tiles wait in a bounded queue to be added to the file
+		jsd=queue.Queue(options.threads)
+		jobq=queue.Queue(0)
+		for j in jobs: jobq.put(j)
+		#### daemon threads, so a failed run can exit while other workers are still blocked on the full queue
+		thrds=[threading.Thread(target=make_tile_stream,args=(jobq, jsd, imgs, tpm, nrange, sz, pad, step, outz, options),daemon=True) for i in range(options.threads)]
+		for t in thrds: t.start()
+		
+		for i in range(len(jobs)):
+			ret=jsd.get()
+			if ret==None:
+				print("Error in tile reconstruction")
+				#### stop the other workers from starting new tiles
+				while True:
+					try: jobq.get_nowait()
+					except queue.Empty: break
+				sys.exit(1)
+			stepx, stepy, threed=ret
+			threed.mult(msk)
+			add_tile_to_file(outname, threed,
+				int(stepx*step+outx//2-sz//2), int(stepy*step+outy//2-sz//2), outz//2-threed["nz"]//2,
+				(outx, outy, outz))
+			threed=None
+			sys.stdout.write("\r{}/{} tiles".format(i+1, len(jobs)))
+			sys.stdout.flush()
+		print("")
+		for t in thrds: t.join()
+		
+		normalize_file(outname, imgs[0]["apix_x"])
+		print("Reconstruction done ({:.1f} s).".format(time.time()-time0))
+		return None
+	
+	thrds=[threading.Thread(target=make_tile,args=([i])) for i in jobs]
+	print("now start threads...")
+	thrtolaunch=0
+	tsleep=threading.active_count()
 
 	
 	while thrtolaunch<len(thrds) or threading.active_count()>tsleep or not jsd.empty():
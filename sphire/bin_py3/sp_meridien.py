@@ -1293,6 +1293,24 @@ def compute_sigma(projdata, params, first_procid, dryrun=False, myid=-1, mpi_com
     # return Blockdata["bckgnoise"]#tsd, sd#, [int(tocp[i]) for i in range(len(sd))]
 
 
+def first_column(table):
+    """
+    First column of a table from read_text_array, as an array if it was read as one
+    """
+    if isinstance(table, numpy.ndarray):
+        return table[:, 0]
+    return [row[0] for row in table]
+
+
+def as_list(table):
+    """
+    A table slice as a list of rows
+    """
+    if isinstance(table, numpy.ndarray):
+        return table.tolist()
+    return table
+
+
 def getindexdata(
     partids,
     partstack,
@@ -1312,27 +1330,28 @@ def getindexdata(
         mpi_comm = mpi.MPI_COMM_WORLD
     #  parameters
     if myid == 0:
-        partstack = sp_utilities.read_text_row(partstack)
+        partstack = sp_utilities.read_text_array(partstack)
     else:
         partstack = 0
     partstack = sp_utilities.wrap_mpi_bcast(partstack, 0, mpi_comm)
     #  particles IDs
     if myid == 0:
-        partids = sp_utilities.read_text_file(partids)
+        partids = first_column(sp_utilities.read_text_array(partids))
     else:
         partids = 0
     partids = sp_utilities.wrap_mpi_bcast(partids, 0, mpi_comm)
     #  Group assignments
     if myid == 0:
-        group_reference = sp_utilities.read_text_file(particle_groups)
+        group_reference = first_column(sp_utilities.read_text_array(particle_groups))
     else:
         group_reference = 0
     group_reference = sp_utilities.wrap_mpi_bcast(group_reference, 0, mpi_comm)
 
     im_start, im_end = sp_applications.MPI_start_end(len(partstack), nproc, myid)
-    partstack = partstack[im_start:im_end]
-    partids = partids[im_start:im_end]
-    group_reference = group_reference[im_start:im_end]
+    # numerical tables are broadcast as arrays, the local subsets are used as lists
+    partstack = as_list(partstack[im_start:im_end])
+    partids = as_list(partids[im_start:im_end])
+    group_reference = as_list(group_reference[im_start:im_end])
     """Multiline Comment5"""
 
     """Multiline Comment6"""
@@ -46,6 +46,7 @@ from past.utils import old_div
 #
 
 import EMAN2_cppwrap
+import collections
 import copy
 import json
 import mpi
@@ -2622,10 +2623,7 @@ def Kmeans_minimum_group_size_orien_groups(
         del ref_vol
         # pass to main_node
         if Blockdata["myid"] == Blockdata["main_node"]:
-            dmatrix = [
-                [0.0 for im in range(Tracker["total_stack"])]
-                for iref in range(number_of_groups)
-            ]
+            dmatrix = numpy.zeros((number_of_groups, Tracker["total_stack"]))
             for im in range(len(local_peaks)):
                 dmatrix[old_div(im, nima)][im % nima + image_start] = local_peaks[im]
         else:
@@ -2773,76 +2771,69 @@ def Kmeans_minimum_group_size_orien_groups(
 def do_assignment_by_dmatrix_orien_group_minimum_group_size(
     dmatrix, orien_group_members, number_of_groups, minimum_group_size_ratio
 ):
-    results = [[] for i in range(number_of_groups)]
+    """
+    Assign the particles of one orientation group to number_of_groups groups
+    so that each group gets at least minimum_group_size_ratio * nima /
+    number_of_groups particles. In each round every group takes its best
+    remaining particle, with ties between groups broken at random; the
+    particles left after the minimum is reached go to their best group.
+    Each group keeps a pointer into its presorted candidate list instead of
+    removing assigned particles from Python lists.
+    """
     nima = len(orien_group_members)
     minimum_group_size = int(old_div(minimum_group_size_ratio * nima, number_of_groups))
-    submatrix = numpy.zeros((number_of_groups, nima))
-    for i in range(number_of_groups):
-        for j in range(len(orien_group_members)):
-            submatrix[i][j] = dmatrix[i][orien_group_members[j]] * (
-                -1.0
-            )  # sort in descending order
-    tmp_array = numpy.argsort(submatrix, axis=1)
-    rmatrix = []
-    for i in range(number_of_groups):
-        rmatrix.append(tmp_array[i].tolist())
-    del tmp_array
-    while len(rmatrix[0]) > nima - minimum_group_size * number_of_groups:
-        tarray = []
+    submatrix = -numpy.asarray(dmatrix, dtype=numpy.float64)[
+        :number_of_groups, orien_group_members
+    ]  # sort in descending order
+    rmatrix = numpy.argsort(submatrix, axis=1)
+    taken = numpy.zeros(nima, dtype=bool)
+    pointer = numpy.zeros(number_of_groups, dtype=numpy.int64)
+    iter_assignment = numpy.full(nima, -1, dtype=numpy.int64)
+    for iround in range(minimum_group_size):
+        # advance each group past particles assigned in earlier rounds
         for i in range(number_of_groups):
-            tarray.append(rmatrix[i][0])
-        value_list, index_list = numpy.unique(numpy.array(tarray), return_index=True)
-        duplicate_list = (
-            numpy.setdiff1d(numpy.arange(number_of_groups), index_list)
-        ).tolist()
-        index_list = index_list.tolist()
-        value_list = value_list.tolist()
+            while taken[rmatrix[i, pointer[i]]]:
+                pointer[i] += 1
+        tarray = rmatrix[numpy.arange(number_of_groups), pointer]
+        value_list, index_list = numpy.unique(tarray, return_index=True)
+        picks = tarray.tolist()
         if len(value_list) < number_of_groups:
-            for i in range(len(index_list)):
-                if tarray[index_list[i]] == tarray[duplicate_list[0]]:
-                    duplicate_list.append(index_list[i])  # find all duplicated ones
+            duplicate_list = (
+                numpy.setdiff1d(numpy.arange(number_of_groups), index_list)
+            ).tolist()
+            for i in index_list.tolist():
+                if picks[i] == picks[duplicate_list[0]]:
+                    duplicate_list.append(i)  # find all duplicated ones
             random.shuffle(duplicate_list)
             duplicate_list.remove(duplicate_list[0])
-            for i in range(len(duplicate_list)):  # swap the first row with the next row
-                index_column = 1
-                while rmatrix[duplicate_list[i]][index_column] in value_list:
-                    index_column += 1  # search along column non-equal ones
-                value_list.append(rmatrix[duplicate_list[i]][index_column])
-                rmatrix[duplicate_list[i]][0], rmatrix[duplicate_list[i]][
-                    index_column
-                ] = (
-                    rmatrix[duplicate_list[i]][index_column],
-                    rmatrix[duplicate_list[i]][0],
-                )
-        for i in range(number_of_groups):
-            results[i].append(rmatrix[i][0])
-            for j in range(number_of_groups):
-                rmatrix[i].remove(value_list[j])  # remove K elements from each column
-    kmeans_ptl_list = (
-        numpy.delete(numpy.array(list(range(nima))), numpy.array(results).ravel())
-    ).tolist()  # ravel works only for even size
-    del rmatrix
-    for iptl in range(len(kmeans_ptl_list)):
-        max_indexes = numpy.argwhere(
-            submatrix[:, kmeans_ptl_list[iptl]]
-            <= submatrix[:, kmeans_ptl_list[iptl]][
-                submatrix[:, kmeans_ptl_list[iptl]].argmin()
-            ]
-        )
-        if len(max_indexes) > 1:
+            claimed = set(value_list.tolist())
+            for i in duplicate_list:  # next best particle not claimed this round
+                index_column = pointer[i] + 1
+                while (
+                    taken[rmatrix[i, index_column]]
+                    or rmatrix[i, index_column] in claimed
+                ):
+                    index_column += 1
+                picks[i] = int(rmatrix[i, index_column])
+                claimed.add(picks[i])
+        else:
+            claimed = picks
+        # everything claimed this round leaves the candidate lists
+        taken[list(claimed)] = True
+        iter_assignment[picks] = numpy.arange(number_of_groups)
+    # remaining particles go to the group with the largest value, ties at random
+    kmeans_ptl_list = numpy.flatnonzero(iter_assignment < 0)
+    if len(kmeans_ptl_list) > 0:
+        subcols = submatrix[:, kmeans_ptl_list]
+        best = subcols.min(axis=0)
+        nbest = (subcols <= best).sum(axis=0)
+        iter_assignment[kmeans_ptl_list] = subcols.argmin(axis=0)
+        for iptl in numpy.flatnonzero(nbest > 1).tolist():
+            max_indexes = numpy.flatnonzero(subcols[:, iptl] <= best[iptl])
             t = list(range(len(max_indexes)))
             random.shuffle(t)
-            results[max_indexes[t[0]][0]].append(kmeans_ptl_list[iptl])
-        else:
-            results[max_indexes[0][0]].append(kmeans_ptl_list[iptl])
-    iter_assignment = [-1 for i in range(nima)]
-    for i in range(number_of_groups):
-        results[i].sort()
-        for j in range(len(results[i])):
-            iter_assignment[results[i][j]] = i
-    del results
-    del submatrix
-    return iter_assignment
+            iter_assignment[kmeans_ptl_list[iptl]] = max_indexes[t[0]]
+    return iter_assignment.tolist()
 
 
 ### various reading data
@@ -3785,23 +3776,85 @@ def downsize_data_for_rec3D(original_data, particle_size, return_real=False, npa
 
 ###=====<--- comparison
 
+PROJ_CACHE_ANGLE_STEP = 0.1  # degrees, orientations are rounded to this before projecting
+PROJ_CACHE_SIZE = 2000  # most recently used projections kept per volume
+
+
+class ProjectionCache(object):
+    """
+    LRU cache of projections of one prepared volume, keyed by orientation
+    rounded to angle_step degrees, so particles refined to nearly the same
+    orientation share one projection. Projections are computed at the
+    rounded angles, so results do not depend on particle order.
+    angle_step=0 only reuses exact matches.
+    """
+
+    def __init__(
+        self, volft, angle_step=PROJ_CACHE_ANGLE_STEP, maxsize=PROJ_CACHE_SIZE
+    ):
+        self.volft = volft
+        self.angle_step = angle_step
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+
+    def get(self, phi, theta, psi, return_real):
+        """
+        Projection at (phi, theta, psi). The returned image is shared and
+        must not be modified in place.
+        """
+        if self.angle_step > 0.0:
+            angles = [
+                round(old_div(a, self.angle_step)) * self.angle_step
+                for a in (phi, theta, psi)
+            ]
+        else:
+            angles = [phi, theta, psi]
+        key = (tuple(angles), return_real)
+        try:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        except KeyError:
+            pass
+        proj = sp_projection.prgl(self.volft, angles + [0.0, 0.0], 1, return_real)
+        self.cache[key] = proj
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return proj
+
+
+def ctf_images_real(data, ny):
+    """
+    ctf_img_real for each image in data, computing one image per distinct
+    CTF and sharing it between the particles that have it.
+    """
+    bykey = {}
+    ctfs = []
+    for q in data:
+        ctf = q.get_attr("ctf")
+        key = ctf.to_string()
+        if key not in bykey:
+            bykey[key] = sp_morphology.ctf_img_real(ny, ctf)
+        ctfs.append(bykey[key])
+    return ctfs
+
 
 def compare_two_images_eucd(data, ref_vol, fdata):
     global Tracker, Blockdata
     peaks = len(data) * [None]
     ny = data[0].get_ysize()
     ref_vol = sp_projection.prep_vol(ref_vol, npad=2, interpolation_method=1)
-    ctfs = [sp_morphology.ctf_img_real(ny, q.get_attr("ctf")) for q in data]
+    projs = ProjectionCache(ref_vol)
+    ctfs = ctf_images_real(data, ny)
     qt = float(Tracker["constants"]["nnxo"] * Tracker["constants"]["nnxo"])
     for im in range(len(data)):
         phi, theta, psi, s2x, s2y = sp_utilities.get_params_proj(
             data[im], xform="xform.projection"
         )
         if Tracker["constants"]["focus3D"]:
-            rtemp = sp_projection.prgl(ref_vol, [phi, theta, psi, 0.0, 0.0], 1, True)
+            rtemp = projs.get(phi, theta, psi, True)
             rtemp = sp_fundamentals.fft(rtemp * fdata[im])
         else:
-            rtemp = sp_projection.prgl(ref_vol, [phi, theta, psi, 0.0, 0.0], 1, False)
+            rtemp = projs.get(phi, theta, psi, False).copy()
         rtemp.set_attr("is_complex", 0)
         if data[im].get_attr("is_complex") == 1:
             data[im].set_attr("is_complex", 0)
@@ -3834,22 +3887,14 @@ def compare_two_images_cross(data, ref_vol):
     ny = data[0].get_ysize()
     peaks = len(data) * [None]
     volft = sp_projection.prep_vol(ref_vol, 2, 1)
-    ctfs = [None for im in range(len(data))]
-    for im in range(len(data)):
-        if im == 0:
-            current_ctf = data[im].get_attr("ctf")
-            ctfimg = sp_morphology.ctf_img_real(ny, current_ctf)
-        else:
-            if not sp_utilities.same_ctf(current_ctf, data[im].get_attr("ctf")):
-                current_ctf = data[im].get_attr("ctf")
-                ctfimg = sp_morphology.ctf_img_real(ny, current_ctf)
-        ctfs[im] = ctfimg
+    projs = ProjectionCache(volft)
+    ctfs = ctf_images_real(data, ny)
     #  Ref is in reciprocal space
     for im in range(len(data)):
         phi, theta, psi, s2x, s2y = sp_utilities.get_params_proj(
             data[im], xform="xform.projection"
         )
-        ref = sp_projection.prgl(volft, [phi, theta, psi, 0.0, 0.0], 1, False)
+        ref = projs.get(phi, theta, psi, False).copy()
         EMAN2_cppwrap.Util.mulclreal(ref, ctfs[im])
         ref.set_attr("is_complex", 0)
         ref.set_value_at(0, 0, 0.0)
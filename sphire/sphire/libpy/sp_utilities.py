@@ -67,6 +67,7 @@ import struct
 import sys
 import time
 import traceback
+import warnings
 import zlib
 
 
@@ -1427,6 +1428,84 @@ def write_text_row(data, file_name, form_float="  %14.6f", form_int="  %12d"):
     outf.flush()
     outf.close()
 
+def read_text_array(fnam, skip=";", cache=False):
+    """
+		Read a column-listed txt file, as written by write_text_row or write_text_array, into a numpy array.
+		Text following the comment symbol is ignored.
+		INPUT: fnam: name of the text file
+		       cache: if True, keep a binary copy of the data in fnam + ".npy" and read that
+		              instead as long as it is newer than the text file
+		OUTPUT:
+			data: 2D array with one row per line, int64 if all entries are integers and float64 otherwise.
+			      Files with non-numerical entries or rows of different length can not be held in one array,
+			      these are returned as the list of lists from read_text_row.
+	"""
+
+    cache_name = fnam + ".npy"
+    if cache and os.path.isfile(cache_name):
+        if os.stat(cache_name).st_mtime_ns > os.stat(fnam).st_mtime_ns:
+            return numpy.load(cache_name)
+
+    # numpy's parser, integer columns are tried first and fail on the first non-integer entry
+    for dtype in (numpy.int64, numpy.float64):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                data = numpy.loadtxt(fnam, dtype=dtype, comments=skip, ndmin=2)
+            break
+        except ValueError:
+            pass
+    else:
+        # strings, or rows of different length
+        return read_text_row(fnam, skip=skip)
+
+    if cache:
+        numpy.save(cache_name, data)
+    return data
+
+
+def write_text_array(data, file_name, form_float="  %14.6f", form_int="  %12d", cache=False):
+    """
+	   Write a numpy array to an ASCII file, in the same format as write_text_row, one row per line.
+	   A 1D array is written one value per line. Integer arrays use form_int, float columns use form_float,
+	   or its exponential form if the fixed form can not represent every value in that column.
+
+	   cache: if True, also save the array to file_name + ".npy" for read_text_array
+	"""
+    data = numpy.asarray(data)
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+
+    if data.dtype.kind in "biu":
+        formats = [form_int] * data.shape[1]
+    else:
+        e_form = form_float.replace("f", "e")
+        width, precision = form_float.strip()[1:-1].split(".")
+        tiny = 0.5 * 10 ** -int(precision)
+        formats = []
+        for col in data.T:
+            col = col[numpy.isfinite(col)]
+            if len(col) == 0:
+                formats.append(form_float)
+                continue
+            extreme = [form_float.strip() % col.min(), form_float.strip() % col.max()]
+            small = numpy.any((col != 0) & (numpy.abs(col) < tiny))
+            if small or max(len(v) for v in extreme) > int(width):
+                formats.append(e_form)
+            else:
+                formats.append(form_float)
+    row = "".join(formats) + "\n"
+
+    outf = open(file_name, "w")
+    for i in range(0, len(data), 100000):
+        chunk = data[i : i + 100000]
+        outf.write((row * len(chunk)) % tuple(chunk.ravel().tolist()))
+    outf.flush()
+    outf.close()
+
+    if cache:
+        numpy.save(file_name + ".npy", data)
+
 
 def read_text_file(file_name, ncol=0):
     """
@@ -3442,6 +3521,50 @@ def unpack_message(msg):
         raise Exception("unpack_message")
 
 
+def is_mpi_array(data):
+    """True for numpy arrays the wrap_mpi_* functions can send as a raw buffer rather than pickling"""
+    return isinstance(data, numpy.ndarray) and not data.dtype.hasobject
+
+
+def bytes_to_words(buf):
+    """View a byte buffer as int32 words for MPI_INT transfer, zero padding it to a multiple of 4 bytes"""
+    buf = numpy.frombuffer(buf, numpy.uint8)
+    if buf.size % 4:
+        buf = numpy.concatenate((buf, numpy.zeros(4 - buf.size % 4, numpy.uint8)))
+    return buf.view(numpy.int32)
+
+
+def message_bytes(msg):
+    """MPI_CHAR buffers are received as arrays of single characters, return them as one bytes object"""
+    if isinstance(msg, bytes):
+        return msg
+    return numpy.asarray(msg).tobytes()
+
+
+def pack_array(data):
+    """Split a numpy array into a small header message (dtype and shape) and its contents as int32 words.
+    The words go over MPI as MPI_INT, so no pickling or compression is involved for any dtype."""
+    shape = data.shape
+    data = numpy.ascontiguousarray(data)
+    header = b"A" + pickle.dumps((data.dtype.str, shape), 2)
+    return header, bytes_to_words(data.reshape(-1).view(numpy.uint8))
+
+
+def array_header(header):
+    """Decode a header prepared by pack_array, returns dtype, shape and the number of int32 words which follow"""
+    dtype, shape = pickle.loads(header[1:])
+    dtype = numpy.dtype(dtype)
+    nbytes = dtype.itemsize * int(numpy.prod(shape))
+    return dtype, shape, (nbytes + 3) // 4
+
+
+def unpack_array(header, words):
+    """Rebuild the numpy array sent as header, words by pack_array"""
+    dtype, shape, nwords = array_header(header)
+    nbytes = dtype.itemsize * int(numpy.prod(shape))
+    return numpy.asarray(words, numpy.int32).view(numpy.uint8)[:nbytes].view(dtype).reshape(shape)
+
+
 def update_tag(
     communicator, target_rank
 ):  # TODO - it doesn't work when communicators are destroyed and recreated
@@ -3462,13 +3585,19 @@ def wrap_mpi_send(data, destination, communicator=None):
     if communicator == None:
         communicator = mpi.MPI_COMM_WORLD
 
-    msg = pack_message(data)
+    # numpy arrays go as a header followed by the raw buffer, everything else is pickled
+    if is_mpi_array(data):
+        msg, words = pack_array(data)
+    else:
+        msg, words = pack_message(data), None
     tag = update_tag(communicator, destination)
     # from mpi import mpi_comm_rank
     # print communicator, mpi_comm_rank(communicator), "send to", destination, tag
     mpi.mpi_send(
         msg, len(msg), mpi.MPI_CHAR, destination, tag, communicator
     )  # int MPI_Send( void *buf, int count, MPI_Datatype datatype, int dest, int tag, MPI_Comm comm )
+    if words is not None and len(words) > 0:
+        mpi.mpi_send(words, len(words), mpi.MPI_INT, destination, tag, communicator)
 
 
 def wrap_mpi_recv(source, communicator=None):
@@ -3481,7 +3610,13 @@ def wrap_mpi_recv(source, communicator=None):
     # print communicator, mpi_comm_rank(communicator), "recv from", source, tag
     mpi.mpi_probe(source, tag, communicator)
     n = mpi.mpi_get_count(mpi.MPI_CHAR)
-    msg = mpi.mpi_recv(n, mpi.MPI_CHAR, source, tag, communicator)
+    msg = message_bytes(mpi.mpi_recv(n, mpi.MPI_CHAR, source, tag, communicator))
+    if msg[0:1] == b"A":
+        dtype, shape, nwords = array_header(msg)
+        words = numpy.zeros(0, numpy.int32)
+        if nwords > 0:
+            words = mpi.mpi_recv(nwords, mpi.MPI_INT, source, tag, communicator)
+        return unpack_array(msg, words)
     return unpack_message(msg)
 
 
@@ -3499,39 +3634,59 @@ def wrap_mpi_bcast(data, root, communicator=None):
     rank = mpi.mpi_comm_rank(communicator)
 
     if rank == root:
-        msg = pack_message(data)
-        n = struct.pack("I", len(msg))
+        if is_mpi_array(data):
+            msg, words = pack_array(data)
+        else:
+            msg, words = pack_message(data), None
+        n = numpy.array([len(msg)], numpy.int32)
 
     else:
         msg = None
-        n = None
+        n = numpy.zeros(1, numpy.int32)
 
     sizeofdata = mpi.mpi_bcast(
-        n, 4, mpi.MPI_CHAR, root, communicator
+        n, 1, mpi.MPI_INT, root, communicator
     )  # int MPI_Bcast ( void *buffer, int count, MPI_Datatype datatype, int root, MPI_Comm comm ).
 
-    if mpi.mpi_comm_rank(communicator) == root:
+    if rank == root:
         sizeofdata = n
-    else:
-        sizeofdata = b''.join([entry if entry != b'' else b'\x00' for entry in sizeofdata])
 
-    n = struct.unpack("I", sizeofdata)[0]
+    n = int(sizeofdata[0])
     msgtobcast = mpi.mpi_bcast(
         msg, n, mpi.MPI_CHAR, root, communicator
     )  # int MPI_Bcast ( void *buffer, int count, MPI_Datatype datatype, int root, MPI_Comm comm )
 
-    if mpi.mpi_comm_rank(communicator) == root:
+    if rank == root:
         msgtobcast = msg
     else:
-        msgtobcast = b''.join([entry if entry != b'' else b'\x00' for entry in msgtobcast])
+        msgtobcast = message_bytes(msgtobcast)
+
+    if msgtobcast[0:1] == b"A":
+        # numpy array, the header is followed by the raw buffer
+        dtype, shape, nwords = array_header(msgtobcast)
+        if rank != root:
+            words = numpy.empty(nwords, numpy.int32)
+        if nwords > 0:
+            received = mpi.mpi_bcast(words, nwords, mpi.MPI_INT, root, communicator)
+            if rank != root:
+                words = received
+        if rank == root:
+            return numpy.array(data, copy=True)
+        return unpack_array(msgtobcast, words)
 
     return unpack_message(msgtobcast)
 
 
-# data must be a python list (numpy array also should be implemented)
+# data must be a python list or a numpy array
 
 
 def wrap_mpi_gatherv(data, root, communicator=None):
+    """
+    Gather data from all processes of the communicator on root, returns None on the other processes.
+    Python lists are concatenated in rank order. numpy arrays are concatenated along their first
+    axis, so every process must send the same dtype and trailing dimensions. The contributions
+    are collected with a single MPI_Gatherv of int32 words, limited to 8 GB in total.
+    """
 
     if communicator == None:
         communicator = mpi.MPI_COMM_WORLD
@@ -3539,21 +3694,45 @@ def wrap_mpi_gatherv(data, root, communicator=None):
     rank = mpi.mpi_comm_rank(communicator)
     procs = mpi.mpi_comm_size(communicator)
 
-    out_array = None
-    if rank == root:
-        if type(data) is list:
-            out_array = []
-            for p in range(procs):
-                if p == rank:
-                    out_array.extend(data)
-                else:
-                    recv_data = wrap_mpi_recv(p, communicator)
-                    out_array.extend(recv_data)
-        else:
-            raise Exception("wrap_mpi_gatherv: type of data not supported")
+    if is_mpi_array(data):
+        header, words = pack_array(data)
+        nbytes = data.nbytes
+    elif rank == root and type(data) is not list:
+        raise Exception("wrap_mpi_gatherv: type of data not supported")
     else:
-        wrap_mpi_send(data, root, communicator)
+        header = None
+        msg = pack_message(data)
+        nbytes = len(msg)
+        words = bytes_to_words(msg)
+
+    recvcounts = [1] * procs
+    displs = list(range(procs))
+    counts = mpi.mpi_gatherv(
+        numpy.array([nbytes], numpy.int32), 1, mpi.MPI_INT,
+        recvcounts, displs, mpi.MPI_INT, root, communicator,
+    )
+    if rank == root:
+        counts = numpy.asarray(counts, numpy.int64)
+        recvcounts = (counts + 3) // 4
+        displs = numpy.concatenate(([0], numpy.cumsum(recvcounts)[:-1]))
+
+    recv_data = mpi.mpi_gatherv(
+        words, len(words), mpi.MPI_INT,
+        recvcounts, displs, mpi.MPI_INT, root, communicator,
+    )
+    if rank != root:
+        return None
+
+    buf = numpy.asarray(recv_data, numpy.int32).view(numpy.uint8)
+    parts = [buf[4 * d : 4 * d + c] for d, c in zip(displs, counts)]
+    if header is not None:
+        dtype, shape, nwords = array_header(header)
+        out_array = numpy.concatenate(parts).view(dtype)
+        return out_array.reshape((-1,) + tuple(shape[1:]))
 
+    out_array = []
+    for p in parts:
+        out_array.extend(unpack_message(p.tobytes()))
     return out_array
 
 
@@ -0,0 +1,95 @@
+from __future__ import print_function
+from __future__ import division
+
+from sphire.bin_py3 import sp_sort3d_depth as oldfu
+from ..sphire.bin import sp_sort3d_depth as fu
+import unittest
+import os
+import random
+import time
+import numpy
+
+"""
+WHAT IS MISSING:
+Only do_assignment_by_dmatrix_orien_group_minimum_group_size is tested here. The new version replaces the
+per-element copies and list.remove calls of the old one with numpy arrays; both have to produce the same
+assignment for the same random seed.
+
+RESULT AND KNOWN ISSUES
+The old version fails when the minimum group size is 0 (numpy.delete with an empty float index array), so the
+synthetic cases always use a nonzero minimum group size.
+The timing comparison only runs when the SPHIRE_BENCHMARK environment variable is set.
+"""
+
+
+def synthetic_dmatrix(number_of_groups, total, ties, seed):
+    rng = numpy.random.RandomState(seed)
+    if ties:
+        return rng.randint(0, 4, size=(number_of_groups, total)).astype(float)
+    return rng.rand(number_of_groups, total)
+
+
+class Test_do_assignment_by_dmatrix_orien_group_minimum_group_size(unittest.TestCase):
+    def run_both(self, dmatrix, members, number_of_groups, ratio, seed):
+        random.seed(seed)
+        return_old = oldfu.do_assignment_by_dmatrix_orien_group_minimum_group_size(
+            dmatrix.tolist(), members, number_of_groups, ratio
+        )
+        random.seed(seed)
+        return_new = fu.do_assignment_by_dmatrix_orien_group_minimum_group_size(
+            dmatrix, members, number_of_groups, ratio
+        )
+        return return_old, return_new
+
+    def test_same_assignment_random_values(self):
+        for seed in range(20):
+            dmatrix = synthetic_dmatrix(4, 200, False, seed)
+            members = list(range(0, 200, 2))
+            return_old, return_new = self.run_both(dmatrix, members, 4, 0.8, seed)
+            self.assertEqual(return_old, return_new)
+
+    def test_same_assignment_with_ties(self):
+        for seed in range(20):
+            dmatrix = synthetic_dmatrix(5, 120, True, seed)
+            members = list(range(120))
+            return_old, return_new = self.run_both(dmatrix, members, 5, 1.0, seed)
+            self.assertEqual(return_old, return_new)
+
+    def test_minimum_group_size(self):
+        dmatrix = synthetic_dmatrix(3, 300, False, 0)
+        dmatrix[0] += 10.0  # every particle prefers group 0
+        return_new = fu.do_assignment_by_dmatrix_orien_group_minimum_group_size(
+            dmatrix, list(range(300)), 3, 0.6
+        )
+        for igroup in range(3):
+            self.assertGreaterEqual(return_new.count(igroup), 60)
+
+    @unittest.skipUnless(
+        os.environ.get("SPHIRE_BENCHMARK"),
+        "set SPHIRE_BENCHMARK=1 to run the timing comparison",
+    )
+    def test_benchmark(self):
+        for nima in (2000, 8000):
+            dmatrix = synthetic_dmatrix(8, nima, False, nima)
+            members = list(range(nima))
+            random.seed(1)
+            t0 = time.time()
+            return_old = oldfu.do_assignment_by_dmatrix_orien_group_minimum_group_size(
+                dmatrix.tolist(), members, 8, 0.9
+            )
+            t1 = time.time()
+            random.seed(1)
+            return_new = fu.do_assignment_by_dmatrix_orien_group_minimum_group_size(
+                dmatrix, members, 8, 0.9
+            )
+            t2 = time.time()
+            print(
+                "{} particles, 8 groups: old {:.3f} s, new {:.3f} s".format(
+                    nima, t1 - t0, t2 - t1
+                )
+            )
+            self.assertEqual(return_old, return_new)
+
+
+if __name__ == "__main__":
+    unittest.main()